@@ -1,57 +1,112 @@
 #!/usr/bin/env python
+import time
+STARTED = time.time() #start of imports, for startup timing
+
 import sys
 import os.path
-import csv
+import threading
 
 from PyQt4 import QtGui, QtCore
-from Crypto import Random
-
-from trezorlib.client import BaseClient, ProtocolMixin, CallException, PinException
-from trezorlib.transport import ConnectionError
-from trezorlib.transport_hid import HidTransport
-from trezorlib import messages_pb2 as proto
 
 from ui_mainwindow import Ui_MainWindow
 
-import password_map
-from encoding import q2s, s2q
-from backup import Backup
-
-from dialogs import AddGroupDialog, TrezorPassphraseDialog, AddPasswordDialog, \
-	InitializeDialog, EnterPinDialog, TrezorChooserDialog
+#modules needing trezorlib, RSA or dialogs (qt_trezor, password_map,
+#backup, export, importer, regroup, dialogs) are imported on first use,
+#so the main window is shown before they load
+import profiler
+from qt_encoding import q2s, s2q
+from device_cache import DeviceCache
+from search_index import SearchIndex, SIMILAR
+from password_cache import PasswordCache, DEFAULT_TTL, DEFAULT_MAX_ENTRIES
+from password_table_model import PasswordTableModel
+from group_tree_model import GroupTreeModel, GROUP_SEPARATOR
+from qt_device_worker import QtDeviceWorker, QtBackgroundTask, ProgressRelay
 
 class MainWindow(QtGui.QMainWindow, Ui_MainWindow):
 	"""Main window for the application with groups and password lists"""
 
-	KEY_IDX = 0 #column where key is shown in password table
-	PASSWORD_IDX = 1 #column where password is shown in password table
-	CACHE_IDX = 0 #column of QWidgetItem in whose data we cache decrypted passwords
+	EXPIRE_INTERVAL = 10 #seconds between wiping expired cached passwords
+	SAVE_DELAY = 300 #milliseconds save requests are coalesced for
 	
-	def __init__(self, pwMap, dbFilename):
+	def __init__(self, settings):
 		"""
-		@param pwMap: a PasswordMap instance with encrypted passwords
-		@param dbFilename: file name for saving pwMap
+		Window starts locked, with no password map, until
+		setPasswordMap is called.
+		
+		@param settings: Settings with file name for saving password map,
+			autosave interval and password cache parameters
 		"""
 		QtGui.QMainWindow.__init__(self)
 		self.setupUi(self)
 		
-		self.pwMap = pwMap
+		self.pwMap = None #PasswordMap with encrypted passwords
 		self.selectedGroup = None
 		self.modified = False #modified flag "Save?" question on exit
-		self.dbFilename = dbFilename
-		
-		self.groupsModel = QtGui.QStandardItemModel()
-		self.groupsModel.setHorizontalHeaderLabels(["Password group"])
-		self.groupsFilter = QtGui.QSortFilterProxyModel()
-		self.groupsFilter.setSourceModel(self.groupsModel)
-		
-		self.groupsTree.setModel(self.groupsFilter)
+		self.dbFilename = settings.dbFilename
+		self.passwordCache = PasswordCache(settings.cacheTtl, settings.cacheMaxEntries)
+		self.lockCount = 0 #increased by lock(), stale decrypt results are dropped
+		
+		#all Trezor calls run in worker thread, progress is in status bar
+		self.device = QtDeviceWorker(self)
+		self.device.errorHandler = self.showDeviceError
+		self.device.queueChanged.connect(self.updateProgress)
+		self.progressLabel = QtGui.QLabel()
+		self.progressBar = QtGui.QProgressBar()
+		self.progressBar.setRange(0, 0) #busy indicator
+		self.progressBar.setMaximumWidth(100)
+		self.cancelButton = QtGui.QPushButton("Cancel queued")
+		self.cancelButton.clicked.connect(self.device.cancelPending)
+		for widget in (self.progressLabel, self.progressBar, self.cancelButton):
+			self.statusBar.addPermanentWidget(widget)
+			widget.hide()
+		
+		self.expireTimer = QtCore.QTimer(self)
+		self.expireTimer.timeout.connect(self.passwordCache.expire)
+		self.expireTimer.start(self.EXPIRE_INTERVAL * 1000)
+		
+		#lock after given time without keyboard or mouse input, 0 disables
+		self.idleTimer = QtCore.QTimer(self)
+		self.idleTimer.setSingleShot(True)
+		self.idleTimer.setInterval(settings.idleTimeout * 1000)
+		self.idleTimer.timeout.connect(self.lock)
+		if settings.idleTimeout > 0:
+			self.idleTimer.start()
+			QtGui.QApplication.instance().installEventFilter(self)
+		
+		#database is written in background thread, save requests
+		#coming until the write starts or while it runs are coalesced
+		self.saveTask = None #QtBackgroundTask writing snapshot of pwMap
+		self.saveRequested = False #changes wait for next write
+		self.afterSave = [] #functions to call after next write
+		self.saveTimer = QtCore.QTimer(self)
+		self.saveTimer.setSingleShot(True)
+		self.saveTimer.setInterval(self.SAVE_DELAY)
+		self.saveTimer.timeout.connect(self.startSave)
+		#save changes given time after first unsaved change, 0 disables
+		self.autosaveTimer = QtCore.QTimer(self)
+		self.autosaveTimer.setSingleShot(True)
+		self.autosaveTimer.setInterval(settings.autosave * 1000)
+		self.autosaveTimer.timeout.connect(self.saveDatabase)
+		self.autosave = settings.autosave > 0
+		
+		#groups are shown as tree of their names split by GROUP_SEPARATOR
+		self.groupsModel = GroupTreeModel([], self)
+		self.groupsTree.setModel(self.groupsModel)
 		self.groupsTree.setContextMenuPolicy(QtCore.Qt.CustomContextMenu)
 		self.groupsTree.customContextMenuRequested.connect(self.showGroupsContextMenu)
 		self.groupsTree.clicked.connect(self.loadPasswordsBySelection)
-		self.groupsTree.selectionModel().selectionChanged.connect(self.loadPasswordsBySelection)
-		self.groupsTree.setSortingEnabled(True)
 		
+		self.passwordModel = PasswordTableModel(self.passwordCache, self)
+		self.passwordTable.setModel(self.passwordModel)
+		self.passwordTable.setSortingEnabled(True)
+		self.passwordTable.sortByColumn(PasswordTableModel.PASSWORD_IDX, QtCore.Qt.AscendingOrder)
+		self.passwordTable.horizontalHeader().setStretchLastSection(True)
+		#fixed row height, so that view does not measure all rows
+		verticalHeader = self.passwordTable.verticalHeader()
+		verticalHeader.setResizeMode(QtGui.QHeaderView.Fixed)
+		verticalHeader.setDefaultSectionSize(self.passwordTable.fontMetrics().height() + 6)
+		#repaint so that expired passwords are hidden
+		self.expireTimer.timeout.connect(self.passwordTable.viewport().update)
 		self.passwordTable.setContextMenuPolicy(QtCore.Qt.CustomContextMenu)
 		self.passwordTable.customContextMenuRequested.connect(self.showPasswdContextMenu)
 		self.passwordTable.setSelectionBehavior(QtGui.QAbstractItemView.SelectRows)
@@ -62,22 +117,97 @@ class MainWindow(QtGui.QMainWindow, Ui_MainWindow):
 		
 		self.actionQuit.triggered.connect(self.close)
 		self.actionBackup.triggered.connect(self.saveBackup)
+		self.actionImport.triggered.connect(self.importPasswords)
 		self.actionSave.triggered.connect(self.saveDatabase)
 		self.actionSave.setShortcut(QtGui.QKeySequence("Ctrl+S"))
-		
-		headerKey = QtGui.QTableWidgetItem("Key");
-		headerValue = QtGui.QTableWidgetItem("Value");
-		self.passwordTable.setColumnCount(2)
-		self.passwordTable.setHorizontalHeaderItem(self.KEY_IDX, headerKey)
-		self.passwordTable.setHorizontalHeaderItem(self.PASSWORD_IDX, headerValue)
+		self.actionLock.triggered.connect(self.lock)
+		self.actionLock.setShortcut(QtGui.QKeySequence("Ctrl+L"))
 		
 		self.searchEdit.textChanged.connect(self.filterGroups)
+		self.searchIndex = None #built on first search
+		self.searchMatches = [] #(group name, key) shown in searchResults
+		self.searchResults.hide()
+		self.searchResults.itemActivated.connect(self.showSearchResult)
+		self.searchResults.itemClicked.connect(self.showSearchResult)
+		
+		self.setUnlocked(False)
+		self.statusBar.showMessage("Waiting for Trezor to unlock password database")
+	
+	def setUnlocked(self, unlocked):
+		"""
+		Enable or disable widgets and actions working with password map.
+		"""
+		for widget in (self.groupsTree, self.passwordTable, self.searchEdit,
+			self.actionSave, self.actionBackup, self.actionImport, self.actionLock):
+			widget.setEnabled(unlocked)
+	
+	def setPasswordMap(self, pwMap):
+		"""
+		Show groups of password map and unlock window.
+		
+		@param pwMap: PasswordMap with decrypted outer layer
+		"""
+		self.pwMap = pwMap
+		self.groupsModel = GroupTreeModel(self.pwMap.groups.keys(), self)
+		self.groupsTree.setModel(self.groupsModel)
+		self.groupsTree.selectionModel().selectionChanged.connect(self.loadPasswordsBySelection)
+		self.setUnlocked(True)
+		self.statusBar.clearMessage()
+	
+	def eventFilter(self, obj, event):
+		"""
+		Restart idle timer on user input to any widget.
+		"""
+		if event.type() in (QtCore.QEvent.KeyPress, QtCore.QEvent.MouseButtonPress,
+			QtCore.QEvent.Wheel):
+			self.idleTimer.start()
+		return False
+	
+	def updateProgress(self):
+		"""
+		Show what Trezor request is waited for and how many are queued.
+		"""
+		pending = self.device.pending()
+		self.progressLabel.setVisible(bool(pending))
+		self.progressBar.setVisible(bool(pending))
+		self.cancelButton.setVisible(len(pending) > 1)
+		if not pending:
+			return
 		
-		groupNames = self.pwMap.groups.keys()
-		for groupName in groupNames:
-			item = QtGui.QStandardItem(s2q(groupName))
-			self.groupsModel.appendRow(item)
-		self.groupsTree.sortByColumn(0, QtCore.Qt.AscendingOrder)
+		text = "Waiting for Trezor: " + pending[0].description
+		if len(pending) > 1:
+			text += " (%d more queued)" % (len(pending) - 1)
+		self.progressLabel.setText(s2q(text))
+	
+	def showDeviceError(self, error):
+		"""
+		Handle exception raised by Trezor request.
+		"""
+		from trezorlib.client import CallException, PinException
+		if isinstance(error, SystemExit): #PIN or passphrase dialog cancelled
+			QtGui.QApplication.instance().exit(error.code)
+			return
+		if isinstance(error, PinException):
+			text = "Invalid PIN"
+		elif isinstance(error, CallException):
+			return #cancelled on Trezor
+		else:
+			text = "Trezor request failed: " + str(error)
+		msgBox = QtGui.QMessageBox(text=s2q(text))
+		msgBox.exec_()
+	
+	def lock(self):
+		"""
+		Forget decrypted passwords and unlocked group keys and hide
+		shown passwords, next access needs Trezor confirmation again.
+		Queued requests are cancelled.
+		"""
+		self.lockCount += 1
+		self.device.cancelPending()
+		self.passwordCache.clear()
+		if self.pwMap is not None:
+			self.pwMap.lockGroups()
+		self.passwordModel.hidePasswords()
 	
 	def setModified(self, modified):
 		"""
@@ -86,6 +216,8 @@ class MainWindow(QtGui.QMainWindow, Ui_MainWindow):
 		"""
 		self.modified = modified
 		self.setWindowTitle("TrezorPass" + "*" * int(self.modified))
+		if modified and self.autosave and not self.autosaveTimer.isActive():
+			self.autosaveTimer.start()
 	
 	def showGroupsContextMenu(self, point):
 		"""
@@ -96,22 +228,34 @@ class MainWindow(QtGui.QMainWindow, Ui_MainWindow):
 		self.addGroupMenu = QtGui.QMenu(self)
 		newGroupAction = QtGui.QAction('Add group', self)
 		deleteGroupAction = QtGui.QAction('Delete group', self)
+		renameGroupAction = QtGui.QAction('Rename, merge or re-key group', self)
+		groupKeyAction = QtGui.QAction('Unlock with one confirmation', self)
 		self.addGroupMenu.addAction(newGroupAction)
 		self.addGroupMenu.addAction(deleteGroupAction)
-		
-		#disable deleting if no point is clicked on
-		proxyIdx = self.groupsTree.indexAt(point)
-		itemIdx = self.groupsFilter.mapToSource(proxyIdx)
-		item = self.groupsModel.itemFromIndex(itemIdx)
-		if item is None:
+		self.addGroupMenu.addAction(renameGroupAction)
+		self.addGroupMenu.addAction(groupKeyAction)
+		
+		#disable deleting if no group is clicked on, folder nodes are
+		#not groups
+		index = self.groupsTree.indexAt(point)
+		groupName = self.groupsModel.groupName(index)
+		if groupName is None:
 			deleteGroupAction.setEnabled(False)
+			renameGroupAction.setEnabled(False)
+			groupKeyAction.setEnabled(False)
+		elif self.pwMap.hasGroupKey(groupName):
+			groupKeyAction.setEnabled(False)
 		
 		action = self.addGroupMenu.exec_(self.groupsTree.mapToGlobal(point))
 		
 		if action == newGroupAction:
-			self.createGroup()
+			self.createGroup(self.groupsModel.folderPath(index))
 		elif action == deleteGroupAction:
-			self.deleteGroup(item)
+			self.deleteGroup(groupName)
+		elif action == renameGroupAction:
+			self.renameGroup(groupName)
+		elif action == groupKeyAction:
+			self.convertToGroupKey(groupName)
 			
 	
 	def showPasswdContextMenu(self, point):
@@ -139,8 +283,8 @@ class MainWindow(QtGui.QMainWindow, Ui_MainWindow):
 			newItemAction.setEnabled(False)
 		
 		#disable deleting if no point is clicked on
-		item = self.passwordTable.itemAt(point.x(), point.y())
-		if item is None:
+		index = self.passwordTable.indexAt(point)
+		if not index.isValid():
 			deleteItemAction.setEnabled(False)
 			showPasswordAction.setEnabled(False)
 			copyPasswordAction.setEnabled(False)
@@ -150,42 +294,175 @@ class MainWindow(QtGui.QMainWindow, Ui_MainWindow):
 		if action == newItemAction:
 			self.createPassword()
 		elif action == deleteItemAction:
-			self.deletePassword(item)
+			self.deletePassword(index)
 		elif action == showPasswordAction:
-			self.showPassword(item)
+			self.showPassword(index)
 		elif action == editItemAction:
-			self.editPassword(item)
+			self.editPassword(index)
 		elif action == copyPasswordAction:
-			self.copyPasswordFromItem(item)
+			self.copyPasswordFromIndex(index)
 			
 	
-	def createGroup(self):
+	def createGroup(self, parentPath=None):
 		"""Slot to create a password group.
+		
+		@param parentPath: name of group or folder the new group is
+			put under by default
 		"""
+		from dialogs import AddGroupDialog
 		dialog = AddGroupDialog(self.pwMap.groups)
+		if parentPath is not None:
+			dialog.newGroupEdit.setText(s2q(parentPath + GROUP_SEPARATOR))
 		if not dialog.exec_():
 			return
 		
 		groupName = dialog.newGroupName()
+		if dialog.groupKey():
+			self.device.submit("create group key", self.pwMap.newGroupKey,
+				(q2s(groupName),), lambda groupKey: self.insertGroup(groupName, groupKey))
+		else:
+			self.insertGroup(groupName, None)
+	
+	def insertGroup(self, groupName, groupKey):
+		"""
+		Add group to password map and groups tree and select it.
 		
-		newItem = QtGui.QStandardItem(groupName)
-		self.groupsModel.appendRow(newItem)
-		self.pwMap.addGroup(q2s(groupName))
-		
-		#make new item selected to save a few clicks
-		itemIdx = self.groupsModel.indexFromItem(newItem)
-		proxyIdx = self.groupsFilter.mapFromSource(itemIdx)
-		self.groupsTree.selectionModel().select(proxyIdx,
-			QtGui.QItemSelectionModel.ClearAndSelect | QtGui.QItemSelectionModel.Rows)
-		self.groupsTree.sortByColumn(0, QtCore.Qt.AscendingOrder)
+		@param groupName: group name as QString
+		@param groupKey: tuple (key, wrapped key) or None
+		"""
+		name = q2s(groupName)
+		if name in self.pwMap.groups:
+			return
+		self.pwMap.addGroup(name, groupKey)
+		self.groupsModel.addGroup(name)
 		
-		#Make item's passwords loaded so new key-value entries can be created
-		#right away - better from UX perspective.
-		self.loadPasswords(newItem)
+		#make new item selected to save a few clicks, its passwords are
+		#loaded so new key-value entries can be created right away
+		self.selectGroup(name)
 		
 		self.setModified(True)
+	
+	def selectGroup(self, groupName):
+		"""
+		Expand groups tree down to group, select it and show its entries.
+		"""
+		index = self.groupsModel.indexForPath(groupName)
+		if index.isValid():
+			parent = index.parent()
+			while parent.isValid():
+				self.groupsTree.expand(parent)
+				parent = parent.parent()
+			self.groupsTree.selectionModel().setCurrentIndex(index,
+				QtGui.QItemSelectionModel.ClearAndSelect | QtGui.QItemSelectionModel.Rows)
+			self.groupsTree.scrollTo(index)
+		self.showEntries(groupName)
 
-	def deleteGroup(self, item):
+	def convertToGroupKey(self, name):
+		"""
+		Re-encrypt passwords of group with group key. Trezor asks to
+		confirm each password once, afterwards one confirmation unlocks
+		whole group.
+		"""
+		values = list(self.pwMap.groups[name].values)
+		msgBox = QtGui.QMessageBox(text="Trezor will ask to confirm each of %d passwords "
+			"once. Continue?" % len(values))
+		msgBox.setStandardButtons(QtGui.QMessageBox.Yes | QtGui.QMessageBox.No)
+		if msgBox.exec_() != QtGui.QMessageBox.Yes:
+			return
+		
+		self.device.submit("convert group %s" % name, self.decryptForGroupKey,
+			(name, values), lambda result: self.reencryptGroup(name, values, *result))
+	
+	def decryptForGroupKey(self, groupName, values):
+		"""
+		Decrypt given encrypted passwords of group and create group key.
+		Runs in worker thread.
+		
+		@returns tuple (group key, decrypted passwords)
+		"""
+		passwords = [self.pwMap.decryptPassword(encPw, groupName) for encPw in values]
+		return self.pwMap.newGroupKey(groupName), passwords
+	
+	def reencryptGroup(self, groupName, values, groupKey, passwords):
+		"""
+		Switch group to group key if it was not changed since its
+		passwords were decrypted.
+		"""
+		if groupName not in self.pwMap.groups or \
+			list(self.pwMap.groups[groupName].values) != values:
+			msgBox = QtGui.QMessageBox(text="Group was changed while converting, try again.")
+			msgBox.exec_()
+			return
+		
+		self.pwMap.reencryptGroup(groupName, groupKey, passwords)
+		self.passwordCache.removeGroup(groupName)
+		if self.selectedGroup == groupName:
+			self.showEntries(groupName)
+		self.setModified(True)
+	
+	def renameGroup(self, name):
+		"""
+		Move entries of group under new name, merging them into existing
+		group of that name, or re-key group if name stays the same.
+		Passwords are decrypted with backup key, so Trezor asks to
+		confirm that once instead of every password. Entries are
+		re-encrypted in worker thread and group is replaced when all of
+		them are.
+		"""
+		from dialogs import RenameGroupDialog
+		from export import ExportCancelled
+		from regroup import moveGroups
+		dialog = RenameGroupDialog(self.pwMap.groups, name)
+		if not dialog.exec_():
+			return
+		
+		targetName = q2s(dialog.newGroupName())
+		groupKeys = dialog.groupKey()
+		cancelEvent = threading.Event()
+		progressDialog = QtGui.QProgressDialog("Moving passwords", "Cancel", 0, 100, self)
+		progressDialog.setWindowModality(QtCore.Qt.WindowModal)
+		progressDialog.setMinimumDuration(500)
+		progressDialog.canceled.connect(cancelEvent.set)
+		
+		relay = ProgressRelay(self)
+		relay.progressed.connect(lambda done, total:
+			progressDialog.setValue(100 * done / total if total else 0))
+		
+		def encryptMove():
+			privateKey = self.pwMap.backupKey.unwrapPrivateKey()
+			return moveGroups(self.pwMap, [name], targetName, privateKey, groupKeys,
+				progress=relay.progressed.emit, cancelEvent=cancelEvent)
+		
+		def failed(error):
+			progressDialog.reset()
+			if not isinstance(error, ExportCancelled):
+				self.showDeviceError(error)
+		
+		self.device.submit("move group %s" % name, encryptMove, (),
+			lambda move: self.commitMove(move, progressDialog), failed)
+	
+	def commitMove(self, move, progressDialog):
+		"""
+		Replace source groups with target group in password map and
+		groups tree.
+		"""
+		progressDialog.reset()
+		try:
+			move.commit()
+		except KeyError, e:
+			msgBox = QtGui.QMessageBox(text=s2q("Group was changed while moving, try again: " + str(e)))
+			msgBox.exec_()
+			return
+		
+		for groupName in move.sourceNames + [move.targetName]:
+			self.passwordCache.removeGroup(groupName)
+			if groupName != move.targetName:
+				self.groupsModel.removeGroup(groupName)
+		self.groupsModel.addGroup(move.targetName)
+		self.selectGroup(move.targetName)
+		self.setModified(True)
+	
+	def deleteGroup(self, name):
 		msgBox = QtGui.QMessageBox(text="Are you sure about delete?")
 		msgBox.setStandardButtons(QtGui.QMessageBox.Yes | QtGui.QMessageBox.No)
 		res = msgBox.exec_()
@@ -193,18 +470,17 @@ class MainWindow(QtGui.QMainWindow, Ui_MainWindow):
 		if res != QtGui.QMessageBox.Yes:
 			return
 		
-		name = q2s(item.text())
 		self.selectedGroup = None
-		del self.pwMap.groups[name]
+		self.pwMap.removeGroup(name)
+		self.passwordCache.removeGroup(name)
 		
-		itemIdx = self.groupsModel.indexFromItem(item)
-		self.groupsModel.takeRow(itemIdx.row())
-		self.passwordTable.setRowCount(0)
+		self.groupsModel.removeGroup(name)
+		self.passwordModel.setGroup(None, None)
 		self.groupsTree.clearSelection()
 		
 		self.setModified(True)
 	
-	def deletePassword(self, item):
+	def deletePassword(self, index):
 		msgBox = QtGui.QMessageBox(text="Are you sure about delete?")
 		msgBox.setStandardButtons(QtGui.QMessageBox.Yes | QtGui.QMessageBox.No)
 		res = msgBox.exec_()
@@ -212,108 +488,109 @@ class MainWindow(QtGui.QMainWindow, Ui_MainWindow):
 		if res != QtGui.QMessageBox.Yes:
 			return
 		
-		row = self.passwordTable.row(item)
-		self.passwordTable.removeRow(row)
-		group = self.pwMap.groups[self.selectedGroup]
-		group.removeEntry(row)
+		idx = self.passwordModel.entryIndex(index.row())
+		encPw = self.pwMap.groups[self.selectedGroup].entry(idx)[1]
+		self.passwordCache.remove(self.selectedGroup, encPw)
+		self.passwordModel.removeEntry(idx,
+			lambda: self.pwMap.removeEntry(self.selectedGroup, idx))
 		
-		self.passwordTable.resizeRowsToContents()
 		self.setModified(True)
 	
-	def cachePassword(self, row, password):
+	def entryIndex(self, groupName, encPw):
 		"""
-		Cache decrypted password for group and row. Cached items are
-		keps as data of QTableWidgetItem so that deletion invalidates
-		cache.
+		Find entry by its encrypted password, which is unique thanks
+		to random IV. Entries may move while a request is queued.
 		
-		Cache applies to currently selectedGroup.
-		
-		Switching between groups clears the table and thus invalidates
-		cached passwords.
+		@returns index of entry in group or None if it was removed
 		"""
-		item = self.passwordTable.item(row, MainWindow.CACHE_IDX)
-		item.setData(QtCore.Qt.UserRole, QtCore.QVariant(s2q(password)))
+		if groupName not in self.pwMap.groups:
+			return None
+		for idx, value in enumerate(self.pwMap.groups[groupName].values):
+			if value == encPw:
+				return idx
+		return None
 	
-	def cachedPassword(self, row):
+	def withPassword(self, index, callback):
 		"""
-		Retrieve cached password for given row of currently selected group.
-		Returns password as string or None if no password cached.
+		Call callback(groupName, encPw, password) with decrypted password
+		of entry shown at index of password table. Password is taken from
+		cache or decrypted by Trezor in worker thread, callback is then
+		called when it's done unless window was locked meanwhile.
 		"""
-		item = self.passwordTable.item(row, MainWindow.CACHE_IDX)
-		cached = item.data(QtCore.Qt.UserRole)
+		groupName = self.selectedGroup
+		encPw = self.pwMap.groups[groupName].entry(self.passwordModel.entryIndex(index.row()))[1]
+		cached = self.passwordCache.get(groupName, encPw)
+		if cached is not None:
+			callback(groupName, encPw, cached)
+			return
 		
-		if cached.isValid():
-			return q2s(cached.toString())
+		lockCount = self.lockCount
+		def decrypted(password):
+			if lockCount != self.lockCount:
+				return
+			self.passwordCache.put(groupName, encPw, password)
+			callback(groupName, encPw, password)
 		
-		return None
+		self.device.submit("decrypt password", self.pwMap.decryptPassword,
+			(encPw, groupName), decrypted)
 	
-	def cachedOrDecrypt(self, row):
-		"""
-		Try retrieving cached password for item in given row, otherwise
-		decrypt with Trezor.
+	def encryptEntry(self, groupName, plainPw):
 		"""
-		cached = self.cachedPassword(row)
-		
-		if cached is not None:
-			return cached
-		else: #decrypt with Trezor
-			group = self.pwMap.groups[self.selectedGroup]
-			pwEntry = group.entry(row)
-			encPw = pwEntry[1]
-			
-			decrypted = self.pwMap.decryptPassword(encPw, self.selectedGroup)
+		Encrypt password for new or edited entry. Runs in worker thread.
 		
-		return decrypted
+		@returns tuple (encrypted password, backup encrypted password)
+		"""
+		encPw = self.pwMap.encryptPassword(plainPw, groupName)
+		bkupPw = self.pwMap.backupKey.encryptPassword(plainPw)
+		return encPw, bkupPw
 	
-	def showPassword(self, item):
-		#check if this password has been decrypted, use cached version
-		row = self.passwordTable.row(item)
-		try:
-			decrypted = self.cachedOrDecrypt(row)
-		except CallException:
-			return
-		item = QtGui.QTableWidgetItem(s2q(decrypted))
-		
-		self.cachePassword(row, decrypted)
-		self.passwordTable.setItem(row, self.PASSWORD_IDX, item)
+	def showPassword(self, index):
+		self.withPassword(index, self.displayPassword)
+	
+	def displayPassword(self, groupName, encPw, password):
+		if groupName == self.selectedGroup:
+			self.passwordModel.revealPassword(encPw, password)
 	
 	def createPassword(self):
 		"""Slot to create key-value password entry.
 		"""
 		if self.selectedGroup is None:
 			return
-		group = self.pwMap.groups[self.selectedGroup]
+		from dialogs import AddPasswordDialog
 		dialog = AddPasswordDialog()
 		if not dialog.exec_():
 			return
 		
-		rowCount = self.passwordTable.rowCount()
-		self.passwordTable.setRowCount(rowCount+1)
-		item = QtGui.QTableWidgetItem(dialog.key())
-		pwItem = QtGui.QTableWidgetItem("*****")
-		self.passwordTable.setItem(rowCount, self.KEY_IDX, item)
-		self.passwordTable.setItem(rowCount, self.PASSWORD_IDX, pwItem)
-		
+		groupName = self.selectedGroup
+		key = q2s(dialog.key())
 		plainPw = q2s(dialog.pw1())
-		encPw = self.pwMap.encryptPassword(plainPw, self.selectedGroup)
-		bkupPw = self.pwMap.backupKey.encryptPassword(plainPw)
-		group.addEntry(q2s(dialog.key()), encPw, bkupPw)
-		
-		self.cachePassword(rowCount, plainPw)
+		self.device.submit("encrypt password", self.encryptEntry, (groupName, plainPw),
+			lambda encrypted: self.appendEntry(groupName, key, plainPw, *encrypted))
+	
+	def appendEntry(self, groupName, key, plainPw, encPw, bkupPw):
+		"""
+		Add encrypted entry to group and show it if group is selected.
+		"""
+		if groupName not in self.pwMap.groups:
+			return
+		self.pwMap.addEntry(groupName, key, encPw, bkupPw)
+		self.passwordCache.put(groupName, encPw, plainPw)
 		
-		self.passwordTable.resizeRowsToContents()
+		if groupName == self.selectedGroup:
+			self.passwordModel.entryAdded()
 		self.setModified(True)
 	
-	def editPassword(self, item):
-		row = self.passwordTable.row(item)
-		group = self.pwMap.groups[self.selectedGroup]
-		try:
-			decrypted = self.cachedOrDecrypt(row)
-		except CallException:
+	def editPassword(self, index):
+		self.withPassword(index, self.editDecrypted)
+	
+	def editDecrypted(self, groupName, encPw, decrypted):
+		idx = self.entryIndex(groupName, encPw)
+		if idx is None:
 			return
 		
+		from dialogs import AddPasswordDialog
 		dialog = AddPasswordDialog()
-		entry = group.entry(row)
+		entry = self.pwMap.groups[groupName].entry(idx)
 		dialog.keyEdit.setText(s2q(entry[0]))
 		dialog.pwEdit1.setText(s2q(decrypted))
 		dialog.pwEdit2.setText(s2q(decrypted))
@@ -321,17 +598,26 @@ class MainWindow(QtGui.QMainWindow, Ui_MainWindow):
 		if not dialog.exec_():
 			return
 		
-		item = QtGui.QTableWidgetItem(dialog.key())
-		pwItem = QtGui.QTableWidgetItem("*****")
-		self.passwordTable.setItem(row, self.KEY_IDX, item)
-		self.passwordTable.setItem(row, self.PASSWORD_IDX, pwItem)
-		
+		key = q2s(dialog.key())
 		plainPw = q2s(dialog.pw1())
-		encPw = self.pwMap.encryptPassword(plainPw, self.selectedGroup)
-		bkupPw = self.pwMap.backupKey.encryptPassword(plainPw)
-		group.updateEntry(row, q2s(dialog.key()), encPw, bkupPw)
+		self.device.submit("encrypt password", self.encryptEntry, (groupName, plainPw),
+			lambda encrypted: self.replaceEntry(groupName, encPw, key, plainPw, *encrypted))
+	
+	def replaceEntry(self, groupName, oldEncPw, key, plainPw, encPw, bkupPw):
+		"""
+		Update entry given by its old encrypted password, if it still
+		exists.
+		"""
+		idx = self.entryIndex(groupName, oldEncPw)
+		if idx is None:
+			return
 		
-		self.cachePassword(row, plainPw)
+		self.passwordCache.remove(groupName, oldEncPw)
+		self.pwMap.updateEntry(groupName, idx, key, encPw, bkupPw)
+		self.passwordCache.put(groupName, encPw, plainPw)
+		
+		if groupName == self.selectedGroup:
+			self.passwordModel.entryChanged(idx)
 		self.setModified(True)
 	
 	def copyPasswordFromSelection(self):
@@ -344,68 +630,94 @@ class MainWindow(QtGui.QMainWindow, Ui_MainWindow):
 			return
 		
 		#there will be more indexes as the selection is on a row
-		row = indexes[0].row()
-		item = self.passwordTable.item(row, 1)
-		self.copyPasswordFromItem(item)
+		self.copyPasswordFromIndex(indexes[0])
 	
-	def copyPasswordFromItem(self, item):
-		row = self.passwordTable.row(item)
-		try:
-			decrypted = self.cachedOrDecrypt(row)
-		except CallException:
-			return
-		
+	def copyPasswordFromIndex(self, index):
+		self.withPassword(index, self.copyPassword)
+	
+	def copyPassword(self, groupName, encPw, password):
 		clipboard = QtGui.QApplication.clipboard()
-		clipboard.setText(s2q(decrypted))
-		
-		self.cachePassword(row, decrypted)
+		clipboard.setText(s2q(password))
 		
-	def loadPasswords(self, item):
-		"""Slot that should load items for group that has been clicked on.
+	def showEntries(self, name):
+		"""
+		Select group and show its entries in password table.
 		"""
-		#self.passwordTable.clear()
-		name = q2s(item.text())
 		self.selectedGroup = name
-		group = self.pwMap.groups[name]
-		self.passwordTable.setRowCount(len(group.entries))
-		self.passwordTable.setColumnCount(2)
-		
-		i = 0
-		for key, encValue, bkupValue in group.entries:
-			item = QtGui.QTableWidgetItem(s2q(key))
-			pwItem = QtGui.QTableWidgetItem("*****")
-			self.passwordTable.setItem(i, self.KEY_IDX, item)
-			self.passwordTable.setItem(i, self.PASSWORD_IDX, pwItem)
-			i = i+1
-		
-		self.passwordTable.resizeRowsToContents()
+		self.passwordModel.setGroup(name, self.pwMap.groups[name])
 	
 	def loadPasswordsBySelection(self):
-		proxyIdx = self.groupsTree.currentIndex()
-		itemIdx = self.groupsFilter.mapToSource(proxyIdx)
-		selectedItem = self.groupsModel.itemFromIndex(itemIdx)
-		
-		if not selectedItem:
+		"""Slot that should load items for group that has been clicked on.
+		"""
+		groupName = self.groupsModel.groupName(self.groupsTree.currentIndex())
+		if groupName is None or groupName == self.selectedGroup:
 			return
 		
-		self.loadPasswords(selectedItem)
+		self.showEntries(groupName)
 	
 	def filterGroups(self, substring):
 		"""
-		Filter groupsTree view to have items containing given substring.
+		Show groups and entries containing given substring in search
+		results. Groups tree is not filtered, its nodes are created
+		only when expanded.
 		"""
-		self.groupsFilter.setFilterFixedString(substring)
-		self.groupsTree.sortByColumn(0, QtCore.Qt.AscendingOrder)
+		self.searchEntries(q2s(substring))
+	
+	def searchEntries(self, query):
+		"""
+		Show group names and keys of all groups matching query in
+		search results. Search index is built on first search and kept
+		up to date by password map. Results not containing query, only
+		similar to it, are shown in italics.
+		"""
+		if self.searchIndex is None:
+			self.searchIndex = SearchIndex()
+			self.searchIndex.build(self.pwMap.groups)
+			self.pwMap.searchIndex = self.searchIndex
+		
+		matches = self.searchIndex.classifiedSearch(query)
+		self.searchMatches = [doc for doc, _ in matches]
+		self.searchResults.clear()
+		for (groupName, key), matchClass in matches:
+			text = groupName if key is None else groupName + " / " + key
+			item = QtGui.QListWidgetItem(s2q(text))
+			if matchClass == SIMILAR:
+				font = item.font()
+				font.setItalic(True)
+				item.setFont(font)
+			self.searchResults.addItem(item)
+		self.searchResults.setVisible(bool(self.searchMatches))
+	
+	def showSearchResult(self, item):
+		"""
+		Select group of search result and the row with its key.
+		"""
+		groupName, key = self.searchMatches[self.searchResults.row(item)]
+		if groupName not in self.pwMap.groups:
+			return
+		
+		self.selectGroup(groupName)
+		
+		if key is not None:
+			keys = self.pwMap.groups[groupName].keys
+			for idx in xrange(len(keys)):
+				if keys[idx] == key:
+					row = self.passwordModel.rowOfEntry(idx)
+					self.passwordTable.selectRow(row)
+					self.passwordTable.scrollTo(self.passwordModel.index(row, PasswordTableModel.KEY_IDX))
+					break
 	
 	def saveBackup(self):
 		"""
 		Uses backup key encrypted by Trezor to decrypt all passwords
 		at once and export them.
 		
-		Export format is CSV: group, key, password
+		Export format is CSV (group, key, password) or JSON Lines.
 		"""
+		csvFilter = QtCore.QString("CSV files (*.csv)")
+		jsonlFilter = QtCore.QString("JSON Lines files (*.jsonl)")
 		dialog = QtGui.QFileDialog(self, "Select backup export file",
-			"", "CVS files (*.csv)")
+			"", csvFilter + ";;" + jsonlFilter)
 		dialog.setAcceptMode(QtGui.QFileDialog.AcceptSave)
 		
 		res = dialog.exec_()
@@ -413,166 +725,232 @@ class MainWindow(QtGui.QMainWindow, Ui_MainWindow):
 			return
 		
 		fname = q2s(dialog.selectedFiles()[0])
-		backupKey = self.pwMap.backupKey
-		try:
-			privateKey = backupKey.unwrapPrivateKey()
-		except CallException:
-			return
+		exportFormat = "csv"
+		if dialog.selectedNameFilter() == jsonlFilter or fname.endswith(".jsonl"):
+			exportFormat = "jsonl"
 		
-		with file(fname, "w") as f:
-			csv.register_dialect("escaped", doublequote=False, escapechar='\\')
-			writer = csv.writer(f, dialect="escaped")
-			sortedGroupNames = sorted(self.pwMap.groups.keys())
-			for groupName in sortedGroupNames:
-				group = self.pwMap.groups[groupName]
-				for entry in group.entries:
-					key, _, bkupPw = entry
-					password = backupKey.decryptPassword(bkupPw, privateKey)
-					csvEntry = (groupName, key, password)
-					writer.writerow(csvEntry)
+		self.device.submit("decrypt backup key", self.pwMap.backupKey.unwrapPrivateKey,
+			(), lambda privateKey: self.exportBackup(fname, exportFormat, privateKey))
 	
-	def saveDatabase(self):
+	def exportBackup(self, fname, exportFormat, privateKey):
 		"""
-		Save main database file.
+		Export snapshot of all groups in background thread, showing
+		progress dialog that allows to cancel it. Partially written
+		file is removed if export does not finish.
 		"""
-		self.pwMap.save(self.dbFilename)
-		self.setModified(False)
-	
-	def closeEvent(self, event):
-		if self.modified:
-			msgBox = QtGui.QMessageBox(text="Password database is modified. Save on exit?")
-			msgBox.setStandardButtons(QtGui.QMessageBox.Yes |
-				QtGui.QMessageBox.No | QtGui.QMessageBox.Cancel )
-			reply = msgBox.exec_()
-			
-			if not reply or reply == QtGui.QMessageBox.Cancel:
-				event.ignore()
-				return
-			elif reply == QtGui.QMessageBox.Yes:
-				self.saveDatabase()
-			
-		event.accept()
-	
-class QtTrezorMixin(object):
-	"""
-	Mixin for input of passhprases.
-	"""
-	
-	def __init__(self, *args, **kwargs):
-		super(QtTrezorMixin, self).__init__(*args, **kwargs)
-		self.passphrase = None
+		from export import EXPORT_FORMATS, ExportCancelled, snapshotGroups, exportGroups
+		snapshot = snapshotGroups(self.pwMap)
+		backupKey = self.pwMap.backupKey
+		total = sum(len(keys) for _, keys, _ in snapshot)
+		cancelEvent = threading.Event()
+		
+		progressDialog = QtGui.QProgressDialog("Exporting passwords", "Cancel", 0, total, self)
+		progressDialog.setWindowModality(QtCore.Qt.WindowModal)
+		progressDialog.setMinimumDuration(500)
+		progressDialog.canceled.connect(cancelEvent.set)
+		
+		def export(progress):
+			with file(fname, "w") as f:
+				writer = EXPORT_FORMATS[exportFormat](f)
+				exportGroups(snapshot, backupKey, privateKey, writer, progress=progress,
+					cancelEvent=cancelEvent)
+		
+		def done(value, error):
+			progressDialog.reset()
+			if error is not None:
+				if os.path.exists(fname):
+					os.remove(fname)
+				if not isinstance(error, ExportCancelled):
+					msgBox = QtGui.QMessageBox(text=s2q("Export failed: " + str(error)))
+					msgBox.exec_()
+		
+		self.exportTask = QtBackgroundTask(export, parent=self)
+		self.exportTask.progressed.connect(lambda written, total: progressDialog.setValue(written))
+		self.exportTask.taskDone.connect(done)
+		self.exportTask.start()
 	
-	def callback_ButtonRequest(self, msg):
-		return proto.ButtonAck()
-
-	def callback_PassphraseRequest(self, msg):
-		if self.passphrase is not None:
-			return proto.PassphraseAck(passphrase=self.passphrase)
-			
-		dialog = TrezorPassphraseDialog()
+	def importPasswords(self):
+		"""
+		Import passwords from CSV or JSON Lines backup export or from
+		KeePass 2.x XML export. Entries are encrypted in worker thread
+		and added to password map at once when all are encrypted.
+		"""
+		from importer import ImportCancelled, importFile
+		filters = [("csv", "CSV files (*.csv)"), ("jsonl", "JSON Lines files (*.jsonl)"),
+			("keepass", "KeePass 2.x XML files (*.xml)"),
+			("csv-legacy", "CSV backups of older TrezorPass (*.csv)")]
+		dialog = QtGui.QFileDialog(self, "Select file to import",
+			"", ";;".join(nameFilter for _, nameFilter in filters))
+		dialog.setFileMode(QtGui.QFileDialog.ExistingFile)
+		
 		if not dialog.exec_():
-			sys.exit(3)
-		else:
-			passphrase = dialog.passphraseEdit.text()
-			passphrase = unicode(passphrase)
+			return
 		
-		return proto.PassphraseAck(passphrase=passphrase)
+		fname = q2s(dialog.selectedFiles()[0])
+		importFormat = "csv"
+		for fmt, nameFilter in filters:
+			if dialog.selectedNameFilter() == nameFilter:
+				importFormat = fmt
+		
+		cancelEvent = threading.Event()
+		progressDialog = QtGui.QProgressDialog("Importing passwords", "Cancel", 0, 100, self)
+		progressDialog.setWindowModality(QtCore.Qt.WindowModal)
+		progressDialog.setMinimumDuration(500)
+		progressDialog.canceled.connect(cancelEvent.set)
+		
+		relay = ProgressRelay(self)
+		relay.progressed.connect(lambda done, total:
+			progressDialog.setValue(100 * done / total if total else 0))
+		
+		def encryptImport():
+			with file(fname) as f:
+				return importFile(self.pwMap, f, importFormat, progress=relay.progressed.emit,
+					cancelEvent=cancelEvent)
+		
+		def failed(error):
+			progressDialog.reset()
+			if isinstance(error, ImportCancelled):
+				return
+			if isinstance(error, (IOError, KeyError)):
+				msgBox = QtGui.QMessageBox(text=s2q("Import failed: " + str(error)))
+				msgBox.exec_()
+			else:
+				self.showDeviceError(error)
+		
+		self.device.submit("import %s" % os.path.basename(fname), encryptImport, (),
+			lambda passwordImport: self.commitImport(passwordImport, progressDialog), failed)
 	
-	def callback_PinMatrixRequest(self, msg):
-		dialog = EnterPinDialog()
-		if not dialog.exec_():
-			sys.exit(7)
+	def commitImport(self, passwordImport, progressDialog):
+		"""
+		Add encrypted imported entries to password map and groups tree.
+		"""
+		progressDialog.reset()
+		newGroups = [name for name in passwordImport.groups if name not in self.pwMap.groups]
+		try:
+			count = passwordImport.commit()
+		except KeyError, e:
+			msgBox = QtGui.QMessageBox(text=s2q("Import failed: " + str(e)))
+			msgBox.exec_()
+			return
 		
-		pin = q2s(dialog.pin())
-		return proto.PinMatrixAck(pin=pin)
-
-	def prefillPassphrase(self, passphrase):
+		for groupName in newGroups:
+			self.groupsModel.addGroup(groupName)
+		if self.selectedGroup in passwordImport.groups:
+			self.showEntries(self.selectedGroup)
+		self.setModified(True)
+		
+		msgBox = QtGui.QMessageBox(text="Imported %d passwords." % count)
+		msgBox.exec_()
+	
+	def saveDatabase(self):
 		"""
-		Instead of asking for passphrase, use this one
+		Save main database file, slot of File/Save and autosave timer.
+		Takes no arguments, since triggered signal passes checked flag.
 		"""
-		self.passphrase = passphrase.decode("utf-8")
-
-class QtTrezorClient(ProtocolMixin, QtTrezorMixin, BaseClient):
-	"""
-	Trezor client with Qt input methods
-	"""
-	pass
-
-class TrezorChooser(object):
-	"""Class for working with Trezor device via HID"""
+		self.requestSave()
 	
-	def __init__(self):
-		pass
+	def requestSave(self, then=None):
+		"""
+		Request save of main database file. Snapshot of password map is
+		written in background thread after SAVE_DELAY, requests coming
+		until then or while it is written are coalesced into one write.
+		Outer key wrapped on load is reused, so Trezor is not asked.
+		
+		@param then: function to call after the changes are saved
+		"""
+		if then is not None:
+			self.afterSave.append(then)
+		self.saveRequested = True
+		if self.saveTask is None and not self.saveTimer.isActive():
+			self.saveTimer.start()
 	
-	def getDevice(self):
+	def startSave(self):
 		"""
-		Get one from available devices. Widget will be shown if more
-		devices are available.
+		Start writing snapshot of password map if save was requested
+		and no write is running.
 		"""
-		devices = self.enumerateHIDDevices()
-
-		if not devices:
-			return None
+		if self.saveTask is not None or not self.saveRequested:
+			return
+		if self.pwMap.wrappedOuterKey is None:
+			#new database, outer key is wrapped by Trezor once
+			self.device.submit("wrap database key", self.pwMap.wrapOuterKey, (),
+				lambda wrappedKey: self.startSave())
+			return
 		
-		transport = self.chooseDevice(devices)
-		client = QtTrezorClient(transport)
-
-		return client
-
-	def enumerateHIDDevices(self):
-		"""Returns Trezor HID devices"""
-		devices = HidTransport.enumerate()
-
-		return devices
-
-	def chooseDevice(self, devices):
-		"""
-		Choose device from enumerated list. If there's only one Trezor,
-		that will be chosen.
+		self.saveRequested = False
+		self.autosaveTimer.stop()
+		snapshot = self.pwMap.snapshot()
+		callbacks, self.afterSave = self.afterSave, []
+		fname = self.dbFilename
 		
-		If there are multiple Trezors, diplays a widget with list
-		of Trezor devices to choose from.
+		def write(progress):
+			snapshot.save(fname)
 		
-		@returns HidTransport object of selected device
+		self.saveTask = QtBackgroundTask(write, parent=self)
+		self.saveTask.taskDone.connect(lambda value, error:
+			self.saveDone(snapshot, callbacks, error))
+		self.saveTask.start()
+		self.statusBar.showMessage("Saving password database")
+	
+	def saveDone(self, snapshot, callbacks, error):
 		"""
-		if not len(devices):
-			raise RuntimeError("No Trezor connected!")
-
-		if len(devices) == 1:
+		Take over file written from snapshot, start next write if more
+		saves were requested meanwhile.
+		"""
+		self.saveTask = None
+		self.statusBar.clearMessage()
+		if error is None:
 			try:
-				return HidTransport(devices[0])
-			except IOError:
-				raise RuntimeError("Trezor is currently in use")
-		
+				self.pwMap.finishSave(snapshot)
+			except IOError, e:
+				error = e
+		else:
+			self.pwMap.abortSave(snapshot)
 		
-		#maps deviceId string to device label
-		deviceMap = {}
-		for device in devices:
-			try:
-				transport = HidTransport(device)
-				client = QtTrezorClient(transport)
-				label = client.features.label and client.features.label or "<no label>"
-				client.close()
-				
-				deviceMap[device[0]] = label
-			except IOError:
-				#device in use, do not offer as choice
-				continue
-				
-		if not deviceMap:
-			raise RuntimeError("All connected Trezors are in use!")
-		
-		dialog = TrezorChooserDialog(deviceMap)
-		if not dialog.exec_():
-			sys.exit(9)
+		if error is not None:
+			self.saveRequested = False
+			self.afterSave = []
+			msgBox = QtGui.QMessageBox(text=s2q("Saving password database failed: " + str(error)))
+			msgBox.exec_()
+			return
 		
-		deviceStr = dialog.chosenDeviceStr()
-		return HidTransport([deviceStr, None])
+		#changes made during the write are not saved yet
+		if not self.pwMap.pendingOps:
+			self.setModified(False)
+		if self.saveRequested:
+			self.saveTimer.start()
+		for then in callbacks:
+			then()
+	
+	def closeEvent(self, event):
+		if self.saveTask is not None:
+			#close again once the running write is finished
+			self.saveTask.taskDone.connect(lambda value, error: self.close())
+			event.ignore()
+			return
 		
-
+		if self.modified:
+			msgBox = QtGui.QMessageBox(text="Password database is modified. Save on exit?")
+			msgBox.setStandardButtons(QtGui.QMessageBox.Yes |
+				QtGui.QMessageBox.No | QtGui.QMessageBox.Cancel )
+			reply = msgBox.exec_()
+			
+			if not reply or reply == QtGui.QMessageBox.Cancel:
+				event.ignore()
+				return
+			elif reply == QtGui.QMessageBox.Yes:
+				#close again once saved, modified flag is cleared then
+				self.requestSave(then=self.close)
+				event.ignore()
+				return
+			
+		self.device.cancelPending()
+		event.accept()
+	
 class Settings(object):
 	"""
-	Settings for password database location
+	Settings for password database location, password cache and
+	labels of Trezor devices
 	"""
 	
 	def __init__(self):
@@ -581,86 +959,228 @@ class Settings(object):
 		fname = self.settings.value("database/filename")
 		if fname.isValid():
 			self.dbFilename = q2s(fname.toString())
+		
+		devices = self.settings.value("trezor/devices")
+		self.deviceCache = DeviceCache.fromJson(q2s(devices.toString()) if devices.isValid() else "")
+		
+		self.cacheTtl = self.intValue("cache/ttl", DEFAULT_TTL)
+		self.cacheMaxEntries = self.intValue("cache/maxEntries", DEFAULT_MAX_ENTRIES)
+		self.idleTimeout = self.intValue("cache/idleTimeout", DEFAULT_TTL)
+		self.autosave = self.intValue("storage/autosave", 0) #seconds, 0 disables
+		
+		#compression of saved database: None keeps compression of the
+		#file, "none", "zlib" or "lzma" sets it
+		compression = self.settings.value("storage/compression")
+		self.compression = q2s(compression.toString()) if compression.isValid() else None
+		self.compressionLevel = self.intValue("storage/compressionLevel", None)
+	
+	def intValue(self, key, default):
+		"""
+		Return integer setting or default if not set or invalid
+		"""
+		value, ok = self.settings.value(key, QtCore.QVariant(default)).toInt()
+		return value if ok else default
 	
 	def store(self):
 		self.settings.setValue("database/filename", s2q(self.dbFilename))
 	
-def initializeStorage(trezor, pwMap, settings):
-	"""
-	Initialize new encrypted password file, ask for master passphrase.
+	def applyCompression(self, pwMap):
+		"""
+		Set compression of password map saves from settings. Unknown or
+		unavailable compression is ignored.
+		"""
+		import password_map
+		if self.compression == "none":
+			pwMap.compression = None
+		elif password_map.compressionAvailable(self.compression):
+			pwMap.compression = self.compression
+		if self.compressionLevel is not None:
+			pwMap.compressionLevel = max(0, min(9, self.compressionLevel))
 	
-	Initialize RSA keypair for backup, encrypt private RSA key using
-	backup passphrase and Trezor's cipher-key-value system.
+	def storeDeviceCache(self):
+		self.settings.setValue("trezor/devices", s2q(self.deviceCache.toJson()))
 	
-	Makes sure a session is created on Trezor so that the passphrase
-	will be cached until disconnect.
+def askNewStorage(settings):
+	"""
+	Ask for master passphrase and location of new password database.
+	Runs in GUI thread.
 	
-	@param trezor: Trezor client
-	@param pwMap: PasswordMap where to put encrypted backupKeys
 	@param settings: Settings object to store password database location
+	@returns master passphrase
+	@throws SystemExit: if dialog was cancelled
 	"""
+	from dialogs import InitializeDialog
 	dialog = InitializeDialog()
 	if not dialog.exec_():
 		sys.exit(4)
 		
-	masterPassphrase = q2s(dialog.pw1())
+	settings.dbFilename = q2s(dialog.pwFile())
+	settings.store()
+	return q2s(dialog.pw1())
+	
+def initializeStorage(pwMap, masterPassphrase, progress=None):
+	"""
+	Initialize new encrypted password file.
 	
-	trezor.prefillPassphrase(masterPassphrase)
-	backup = Backup(trezor)
+	Initialize RSA keypair for backup, encrypt private RSA key using
+	backup passphrase and Trezor's cipher-key-value system. Generate
+	outer key of the new password database. Runs in background thread,
+	RSA key generation would block GUI for seconds.
+	
+	Makes sure a session is created on Trezor so that the passphrase
+	will be cached until disconnect.
+	
+	@param pwMap: PasswordMap where to put encrypted backupKeys
+	@param masterPassphrase: passphrase from askNewStorage
+	@returns pwMap
+	"""
+	from Crypto import Random
+	import password_map
+	from backup import Backup
+	
+	pwMap.trezor.prefillPassphrase(masterPassphrase)
+	backup = Backup(pwMap.trezor)
 	backup.generate()
 	pwMap.backupKey = backup
-	settings.dbFilename = q2s(dialog.pwFile())
-	settings.store()
+	pwMap.outerKey = Random.new().read(password_map.KEYSIZE)
+	return pwMap
+
+def profileArgs(argv):
+	"""
+	Parse --profile, --profile-output=FILE and --profile-memory options.
 	
+	@returns tuple (profiling enabled, report file name or None for
+		stderr, trace memory)
+	"""
+	output = None
+	for arg in argv:
+		if arg.startswith("--profile-output="):
+			output = arg[len("--profile-output="):]
+	return "--profile" in argv, output, "--profile-memory" in argv
 
-app = QtGui.QApplication(sys.argv)
+def enableProfiling(output, traceMemory):
+	"""
+	Time Trezor calls, PasswordMap and backup key operations and
+	filling of group tree and password table. Imports modules that
+	are otherwise loaded after the main window is shown.
+	"""
+	from qt_trezor import QtTrezorClient
+	profiler.enable(output, traceMemory)
+	profiler.enableCore(QtTrezorClient)
+	for cls, methodName in [(MainWindow, "showEntries"), (MainWindow, "searchEntries"),
+		(PasswordTableModel, "setGroup"), (PasswordTableModel, "sort"),
+		(GroupTreeModel, "__init__"), (GroupTreeModel, "fetchMore")]:
+		profiler.profiler.wrap(cls, methodName)
 
-try:
-	trezorChooser = TrezorChooser()
+def openDatabase(settings, autoSelect, timer, progress=None):
+	"""
+	Connect to Trezor and load password database, unwrapping its outer
+	key. Runs in background thread while locked main window is shown,
+	PIN, passphrase and device dialogs are shown in GUI thread.
+	
+	@param autoSelect: use last chosen Trezor without asking
+	@param timer: profiler.StartupTimer recording stages
+	@returns PasswordMap, loaded if database file exists, or None if no
+		Trezor is connected
+	"""
+	import password_map
+	from qt_trezor import QtTrezorChooser
+	timer.stage("trezorlib and storage imported")
+	
+	trezorChooser = QtTrezorChooser(cache=settings.deviceCache, autoSelect=autoSelect)
 	trezor = trezorChooser.getDevice()
-except (ConnectionError, RuntimeError), e:
-	msgBox = QtGui.QMessageBox(text="Connection to Trezor failed: " + e.message)
-	msgBox.exec_()
-	sys.exit(1)
+	if trezor is None:
+		return None
+	trezor.clear_session()
+	timer.stage("Trezor connected")
 	
+	pwMap = password_map.PasswordMap(trezor)
+	if settings.dbFilename and os.path.isfile(settings.dbFilename):
+		pwMap.load(settings.dbFilename)
+		timer.stage("database unlocked")
+	return pwMap
 
-if trezor is None:
-	msgBox = QtGui.QMessageBox(text="No available Trezor found, quitting.")
-	msgBox.exec_()
-	sys.exit(1)
+def databaseOpened(mainWindow, settings, timer, pwMap, error):
+	"""
+	Unlock main window with password map opened by openDatabase, or
+	report error and quit. Runs in GUI thread.
+	"""
+	from trezorlib.client import CallException, PinException
+	from trezorlib.transport import ConnectionError
+	app = QtGui.QApplication.instance()
+	settings.storeDeviceCache()
 	
-trezor.clear_session()
-#print "label:", trezor.features.label
-
-pwMap = password_map.PasswordMap(trezor)
-settings = Settings()
-
-if settings.dbFilename and os.path.isfile(settings.dbFilename):
-	try:
-		pwMap.load(settings.dbFilename)
-	except PinException:
-		msgBox = QtGui.QMessageBox(text="Invalid PIN")
-		msgBox.exec_()
-		sys.exit(8)
-	except CallException:
+	if isinstance(error, SystemExit):
+		#PIN, passphrase or device dialog cancelled
+		app.exit(error.code)
+		return
+	if isinstance(error, PinException):
+		QtGui.QMessageBox(text="Invalid PIN").exec_()
+		app.exit(8)
+		return
+	if isinstance(error, CallException):
 		#button cancel on Trezor, so exit
-		sys.exit(6)
-	except Exception, e:
-		msgBox = QtGui.QMessageBox(text="Could not decrypt passwords: " + e.message)
-		msgBox.exec_()
-		sys.exit(5)
-		
-else:
-	initializeStorage(trezor, pwMap, settings)
+		app.exit(6)
+		return
+	if isinstance(error, (ConnectionError, RuntimeError)):
+		QtGui.QMessageBox(text="Connection to Trezor failed: " + error.message).exec_()
+		app.exit(1)
+		return
+	if error is not None:
+		QtGui.QMessageBox(text="Could not decrypt passwords: " + error.message).exec_()
+		app.exit(5)
+		return
+	if pwMap is None:
+		QtGui.QMessageBox(text="No available Trezor found, quitting.").exec_()
+		app.exit(1)
+		return
 	
-rng = Random.new()
-pwMap.outerIv = rng.read(password_map.BLOCKSIZE)
-pwMap.outerKey = rng.read(password_map.KEYSIZE)
-pwMap.encryptedBackupKey = ""
-
-mainWindow = MainWindow(pwMap, settings.dbFilename)
-mainWindow.show()
-retCode = app.exec_()
+	if pwMap.outerKey is None:
+		try:
+			masterPassphrase = askNewStorage(settings)
+		except SystemExit, e:
+			app.exit(e.code)
+			return
+		#errors of initialization are reported like those of opening
+		initTask = QtBackgroundTask(initializeStorage, (pwMap, masterPassphrase),
+			parent=mainWindow)
+		initTask.taskDone.connect(lambda pwMap, error:
+			databaseOpened(mainWindow, settings, timer, pwMap, error))
+		initTask.start()
+		return
+	settings.applyCompression(pwMap)
+	mainWindow.setPasswordMap(pwMap)
+	timer.stage("main window unlocked")
+	if "--startup-timing" in sys.argv:
+		timer.report(sys.stderr)
 
+def main():
+	timer = profiler.StartupTimer(STARTED)
+	timer.stage("imports")
+	profiling, profileOutput, traceMemory = profileArgs(sys.argv)
+	if profiling:
+		enableProfiling(profileOutput, traceMemory)
+	
+	app = QtGui.QApplication(sys.argv)
+	settings = Settings()
+	timer.stage("application and settings")
+	
+	mainWindow = MainWindow(settings)
+	mainWindow.show()
+	app.processEvents() #first paint of locked window
+	timer.stage("main window shown")
+	
+	#last chosen Trezor is used without asking unless --choose-trezor
+	#is given
+	openTask = QtBackgroundTask(openDatabase, (settings,
+		"--choose-trezor" not in sys.argv, timer), parent=mainWindow)
+	openTask.taskDone.connect(lambda pwMap, error:
+		databaseOpened(mainWindow, settings, timer, pwMap, error))
+	openTask.start()
+	
+	retCode = app.exec_()
+	
+	return retCode
 
-sys.exit(retCode)
+if __name__ == "__main__":
+	sys.exit(main())
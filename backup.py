@@ -1,20 +1,46 @@
+import struct
+import hmac
+import hashlib
 import cPickle
 
-from Crypto.PublicKey import RSA
-from Crypto.Cipher import PKCS1_OAEP
 from Crypto.Cipher import AES
 from Crypto import Random
 
-from encoding import Magic, Padding
+from encoding import Magic, Padding, macEquals
+from serialization import Encoder, Decoder
+
+## Backup encrypted password, hybrid scheme
+#  1 byte	scheme, HYBRID_SCHEME
+#  4 bytes	index of data key in Backup.wrappedDataKeys, network order uint32_t
+# 16 bytes	IV
+#  N bytes	AES-CBC encrypted password with PKCS#7 padding
+# 16 bytes	HMAC-SHA256 over all preceding bytes, truncated
+#
+# Data key is 32 bytes AES key followed by 32 bytes HMAC key, it is
+# stored only encrypted by RSA-OAEP to backup public key. Older
+# passwords are RSA-OAEP encrypted directly, those have exactly
+# RSA_KEYSIZE/8 bytes, which a hybrid one never has.
+#
+# RSA modules are imported on first use, loading a database only keeps
+# the public key in DER form, so startup does not pay for them.
 
 class Backup(object):
 	"""
 	Performs backup and restore for password storage
+	
+	Passwords are encrypted with data key of current session, which is
+	created and wrapped by RSA public key on first use, so private key
+	is needed only once per data key to decrypt them.
 	"""
 	
 	RSA_KEYSIZE = 2048
 	SYMMETRIC_KEYSIZE = 32
 	BLOCKSIZE = 16
+	SERIALIZATION_VERSION = 1 #first byte of binary serialized form
+	SERIALIZATION_VERSION_DATA_KEYS = 2 #same, followed by wrapped data keys
+	HYBRID_SCHEME = 1 #first byte of hybrid encrypted password
+	HYBRID_MACSIZE = 16
+	HYBRID_OVERHEAD = 1 + 4 + BLOCKSIZE + HYBRID_MACSIZE #not counting padded password
 
 	
 	def __init__(self, trezor):
@@ -27,16 +53,31 @@ class Backup(object):
 		self.encryptedPrivate = None #encrypted private key
 		self.encryptedEphemeral = None #ephemeral key used to encrypt private RSA key
 		self.ephemeralIv = None #IV used to encrypt private key with ephemeral key
-		self.publicKey = None
+		self.publicDer = None #public key in DER encoding
+		self._publicKey = None #RSA key imported from publicDer on first use
 		self.trezor = trezor
+		self.wrappedDataKeys = [] #RSA-OAEP encrypted data keys of hybrid scheme
+		self.sessionKey = None #(index, data key) used for encrypting
+	
+	@property
+	def publicKey(self):
+		"""
+		Public RSA key
+		"""
+		if self._publicKey is None and self.publicDer is not None:
+			from Crypto.PublicKey import RSA
+			self._publicKey = RSA.importKey(self.publicDer)
+		return self._publicKey
 	
 	def generate(self):
 		"""
 		Generate key and encrypt private key
 		"""
+		from Crypto.PublicKey import RSA
 		key = RSA.generate(self.RSA_KEYSIZE)
 		privateDer = key.exportKey(format="DER")
-		self.publicKey = key.publickey()
+		self._publicKey = key.publickey()
+		self.publicDer = self._publicKey.exportKey(format="DER")
 		self.wrapPrivateKey(privateDer)
 		
 	def wrapPrivateKey(self, privateKey):
@@ -74,44 +115,160 @@ class Backup(object):
 		padded = cipher.decrypt(self.encryptedPrivate)
 		privateDer = Padding(self.BLOCKSIZE).unpad(padded)
 		
+		from Crypto.PublicKey import RSA
 		privateKey = RSA.importKey(privateDer)
 		return privateKey
 	
-	def serialize(self):
+	def serialize(self, pickled=False):
 		"""
 		Return object data as serialized string.
+		
+		@param pickled: use pickle instead of binary encoding, for
+			storage versions older than 3
 		"""
-		publicDer = self.publicKey.exportKey(format="DER")
 		picklable = (self.ephemeralIv, self.encryptedEphemeral,
-		     self.encryptedPrivate, publicDer)
-		return cPickle.dumps(picklable, cPickle.HIGHEST_PROTOCOL)
+		     self.encryptedPrivate, self.publicDer)
+		if pickled:
+			#data keys follow explicit field version, 4-tuple is the
+			#form without them that version 1 readers know
+			if self.wrappedDataKeys:
+				picklable += (self.SERIALIZATION_VERSION_DATA_KEYS, self.wrappedDataKeys)
+			return cPickle.dumps(picklable, cPickle.HIGHEST_PROTOCOL)
+		
+		encoder = Encoder()
+		if self.wrappedDataKeys:
+			encoder.uint8(self.SERIALIZATION_VERSION_DATA_KEYS)
+		else:
+			encoder.uint8(self.SERIALIZATION_VERSION)
+		for field in picklable:
+			encoder.string(field)
+		if self.wrappedDataKeys:
+			encoder.uint32(len(self.wrappedDataKeys))
+			for wrappedDataKey in self.wrappedDataKeys:
+				encoder.string(wrappedDataKey)
+		return encoder.getvalue()
 
-	def deserialize(self, serialized):
+	def deserialize(self, serialized, pickled=False):
 		"""
 		Set object data from serialized string
+		
+		@param pickled: serialized is pickle, from storage versions
+			older than 3
+		@throws IOError: if binary encoding is corrupted or unknown
 		"""
-		unpickled = cPickle.loads(serialized)
+		self.wrappedDataKeys = []
+		self.sessionKey = None
+		if pickled:
+			unpickled = cPickle.loads(serialized)
+			if len(unpickled) == 6 and unpickled[4] == self.SERIALIZATION_VERSION_DATA_KEYS:
+				self.wrappedDataKeys = list(unpickled[5])
+			elif len(unpickled) != 4:
+				raise IOError("Unknown encoding version of backup key")
+		else:
+			decoder = Decoder(serialized)
+			encodingVersion = decoder.uint8()
+			if encodingVersion not in (self.SERIALIZATION_VERSION,
+				self.SERIALIZATION_VERSION_DATA_KEYS):
+				raise IOError("Unknown encoding version of backup key")
+			unpickled = [decoder.string() for _ in range(4)]
+			if encodingVersion == self.SERIALIZATION_VERSION_DATA_KEYS:
+				self.wrappedDataKeys = [decoder.string() for _ in xrange(decoder.uint32())]
+			decoder.expectEnd()
+		
 		(self.ephemeralIv, self.encryptedEphemeral,
-		     self.encryptedPrivate, publicDer) = unpickled
-		self.publicKey = RSA.importKey(publicDer)
+		     self.encryptedPrivate, self.publicDer) = unpickled[:4]
+		self._publicKey = None
 	
-	def encryptPassword(self, password):
+	def addDataKey(self):
 		"""
-		Encrypt password with RSA under OAEP padding and return it.
-		Password must be shorter than modulus length minus padding
-		length.
+		Create new data key, store it wrapped by public key and use it
+		for encrypting passwords in this session.
 		"""
+		from Crypto.Cipher import PKCS1_OAEP
+		dataKey = Random.new().read(2 * self.SYMMETRIC_KEYSIZE)
 		cipher = PKCS1_OAEP.new(self.publicKey)
-		encrypted = cipher.encrypt(password)
+		self.wrappedDataKeys.append(cipher.encrypt(dataKey))
+		self.sessionKey = (len(self.wrappedDataKeys) - 1, dataKey)
+	
+	def forgetSessionKey(self):
+		"""
+		Forget data key, so that passwords encrypted in this session
+		can be decrypted only with private key. Next password will be
+		encrypted with a new data key.
+		"""
+		self.sessionKey = None
+	
+	def encryptPassword(self, password):
+		"""
+		Encrypt password with data key of this session, see hybrid
+		scheme above.
+		"""
+		if self.sessionKey is None:
+			self.addDataKey()
+		index, dataKey = self.sessionKey
 		
-		return encrypted
+		iv = Random.new().read(self.BLOCKSIZE)
+		cipher = AES.new(dataKey[:self.SYMMETRIC_KEYSIZE], AES.MODE_CBC, iv)
+		padded = Padding(self.BLOCKSIZE).pad(password)
+		data = chr(self.HYBRID_SCHEME) + struct.pack("!I", index) + iv + cipher.encrypt(padded)
+		mac = hmac.new(dataKey[self.SYMMETRIC_KEYSIZE:], data, hashlib.sha256).digest()
+		
+		return data + mac[:self.HYBRID_MACSIZE]
 	
 	def decryptPassword(self, encryptedPassword, privateKey):
 		"""
-		Decrypt RSA-OAEP encrypted password.
+		Decrypt password encrypted by hybrid scheme or RSA-OAEP.
+		For many passwords, use decryptor() that unwraps each data key
+		only once.
 		"""
-		cipher = PKCS1_OAEP.new(privateKey)
-		password = cipher.decrypt(encryptedPassword)
-		
-		return password
+		return self.decryptor(privateKey).decrypt(encryptedPassword)
+	
+	def decryptor(self, privateKey):
+		"""
+		@param privateKey: private key from unwrapPrivateKey
+		@returns BackupDecryptor for passwords of this backup key
+		"""
+		return BackupDecryptor(privateKey, self.wrappedDataKeys)
+
+class BackupDecryptor(object):
+	"""
+	Decrypts backup encrypted passwords of both schemes, data keys are
+	unwrapped by private key on first use.
+	"""
 	
+	def __init__(self, privateKey, wrappedDataKeys):
+		from Crypto.Cipher import PKCS1_OAEP
+		self.rsaCipher = PKCS1_OAEP.new(privateKey)
+		self.wrappedDataKeys = wrappedDataKeys
+		self.dataKeys = {} #unwrapped data keys by index
+	
+	def dataKey(self, index):
+		if index not in self.dataKeys:
+			if index >= len(self.wrappedDataKeys):
+				raise ValueError("Unknown backup data key")
+			self.dataKeys[index] = self.rsaCipher.decrypt(self.wrappedDataKeys[index])
+		return self.dataKeys[index]
+	
+	def decrypt(self, encryptedPassword):
+		"""
+		Decrypt password encrypted by Backup.encryptPassword.
+		
+		@throws ValueError: if password is corrupted
+		"""
+		if len(encryptedPassword) == Backup.RSA_KEYSIZE / 8:
+			return self.rsaCipher.decrypt(encryptedPassword)
+		
+		if len(encryptedPassword) < Backup.HYBRID_OVERHEAD + Backup.BLOCKSIZE or \
+			ord(encryptedPassword[0]) != Backup.HYBRID_SCHEME:
+			raise ValueError("Unknown backup encryption scheme")
+		
+		data, mac = encryptedPassword[:-Backup.HYBRID_MACSIZE], encryptedPassword[-Backup.HYBRID_MACSIZE:]
+		index = struct.unpack("!I", data[1:5])[0]
+		dataKey = self.dataKey(index)
+		expectedMac = hmac.new(dataKey[Backup.SYMMETRIC_KEYSIZE:], data, hashlib.sha256).digest()
+		if not macEquals(mac, expectedMac[:Backup.HYBRID_MACSIZE]):
+			raise ValueError("Backup password HMAC does not match")
+		
+		iv = data[5:5 + Backup.BLOCKSIZE]
+		cipher = AES.new(dataKey[:Backup.SYMMETRIC_KEYSIZE], AES.MODE_CBC, iv)
+		return Padding(Backup.BLOCKSIZE).unpad(cipher.decrypt(data[5 + Backup.BLOCKSIZE:]))
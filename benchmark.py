@@ -0,0 +1,446 @@
+#!/usr/bin/env python
+"""
+Benchmark of PasswordMap load and save on synthetic databases.
+
+Generates databases for every combination of group count, entries per
+group and key length, saves and loads them with emulated Trezor and
+reports time and peak memory of each phase, plus file size and memory
+taken by loaded entries.
+
+Results can be written as JSON and compared with results of another
+version to spot regressions:
+
+	python benchmark.py --output before.json
+	python benchmark.py --output after.json --compare before.json
+
+Size and time of compressed storage, on keys looking like logins:
+
+	python benchmark.py --keys logins --compression none,zlib,lzma
+"""
+import sys
+import os
+import time
+import json
+import random
+import argparse
+import platform
+import resource
+import tempfile
+import traceback
+
+from Crypto import Random
+
+import password_map
+from password_map import PasswordMap
+from backup import Backup
+from trezor_emulator import EmulatedTrezorClient
+
+RESULTS_FORMAT = 1 #version of JSON results layout
+
+def maxRssKiB():
+	"""Return peak resident set size of this process in KiB"""
+	maxrss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+	if sys.platform == "darwin": #reported in bytes there
+		maxrss /= 1024
+	return maxrss
+
+def measureInProcess(fn, *args):
+	"""
+	Run fn(*args), return dict with wall time and peak memory growth.
+	"""
+	before = maxRssKiB()
+	start = time.time()
+	fn(*args)
+	seconds = time.time() - start
+	return {"seconds": seconds, "peakKiB": max(0, maxRssKiB() - before)}
+
+def inChild(fn, *args):
+	"""
+	Run fn(*args) in forked child if possible and return its result,
+	which must be JSON serializable.
+	
+	Memory freed by the parent stays mapped in it and is reused by
+	children, so a measured child would not grow over objects freed
+	before fork. Therefore groups of phases start from children of
+	the small main process rather than of the previous phase.
+	"""
+	if not hasattr(os, "fork"):
+		return fn(*args)
+	
+	r, w = os.pipe()
+	pid = os.fork()
+	if pid == 0:
+		os.close(r)
+		status = 1
+		try:
+			data = json.dumps(fn(*args))
+			while data:
+				data = data[os.write(w, data):]
+			status = 0
+		except BaseException:
+			traceback.print_exc()
+		finally:
+			sys.stderr.flush()
+			os._exit(status)
+	
+	os.close(w)
+	chunks = []
+	while True:
+		chunk = os.read(r, 4096)
+		if not chunk:
+			break
+		chunks.append(chunk)
+	os.close(r)
+	_, status = os.waitpid(pid, 0)
+	
+	if status != 0 or not chunks:
+		raise RuntimeError("Benchmarked phase failed in child process (status %d)" % status)
+	return json.loads("".join(chunks))
+
+def measure(fn, *args):
+	"""
+	Measure fn(*args) like measureInProcess, but in forked child if
+	possible. Linux resets peak RSS of forked child to its current RSS,
+	so high-water mark of earlier phases does not mask peak of this one.
+	"""
+	return inChild(measureInProcess, fn, *args)
+
+def runPhase(phases, name, fn, *args):
+	"""
+	Measure phase and store result under name, then run it again here
+	to get its return value for following phases.
+	"""
+	phases[name] = measure(fn, *args)
+	return fn(*args)
+
+class SyntheticData(object):
+	"""Deterministic pseudo-random keys and ciphertexts"""
+
+	def __init__(self, seed):
+		self.rng = random.Random(seed)
+
+	def hexString(self, length):
+		return "%0*x" % (length, self.rng.getrandbits(4 * length))
+
+	def bytes(self, length):
+		return self.hexString(2 * length).decode("hex")
+
+	def login(self, length):
+		"""
+		Key like user name or e-mail of a real database, padded or cut
+		to length
+		"""
+		user = self.rng.choice(LOGIN_USERS)
+		if self.rng.random() < 0.5:
+			user += "%d" % self.rng.randint(1, 999)
+		if self.rng.random() < 0.7:
+			user += "@" + self.rng.choice(LOGIN_DOMAINS)
+		return (user + "." * length)[:length]
+
+#parts of generated login keys
+LOGIN_USERS = ["admin", "john.smith", "jsmith", "root", "deploy", "jane.doe", "backup",
+	"support", "info", "test", "alice", "bob", "mail", "user", "developer", "ops"]
+LOGIN_DOMAINS = ["example.com", "example.org", "mail.example.net", "corp.example.com",
+	"gmail.com", "github.com", "aws.amazon.com", "bank.example.co.uk"]
+
+def syntheticDatabase(trezor, backupKey, groups, entriesPerGroup, keyLength,
+	passwordLength, seed, realCrypto, keys="hex"):
+	"""
+	Create PasswordMap filled with generated entries.
+
+	@param keys: "hex" for random hex keys, "logins" for keys looking
+		like user names and e-mails
+	@param realCrypto: encrypt passwords with emulated Trezor and backup
+		RSA key; otherwise use random strings of the same lengths
+	"""
+	data = SyntheticData(seed)
+	pwMap = PasswordMap(trezor)
+	pwMap.outerKey = Random.new().read(password_map.KEYSIZE)
+	pwMap.backupKey = backupKey
+
+	paddedLength = (passwordLength / password_map.BLOCKSIZE + 1) * password_map.BLOCKSIZE
+	backupLength = Backup.HYBRID_OVERHEAD + paddedLength
+
+	for i in xrange(groups):
+		groupName = "group-%06d" % i
+		pwMap.addGroup(groupName)
+		group = pwMap.groups[groupName]
+		for j in xrange(entriesPerGroup):
+			key = data.login(keyLength) if keys == "logins" else data.hexString(keyLength)
+			if realCrypto:
+				password = data.hexString(passwordLength)
+				encPw = pwMap.encryptPassword(password, groupName)
+				bkupPw = backupKey.encryptPassword(password)
+			else:
+				encPw = data.bytes(password_map.BLOCKSIZE + paddedLength)
+				bkupPw = data.bytes(backupLength)
+			group.addEntry(key, encPw, bkupPw)
+
+	return pwMap
+
+def readFileV1(pwMap, fname):
+	with file(fname, "rb") as f:
+		pwMap.readHeader(f)
+		return pwMap.readStorageV1(f)
+
+def decryptFileV1(pwMap, fname, offset, size):
+	with file(fname, "rb") as f:
+		mapped = password_map.mapFile(f)
+	try:
+		return password_map.decryptMapped(mapped, offset, size,
+			pwMap.outerKey, pwMap.outerIv)[1]
+	finally:
+		mapped.close()
+
+def saveV1(pwMap, fname):
+	"""
+	Measure phases of saving version 1 storage file.
+	"""
+	phases = {}
+	wrappedKey = pwMap.wrapKey(pwMap.outerKey)
+	pwMap.outerIv = Random.new().read(password_map.BLOCKSIZE)
+	serialized = runPhase(phases, "save.serialize", pwMap.serialize)
+	encrypted = runPhase(phases, "save.encrypt", pwMap.encryptOuter, serialized, pwMap.outerIv)
+	hmacDigest = runPhase(phases, "save.mac", pwMap.outerMac, encrypted)
+	runPhase(phases, "save.write", pwMap.writeStorageV1, fname, wrappedKey, encrypted, hmacDigest)
+	del serialized, encrypted
+	phases["save.total"] = measure(pwMap.save, fname, 1)
+	return phases
+
+def loadV1(trezor, fname):
+	"""
+	Measure phases of loading version 1 storage file.
+	"""
+	phases = {}
+	loaded = PasswordMap(trezor)
+	offset, size, _ = runPhase(phases, "load.read", readFileV1, loaded, fname)
+	#HMAC is computed in the same pass over mapped file as decryption
+	serialized = runPhase(phases, "load.decrypt", decryptFileV1, loaded, fname, offset, size)
+	phases["load.deserialize"] = measure(loaded.deserialize, serialized)
+	del serialized
+	phases["load.total"] = measure(PasswordMap(trezor).load, fname)
+	return phases
+
+def loadAllGroups(pwMap):
+	for groupName in pwMap.groups.keys():
+		pwMap.groups[groupName]
+
+def loadFirstGroup(pwMap):
+	pwMap.groups[min(pwMap.groups.keys())]
+
+def openedMap(trezor, fname, journaled=True):
+	pwMap = PasswordMap(trezor)
+	pwMap.journaled = journaled
+	pwMap.load(fname)
+	return pwMap
+
+def saveOneEntry(pwMap, fname, version):
+	groupName = min(pwMap.groups.keys())
+	pwMap.addEntry(groupName, "benchmark", "x" * 48, "x" * (Backup.HYBRID_OVERHEAD + 32))
+	pwMap.save(fname, version)
+
+def saveV2(pwMap, fname, version):
+	"""
+	Measure saving version 2/3 storage file with all groups in memory,
+	and taking snapshot of it, which is all the GUI thread does when
+	saving in background.
+	"""
+	return {"save.total": measure(pwMap.save, fname, version),
+		"save.snapshot": measure(pwMap.snapshot)}
+
+def loadV2(trezor, fname, version):
+	"""
+	Measure loading version 2/3 storage file, split to opening the file
+	(index only) and decrypting groups, then rewrite of the file with
+	all groups decrypted.
+	"""
+	phases = {}
+	loaded = PasswordMap(trezor)
+	runPhase(phases, "load.open", loaded.load, fname)
+	phases["load.firstGroup"] = measure(loadFirstGroup, loaded)
+	runPhase(phases, "load.allGroups", loadAllGroups, loaded)
+	loaded.journaled = False
+	phases["save.afterLoad"] = measure(loaded.save, fname, version)
+	return phases
+
+def updateV2(trezor, fname, version):
+	"""
+	Measure rewrite of version 2/3 storage file with no group opened
+	and journal append.
+	"""
+	phases = {}
+	#each measured save runs in a child, so file is unchanged for next one
+	phases["save.unopened"] = measure(openedMap(trezor, fname, False).save, fname, version)
+	phases["save.journal"] = measure(saveOneEntry, openedMap(trezor, fname), fname, version)
+	return phases
+
+def saveCase(trezor, backupKey, fname, case, args):
+	"""
+	Generate database for case and measure its save phases.
+	"""
+	pwMap = syntheticDatabase(trezor, backupKey, case["groups"],
+		case["entriesPerGroup"], case["keyLength"], args.password_length,
+		args.seed, args.real_crypto, args.keys)
+	
+	if case["format"] == 1:
+		return saveV1(pwMap, fname)
+	else:
+		pwMap.chunked = case.get("chunked", False)
+		pwMap.compression = case.get("compression")
+		pwMap.compressionLevel = args.compression_level
+		return saveV2(pwMap, fname, case["format"])
+
+def benchmarkCase(trezor, backupKey, fname, case, args):
+	"""
+	Measure save and load phases for one database size and format.
+	
+	@returns dict with case parameters, file size, memory per 100k
+		entries and phase results
+	"""
+	phases = inChild(saveCase, trezor, backupKey, fname, case, args)
+	fileSize = os.path.getsize(fname)
+	
+	if case["format"] == 1:
+		phases.update(inChild(loadV1, trezor, fname))
+		loadedKiB = phases["load.deserialize"]["peakKiB"]
+	else:
+		phases.update(inChild(loadV2, trezor, fname, case["format"]))
+		phases.update(inChild(updateV2, trezor, fname, case["format"]))
+		loadedKiB = phases["load.allGroups"]["peakKiB"]
+	
+	result = dict(case)
+	result["entries"] = case["groups"] * case["entriesPerGroup"]
+	result["fileSize"] = fileSize
+	result["per100kKiB"] = loadedKiB * 100000.0 / max(1, result["entries"])
+	result["phases"] = phases
+	return result
+
+def caseId(case):
+	return (case.get("format", 1), case["groups"], case["entriesPerGroup"], case["keyLength"],
+		case.get("chunked", False), case.get("compression"))
+
+def printCase(result, previous=None):
+	"""
+	Print phase table of a case, with ratio to previous result if given.
+	"""
+	print "format %(format)d%(chunkedStr)s, %(entries)d entries (%(groups)d groups x %(entriesPerGroup)d), " \
+		"key length %(keyLength)d, file size %(fileSize)d bytes" % \
+		dict(result, chunkedStr=(" chunked" if result.get("chunked") else "") +
+			(" " + result["compression"] if result.get("compression") else ""))
+	print "  memory of loaded entries per 100k entries %.1f MiB" % (result["per100kKiB"] / 1024.0)
+	if previous is not None:
+		print "  previous file size %d bytes (%.2fx)" % (previous["fileSize"],
+			float(result["fileSize"]) / max(1, previous["fileSize"]))
+		if "per100kKiB" in previous:
+			print "  previous memory per 100k entries %.1f MiB" % (previous["per100kKiB"] / 1024.0)
+
+	for name in sorted(result["phases"]):
+		phase = result["phases"][name]
+		line = "  %-18s %10.4f s %10.1f MiB" % (name, phase["seconds"], phase["peakKiB"] / 1024.0)
+		if previous is not None and name in previous["phases"]:
+			old = previous["phases"][name]
+			line += "   was %10.4f s (%.2fx)" % (old["seconds"],
+				phase["seconds"] / max(old["seconds"], 1e-9))
+		print line
+
+def storageCases(args):
+	"""
+	@returns list of (storage version, compression) to benchmark,
+		version 1 is never compressed
+	"""
+	cases = []
+	for storageFormat in args.format:
+		for compression in args.compression:
+			if storageFormat == 1 and compression != "none":
+				continue
+			cases.append((storageFormat, compression))
+	return cases
+
+def intList(s):
+	return [int(x) for x in s.split(",")]
+
+def parseArgs(argv):
+	parser = argparse.ArgumentParser(description="Benchmark PasswordMap load and save")
+	parser.add_argument("--groups", type=intList, default=[100],
+		help="comma-separated group counts (default: 100)")
+	parser.add_argument("--entries", type=intList, default=[100, 1000, 10000],
+		help="comma-separated entry counts per group (default: 100,1000,10000)")
+	parser.add_argument("--key-length", type=intList, default=[24],
+		help="comma-separated key lengths (default: 24)")
+	parser.add_argument("--password-length", type=int, default=16)
+	parser.add_argument("--format", type=intList, default=[password_map.STORAGE_VERSION],
+		help="comma-separated storage versions to benchmark (default: %d)" % password_map.STORAGE_VERSION)
+	parser.add_argument("--chunked", action="store_true",
+		help="write version 2/3 group segments in chunks decrypted in parallel")
+	parser.add_argument("--compression", type=lambda s: s.split(","), default=["none"],
+		help="comma-separated compressions of version 2/3 files: none, zlib, lzma (default: none)")
+	parser.add_argument("--compression-level", type=int, default=password_map.DEFAULT_COMPRESSION_LEVEL,
+		help="zlib level or lzma preset (default: %(default)s)")
+	parser.add_argument("--keys", choices=["hex", "logins"], default="hex",
+		help="generated keys: random hex or looking like logins (default: hex)")
+	parser.add_argument("--real-crypto", action="store_true",
+		help="encrypt generated passwords instead of using random ciphertexts (slow)")
+	parser.add_argument("--latency", type=float, default=0.0,
+		help="emulated Trezor latency per call in seconds")
+	parser.add_argument("--seed", default="benchmark")
+	parser.add_argument("--label", help="label stored with results, e.g. version")
+	parser.add_argument("--output", help="write results as JSON to this file")
+	parser.add_argument("--compare", help="JSON results of previous run to compare with")
+	args = parser.parse_args(argv)
+	for compression in args.compression:
+		if compression != "none" and not password_map.compressionAvailable(compression):
+			parser.error("compression is not available: " + compression)
+	return args
+
+def main(argv):
+	args = parseArgs(argv)
+
+	previous = {}
+	if args.compare:
+		with file(args.compare) as f:
+			for result in json.load(f)["cases"]:
+				previous[caseId(result)] = result
+
+	trezor = EmulatedTrezorClient(args.seed, latency=args.latency)
+	backupKey = Backup(trezor)
+	backupKey.generate()
+
+	fd, fname = tempfile.mkstemp(suffix=".pwdb")
+	os.close(fd)
+	results = []
+	try:
+		for storageFormat, compression in storageCases(args):
+			for groups in args.groups:
+				for entriesPerGroup in args.entries:
+					for keyLength in args.key_length:
+						case = {"format": storageFormat, "groups": groups,
+							"entriesPerGroup": entriesPerGroup, "keyLength": keyLength}
+						if args.chunked and storageFormat != 1:
+							case["chunked"] = True
+						if compression != "none":
+							case["compression"] = compression
+						result = benchmarkCase(trezor, backupKey, fname, case, args)
+						printCase(result, previous.get(caseId(result)))
+						results.append(result)
+	finally:
+		os.unlink(fname)
+
+	if args.output:
+		report = {
+			"format": RESULTS_FORMAT,
+			"label": args.label,
+			"timestamp": time.time(),
+			"python": platform.python_version(),
+			"platform": platform.platform(),
+			"realCrypto": args.real_crypto,
+			"keys": args.keys,
+			"passwordLength": args.password_length,
+			"cases": results,
+		}
+		with file(args.output, "w") as f:
+			json.dump(report, f, indent=1, sort_keys=True)
+
+	return 0
+
+if __name__ == "__main__":
+	sys.exit(main(sys.argv[1:]))
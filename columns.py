@@ -0,0 +1,137 @@
+import operator
+from array import array
+from itertools import izip
+
+from serialization import UINT32
+
+class StringColumn(object):
+	"""
+	List of strings packed in one buffer, with start offsets and
+	lengths of strings kept in arrays. Costs 8 bytes per string on top
+	of string data, instead of a Python string object each.
+
+	Replaced and removed strings leave garbage in the buffer, which is
+	compacted once it outgrows half of the buffer. Buffer of a column
+	created from serialized data stays an immutable string or buffer
+	over decrypted data until the column is first changed.
+	"""
+
+	__slots__ = ("data", "starts", "lengths", "garbage", "ordered")
+
+	def __init__(self):
+		self.data = bytearray()
+		self.starts = array(UINT32)
+		self.lengths = array(UINT32)
+		self.garbage = 0 #bytes of buffer not belonging to any string
+		self.ordered = True #strings are stored in order without gaps
+
+	@classmethod
+	def fromEnds(cls, ends, data):
+		"""
+		Create column from serialized form - array of end offsets of
+		strings in concatenated data.
+		"""
+		column = cls()
+		if not len(ends):
+			return column
+		column.data = data
+		column.starts = array(UINT32, [0])
+		column.starts.extend(ends[:-1])
+		column.lengths = array(UINT32, map(operator.sub, ends, column.starts))
+		return column
+
+	@classmethod
+	def fromStrings(cls, strings):
+		"""
+		Create column holding given sequence of strings.
+		"""
+		ends = array(UINT32)
+		appendEnd = ends.append
+		end = 0
+		for length in map(len, strings):
+			end += length
+			appendEnd(end)
+		return cls.fromEnds(ends, "".join(strings))
+
+	def ends(self):
+		"""
+		Return serialized form - tuple (array of end offsets, data as
+		string). Compacts buffer if needed.
+		"""
+		if not self.ordered:
+			self.compact()
+		ends = array(UINT32, map(operator.add, self.starts, self.lengths))
+		return ends, str(self.data)
+
+	def copy(self):
+		"""
+		Return column with the same strings that is not affected by
+		later changes of this one. Buffer that is not a bytearray yet
+		is shared, since it is never changed in place.
+		"""
+		column = StringColumn()
+		column.data = bytearray(self.data) if isinstance(self.data, bytearray) else self.data
+		column.starts = self.starts[:]
+		column.lengths = self.lengths[:]
+		column.garbage = self.garbage
+		column.ordered = self.ordered
+		return column
+
+	def __len__(self):
+		return len(self.starts)
+
+	def __getitem__(self, idx):
+		start = self.starts[idx]
+		return str(self.data[start:start + self.lengths[idx]])
+
+	def __iter__(self):
+		data = self.data
+		for start, length in izip(self.starts, self.lengths):
+			yield str(data[start:start + length])
+
+	def writable(self):
+		"""Return buffer as bytearray that can be appended to"""
+		if not isinstance(self.data, bytearray):
+			self.data = bytearray(self.data)
+		return self.data
+
+	def append(self, s):
+		data = self.writable()
+		self.starts.append(len(data))
+		self.lengths.append(len(s))
+		data.extend(s)
+
+	def __setitem__(self, idx, s):
+		data = self.writable()
+		self.garbage += self.lengths[idx]
+		self.starts[idx] = len(data)
+		self.lengths[idx] = len(s)
+		data.extend(s)
+		self.ordered = False
+		self.compactIfNeeded()
+
+	def __delitem__(self, idx):
+		self.garbage += self.lengths[idx]
+		del self.starts[idx]
+		del self.lengths[idx]
+		self.ordered = False
+		self.compactIfNeeded()
+
+	def compactIfNeeded(self):
+		if self.garbage > len(self.data) / 2:
+			self.compact()
+
+	def compact(self):
+		"""
+		Rewrite buffer with strings in order and no garbage.
+		"""
+		data = bytearray()
+		starts = array(UINT32)
+		for s in self:
+			starts.append(len(data))
+			data.extend(s)
+
+		self.data = data
+		self.starts = starts
+		self.garbage = 0
+		self.ordered = True
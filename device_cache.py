@@ -0,0 +1,58 @@
+import json
+
+NO_LABEL = "<no label>"
+
+class DeviceCache(object):
+	"""
+	Labels and device ids of Trezors by HID path, kept between runs so
+	that devices need not be opened just to show their labels. Also
+	remembers device id of last chosen Trezor.
+
+	Cached label may be stale if another Trezor was plugged in at the
+	same path, TrezorChooser checks features of the chosen device once
+	it is opened.
+	"""
+
+	def __init__(self, devices=None, lastDeviceId=None):
+		"""
+		@param devices: dict HID path -> (label, device id)
+		"""
+		self.devices = dict(devices or {})
+		self.lastDeviceId = lastDeviceId
+
+	@classmethod
+	def fromJson(cls, serialized):
+		"""
+		Create cache from string written by toJson, empty cache if
+		string is not valid.
+		"""
+		try:
+			data = json.loads(serialized)
+			devices = dict((path.encode("utf-8"), (label, deviceId))
+				for path, (label, deviceId) in data["devices"].iteritems())
+			return cls(devices, data.get("lastDeviceId"))
+		except (ValueError, KeyError, TypeError, AttributeError):
+			return cls()
+
+	def toJson(self):
+		return json.dumps({"devices": self.devices, "lastDeviceId": self.lastDeviceId})
+
+	def forget(self, paths):
+		"""Remove cached labels of devices at paths"""
+		for path in paths:
+			self.devices.pop(path, None)
+
+	def keepOnly(self, paths):
+		"""Remove cached labels of devices not at paths"""
+		self.forget(set(self.devices) - set(paths))
+
+	def pathOfLast(self, paths):
+		"""
+		@returns path of last chosen device if it is among paths,
+			else None
+		"""
+		for path in paths:
+			cached = self.devices.get(path)
+			if cached is not None and cached[1] == self.lastDeviceId:
+				return path
+		return None
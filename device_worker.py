@@ -0,0 +1,182 @@
+import threading
+import Queue
+
+class RequestCancelled(Exception):
+	"""Request was cancelled before it was run"""
+	pass
+
+class DeviceRequest(object):
+	"""
+	Call of a function using Trezor, queued in DeviceWorker. Works as
+	a future - result() waits until the call is done.
+	"""
+
+	PENDING, RUNNING, DONE, CANCELLED = range(4)
+
+	def __init__(self, fn, args, description):
+		self.fn = fn
+		self.args = args
+		self.description = description #shown to user while waiting
+		self.state = self.PENDING
+		self.value = None
+		self.error = None #exception raised by fn
+		self.finished = threading.Event()
+		self.callbacks = []
+		self.lock = threading.Lock()
+
+	def cancel(self):
+		"""
+		Cancel request if it is not running yet.
+
+		@returns True if request was cancelled
+		"""
+		with self.lock:
+			if self.state != self.PENDING:
+				return False
+			self.state = self.CANCELLED
+		self.finish(self.CANCELLED)
+		return True
+
+	def cancelled(self):
+		return self.state == self.CANCELLED
+
+	def done(self):
+		return self.finished.is_set()
+
+	def start(self):
+		"""
+		Mark request running unless it was cancelled.
+
+		@returns False if request was cancelled
+		"""
+		with self.lock:
+			if self.state != self.PENDING:
+				return False
+			self.state = self.RUNNING
+			return True
+
+	def run(self):
+		try:
+			self.value = self.fn(*self.args)
+		except BaseException, e:
+			self.error = e
+		self.finish(self.DONE)
+
+	def finish(self, state):
+		"""
+		Set final state and call done callbacks. Callbacks are taken
+		under lock, so addDoneCallback either adds its callback before
+		or calls it itself.
+		"""
+		with self.lock:
+			self.state = state
+			self.finished.set()
+			callbacks, self.callbacks = self.callbacks, []
+		for callback in callbacks:
+			callback(self)
+
+	def addDoneCallback(self, callback):
+		"""
+		Call callback(request) when request is done or cancelled. It is
+		called in worker thread, or right away if request is done.
+		"""
+		with self.lock:
+			if not self.done():
+				self.callbacks.append(callback)
+				return
+		callback(self)
+
+	def result(self, timeout=None):
+		"""
+		Wait for request to finish and return value of the call.
+
+		@throws RequestCancelled: if request was cancelled
+		@throws exception raised by the call
+		"""
+		if not self.finished.wait(timeout):
+			raise RuntimeError("Trezor request timed out")
+		if self.cancelled():
+			raise RequestCancelled(self.description)
+		if self.error is not None:
+			raise self.error
+		return self.value
+
+class DeviceWorker(threading.Thread):
+	"""
+	Thread owning Trezor client. All calls that talk to Trezor are
+	queued here and run one after another, so callers never block on
+	device I/O or button presses.
+	"""
+
+	def __init__(self):
+		threading.Thread.__init__(self, name="TrezorWorker")
+		self.daemon = True
+		self.queue = Queue.Queue()
+		self.lock = threading.Lock()
+		self.requests = [] #pending and running requests in order
+		self.current = None #request being run
+
+	def submit(self, description, fn, *args):
+		"""
+		Queue call fn(*args).
+
+		@param description: text describing request for user
+		@returns DeviceRequest
+		"""
+		return self.submitRequest(DeviceRequest(fn, args, description))
+
+	def submitRequest(self, request, onDone=None):
+		"""
+		Queue request.
+
+		@param onDone: called with request when it is done or cancelled,
+			registered before the request can run, so even a fast
+			request does not finish before it
+		@returns request
+		"""
+		with self.lock:
+			self.requests.append(request)
+		request.addDoneCallback(self.forget)
+		if onDone is not None:
+			request.addDoneCallback(onDone)
+		self.queue.put(request)
+		return request
+
+	def forget(self, request):
+		with self.lock:
+			if request in self.requests:
+				self.requests.remove(request)
+
+	def pending(self):
+		"""
+		@returns list of requests that are queued or running
+		"""
+		with self.lock:
+			return list(self.requests)
+
+	def cancelPending(self):
+		"""
+		Cancel all requests that are not running yet. Running request
+		can be cancelled only on Trezor.
+		"""
+		for request in self.pending():
+			request.cancel()
+
+	def run(self):
+		while True:
+			request = self.queue.get()
+			if request is None:
+				break
+			if not request.start():
+				continue
+			self.current = request
+			request.run()
+			self.current = None
+
+	def stop(self, timeout=None):
+		"""
+		Cancel pending requests and end thread after the running one.
+		"""
+		self.cancelPending()
+		self.queue.put(None)
+		self.join(timeout)
@@ -7,8 +7,13 @@ from ui_initialize_dialog import Ui_InitializeDialog
 from ui_enter_pin_dialog import Ui_EnterPinDialog
 from ui_trezor_chooser_dialog import Ui_TrezorChooserDialog
 
+from group_tree_model import GROUP_SEPARATOR
+from qt_encoding import s2q
+
 class AddGroupDialog(QtGui.QDialog, Ui_AddGroupDialog):
 	
+	allowExisting = False #name of existing group is valid
+	
 	def __init__(self, groups):
 		QtGui.QDialog.__init__(self)
 		self.setupUi(self)
@@ -21,24 +26,48 @@ class AddGroupDialog(QtGui.QDialog, Ui_AddGroupDialog):
 	
 	def newGroupName(self):
 		return self.newGroupEdit.text()
+	
+	def groupKey(self):
+		"""Return True if group should be encrypted with group key"""
+		return self.groupKeyCheckBox.isChecked()
 		
 	
 	def validate(self):
 		"""
-		Validates input if name is not empty and is different from
-		existing group names.
+		Validates input if name is not empty, is different from
+		existing group names and has no empty level.
 		"""
 		valid = True
 		text = self.newGroupEdit.text()
 		if text.isEmpty():
 			valid = False
 		
-		if unicode(text).encode("utf-8") in self.groups:
+		name = unicode(text).encode("utf-8")
+		if name in self.groups and not self.allowExisting:
+			valid = False
+		
+		#every level of group tree needs a name
+		if "" in name.split(GROUP_SEPARATOR):
 			valid = False
 		
 		button = self.buttonBox.button(QtGui.QDialogButtonBox.Ok)
 		button.setEnabled(valid)
 	
+class RenameGroupDialog(AddGroupDialog):
+	"""
+	Asks for new name of group. Name of existing group merges the group
+	into it, its own name re-keys it.
+	"""
+	
+	allowExisting = True
+	
+	def __init__(self, groups, groupName):
+		AddGroupDialog.__init__(self, groups)
+		self.setWindowTitle("Rename, merge or re-key group")
+		self.label.setText("New name of group, entries are merged into existing group of that name")
+		self.groupKeyCheckBox.setChecked(True)
+		self.newGroupEdit.setText(s2q(groupName))
+	
 class TrezorPassphraseDialog(QtGui.QDialog, Ui_TrezorPassphraseDialog):
 	
 	def __init__(self):
@@ -157,20 +186,24 @@ class EnterPinDialog(QtGui.QDialog, Ui_EnterPinDialog):
 	
 class TrezorChooserDialog(QtGui.QDialog, Ui_TrezorChooserDialog):
 	
-	def __init__(self, deviceMap):
+	def __init__(self, deviceMap, selectedStr=None):
 		"""
 		Create dialog and fill it with labels from deviceMap
 		
 		@param deviceMap: dict device string -> device label
+		@param selectedStr: device string of initially selected Trezor
 		"""
 		QtGui.QDialog.__init__(self)
 		self.setupUi(self)
 		
+		selectedRow = 0
 		for deviceStr, label in deviceMap.items():
+			if deviceStr == selectedStr:
+				selectedRow = self.trezorList.count()
 			item = QtGui.QListWidgetItem(label)
 			item.setData(QtCore.Qt.UserRole, QtCore.QVariant(deviceStr))
 			self.trezorList.addItem(item)
-		self.trezorList.setCurrentRow(0)
+		self.trezorList.setCurrentRow(selectedRow)
 	
 	def chosenDeviceStr(self):
 		"""
@@ -1,15 +1,5 @@
 import struct
 
-from PyQt4 import QtCore
-
-def q2s(s):
-	"""Convert QString to UTF-8 string object"""
-	return str(s.toUtf8())
-
-def s2q(s):
-	"""Convert UTF-8 encoded string to QString"""
-	return QtCore.QString.fromUtf8(s)
-
 class Magic(object):
 	"""
 	Few magic constant definitions so that we know which nodes to search
@@ -41,4 +31,16 @@ class Padding(object):
 	
 	def unpad(self, s):
 		return s[0:-ord(s[-1])]
-	
\ No newline at end of file
+	
+
+def macEquals(digest1, digest2):
+	"""
+	Time-invariant comparison of HMAC digests that also works with
+	python 2.6
+	"""
+	if len(digest1) != len(digest2):
+		return False
+	hmacCompare = 0
+	for (ch1, ch2) in zip(digest1, digest2):
+		hmacCompare |= int(ch1 != ch2)
+	return hmacCompare == 0
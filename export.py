@@ -0,0 +1,142 @@
+import csv
+import json
+import multiprocessing
+from itertools import izip
+
+from backup import Backup, BackupDecryptor
+
+csv.register_dialect("escaped", doublequote=False, escapechar='\\')
+
+BATCH_SIZE = 256 #maximum entries decrypted in one task of process pool
+#exports with less RSA encrypted passwords are not worth a pool, passwords
+#of hybrid backup scheme are cheap to decrypt
+PARALLEL_MIN_ENTRIES = 2 * BATCH_SIZE
+
+class ExportCancelled(Exception):
+	"""Export was cancelled before all passwords were written"""
+	pass
+
+class CsvRowWriter(object):
+	"""Writes rows as CSV: group, key, password"""
+
+	def __init__(self, f):
+		self.writer = csv.writer(f, dialect="escaped")
+
+	def writeRow(self, groupName, key, password):
+		#csv module does not escape escapechar itself in quoted fields,
+		#without doubling backslashes they could not be read back;
+		#older backups without doubling are imported as "csv-legacy"
+		self.writer.writerow([s.replace("\\", "\\\\") for s in (groupName, key, password)])
+
+class JsonLinesRowWriter(object):
+	"""Writes rows as one JSON object per line with group, key and password"""
+
+	def __init__(self, f):
+		self.f = f
+
+	def writeRow(self, groupName, key, password):
+		row = {"group": groupName.decode("utf-8"), "key": key.decode("utf-8"),
+			"password": password.decode("utf-8")}
+		self.f.write(json.dumps(row, sort_keys=True))
+		self.f.write("\n")
+
+#row writers by export format name
+EXPORT_FORMATS = {
+	"csv": CsvRowWriter,
+	"jsonl": JsonLinesRowWriter,
+}
+
+def snapshotGroups(pwMap):
+	"""
+	Copy keys and backup encrypted passwords of all groups, so that
+	export can run in another thread while pwMap is changed.
+
+	@returns list of (group name, keys, backup passwords) sorted by group
+		name, keys and passwords are StringColumns
+	"""
+	snapshot = []
+	for groupName in sorted(pwMap.groups.keys()):
+		group = pwMap.groups[groupName]
+		snapshot.append((groupName, group.keys.copy(), group.backups.copy()))
+	return snapshot
+
+#BackupDecryptor of pool worker process, set by initDecryptor
+_workerDecryptor = None
+
+def initDecryptor(privateDer, wrappedDataKeys):
+	global _workerDecryptor
+	from Crypto.PublicKey import RSA
+	_workerDecryptor = BackupDecryptor(RSA.importKey(privateDer), wrappedDataKeys)
+
+def decryptBatch(encryptedPasswords):
+	"""
+	Decrypt list of backup encrypted passwords in pool worker process
+	"""
+	return [_workerDecryptor.decrypt(encrypted) for encrypted in encryptedPasswords]
+
+def exportGroups(snapshot, backupKey, privateKey, writer, processes=None, progress=None,
+	cancelEvent=None):
+	"""
+	Decrypt all passwords of snapshot with backup private key and
+	write them with writer. If there are many RSA encrypted passwords,
+	decryption runs in process pool in batches of at most BATCH_SIZE
+	entries of one group. Rows are written in order of snapshot as
+	batches finish.
+
+	@param snapshot: groups from snapshotGroups
+	@param backupKey: Backup with data keys of hybrid scheme
+	@param privateKey: unwrapped private RSA key of backup key
+	@param writer: row writer, e.g. CsvRowWriter
+	@param processes: size of process pool, defaults to CPU count,
+		1 decrypts in this process
+	@param progress: function called with (entries written, total entries)
+	@param cancelEvent: threading.Event, export stops when it is set
+	@throws ExportCancelled: if cancelEvent was set, part of rows may
+		have been written already
+	"""
+	batches = [] #(group name, keys, backups, start, end)
+	for groupName, keys, backups in snapshot:
+		for start in xrange(0, len(keys), BATCH_SIZE):
+			batches.append((groupName, keys, backups, start, min(len(keys), start + BATCH_SIZE)))
+	total = sum(len(keys) for _, keys, _ in snapshot)
+	rsaEntries = sum(backups.lengths.count(Backup.RSA_KEYSIZE / 8) for _, _, backups in snapshot)
+	wrappedDataKeys = list(backupKey.wrappedDataKeys)
+	tasks = (list(backups[i] for i in xrange(start, end))
+		for _, _, backups, start, end in batches)
+
+	if processes is None:
+		processes = multiprocessing.cpu_count()
+	pool = None
+	if processes > 1 and rsaEntries >= PARALLEL_MIN_ENTRIES:
+		privateDer = privateKey.exportKey(format="DER")
+		pool = multiprocessing.Pool(processes, initDecryptor, (privateDer, wrappedDataKeys))
+		results = pool.imap(decryptBatch, tasks)
+	else:
+		decryptor = BackupDecryptor(privateKey, wrappedDataKeys)
+		results = (map(decryptor.decrypt, task) for task in tasks)
+
+	try:
+		written = 0
+		for (groupName, keys, _, start, end), passwords in izip(batches, results):
+			if cancelEvent is not None and cancelEvent.is_set():
+				raise ExportCancelled()
+			for idx, password in izip(xrange(start, end), passwords):
+				writer.writeRow(groupName, keys[idx], password)
+			written += end - start
+			if progress is not None:
+				progress(written, total)
+	finally:
+		if pool is not None:
+			pool.terminate()
+			pool.join()
+
+def exportCsv(pwMap, privateKey, f):
+	"""
+	Decrypt all passwords with backup private key and write them
+	to file as CSV: group, key, password
+
+	@param pwMap: PasswordMap with backupKey set
+	@param privateKey: unwrapped private RSA key of pwMap.backupKey
+	@param f: file object opened for writing
+	"""
+	exportGroups(snapshotGroups(pwMap), pwMap.backupKey, privateKey, CsvRowWriter(f))
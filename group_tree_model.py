@@ -0,0 +1,268 @@
+from bisect import bisect_left
+
+from PyQt4 import QtCore, QtGui
+
+from qt_encoding import s2q
+
+GROUP_SEPARATOR = "/" #separates levels of group names, e.g. work/aws/prod
+
+def parentPath(path):
+	"""
+	@returns path of parent node, None for top level
+	"""
+	pos = path.rfind(GROUP_SEPARATOR)
+	if pos < 0:
+		return None
+	return path[:pos]
+
+def childPath(path, name):
+	"""
+	@returns path of child node name under path, None is root
+	"""
+	if path is None:
+		return name
+	return path + GROUP_SEPARATOR + name
+
+class GroupNode(object):
+	"""
+	Node of group tree created when its parent is expanded
+	"""
+
+	__slots__ = ("name", "path", "parent", "children", "fetched")
+
+	def __init__(self, name, path, parent):
+		self.name = name #last part of path
+		self.path = path #full group name, None for root
+		self.parent = parent
+		self.children = [] #GroupNodes in order of child names of path
+		self.fetched = False #children were created
+
+class GroupTreeModel(QtCore.QAbstractItemModel):
+	"""
+	Tree of password groups, group names are split into levels by
+	GROUP_SEPARATOR. A node may be a group, a folder of groups below
+	it, or both.
+
+	Sorted names of children are kept for every path, but nodes are
+	created only when their parent is expanded (canFetchMore and
+	fetchMore). Added groups are inserted at their sorted position,
+	so the tree never has to be sorted again.
+	"""
+
+	def __init__(self, groupNames, parent=None):
+		"""
+		@param groupNames: names of all groups as utf-8 strings
+		"""
+		QtCore.QAbstractItemModel.__init__(self, parent)
+		self.groupNames = set(groupNames)
+		self.root = GroupNode(None, None, None)
+		children = {}
+		for groupName in self.groupNames:
+			path = groupName
+			while True:
+				parent = parentPath(path)
+				names = children.setdefault(parent, set())
+				name = self.nodeName(parent, path)
+				if name in names:
+					break
+				names.add(name)
+				if parent is None:
+					break
+				path = parent
+		#sorted names of children by path, None is root; children of
+		#fetched nodes are in the same order
+		self.childNames = dict((path, sorted(names)) for path, names in children.iteritems())
+
+	def nodeName(self, parent, path):
+		"""
+		@returns last part of path under parent path
+		"""
+		return path if parent is None else path[len(parent)+1:]
+
+	def childRow(self, path, name):
+		"""
+		@returns row of child name under path or where it belongs
+		"""
+		return bisect_left(self.childNames.get(path, []), name)
+
+	def nodeOf(self, index):
+		if not index.isValid():
+			return self.root
+		return index.internalPointer()
+
+	def indexOf(self, node):
+		if node is self.root:
+			return QtCore.QModelIndex()
+		return self.createIndex(self.childRow(node.parent.path, node.name), 0, node)
+
+	def index(self, row, column, parent=QtCore.QModelIndex()):
+		node = self.nodeOf(parent)
+		if column != 0 or row < 0 or row >= len(node.children):
+			return QtCore.QModelIndex()
+		return self.createIndex(row, column, node.children[row])
+
+	def parent(self, index):
+		if not index.isValid():
+			return QtCore.QModelIndex()
+		return self.indexOf(index.internalPointer().parent)
+
+	def rowCount(self, parent=QtCore.QModelIndex()):
+		return len(self.nodeOf(parent).children)
+
+	def columnCount(self, parent=QtCore.QModelIndex()):
+		return 1
+
+	def hasChildren(self, parent=QtCore.QModelIndex()):
+		return bool(self.childNames.get(self.nodeOf(parent).path))
+
+	def canFetchMore(self, parent):
+		node = self.nodeOf(parent)
+		return not node.fetched and bool(self.childNames.get(node.path))
+
+	def fetchMore(self, parent):
+		node = self.nodeOf(parent)
+		if node.fetched:
+			return
+		names = self.childNames.get(node.path, [])
+		node.fetched = True
+		if not names:
+			return
+		self.beginInsertRows(parent, 0, len(names) - 1)
+		node.children = [GroupNode(name, childPath(node.path, name), node) for name in names]
+		self.endInsertRows()
+
+	def data(self, index, role=QtCore.Qt.DisplayRole):
+		if not index.isValid():
+			return QtCore.QVariant()
+		node = index.internalPointer()
+		if role == QtCore.Qt.DisplayRole:
+			return QtCore.QVariant(s2q(node.name))
+		if role == QtCore.Qt.ToolTipRole:
+			return QtCore.QVariant(s2q(node.path))
+		if role == QtCore.Qt.FontRole and node.path not in self.groupNames:
+			#folder that is not a group itself
+			font = QtGui.QFont()
+			font.setItalic(True)
+			return QtCore.QVariant(font)
+		return QtCore.QVariant()
+
+	def headerData(self, section, orientation, role=QtCore.Qt.DisplayRole):
+		if role != QtCore.Qt.DisplayRole or orientation != QtCore.Qt.Horizontal:
+			return QtCore.QVariant()
+		return QtCore.QVariant("Password group")
+
+	def groupName(self, index):
+		"""
+		@returns name of group at index, None if index is not a group
+		"""
+		if not index.isValid():
+			return None
+		path = index.internalPointer().path
+		return path if path in self.groupNames else None
+
+	def folderPath(self, index):
+		"""
+		@returns path of node at index, None for root
+		"""
+		return self.nodeOf(index).path
+
+	def shownNode(self, path):
+		"""
+		@returns node of path if it was created, else None
+		"""
+		if path is None:
+			return self.root
+		parent = self.shownNode(parentPath(path))
+		if parent is None or not parent.fetched:
+			return None
+		name = self.nodeName(parent.path, path)
+		row = self.childRow(parent.path, name)
+		if row < len(parent.children) and parent.children[row].name == name:
+			return parent.children[row]
+		return None
+
+	def indexForPath(self, path):
+		"""
+		Create nodes down to path and return its index.
+
+		@returns QModelIndex of node, invalid if path is not in tree
+		"""
+		parent = parentPath(path)
+		parentIndex = QtCore.QModelIndex() if parent is None else self.indexForPath(parent)
+		if parent is not None and not parentIndex.isValid():
+			return QtCore.QModelIndex()
+
+		self.fetchMore(parentIndex)
+		node = self.nodeOf(parentIndex)
+		name = self.nodeName(parent, path)
+		row = self.childRow(parent, name)
+		if row < len(node.children) and node.children[row].name == name:
+			return self.createIndex(row, 0, node.children[row])
+		return QtCore.QModelIndex()
+
+	def addGroup(self, groupName):
+		"""
+		Add group, creating folders above it if needed. Shown nodes are
+		inserted at sorted position.
+		"""
+		if groupName in self.groupNames:
+			return
+		self.groupNames.add(groupName)
+
+		path = groupName
+		while True:
+			parent = parentPath(path)
+			name = self.nodeName(parent, path)
+			names = self.childNames.setdefault(parent, [])
+			row = bisect_left(names, name)
+			if row < len(names) and names[row] == name:
+				#folder already exists, it may have become a group
+				node = self.shownNode(path)
+				if node is not None:
+					index = self.indexOf(node)
+					self.dataChanged.emit(index, index)
+				break
+
+			parentNode = self.shownNode(parent)
+			if parentNode is not None and not names:
+				parentNode.fetched = True #it had no children to fetch
+			if parentNode is not None and parentNode.fetched:
+				self.beginInsertRows(self.indexOf(parentNode), row, row)
+				names.insert(row, name)
+				parentNode.children.insert(row, GroupNode(name, path, parentNode))
+				self.endInsertRows()
+			else:
+				names.insert(row, name)
+			if parent is None:
+				break
+			path = parent
+
+	def removeGroup(self, groupName):
+		"""
+		Remove group and folders above it left without groups.
+		"""
+		self.groupNames.discard(groupName)
+		path = groupName
+		while path is not None and path not in self.groupNames and not self.childNames.get(path):
+			self.childNames.pop(path, None)
+			parent = parentPath(path)
+			name = self.nodeName(parent, path)
+			names = self.childNames.get(parent, [])
+			row = bisect_left(names, name)
+			if row >= len(names) or names[row] != name:
+				break
+			parentNode = self.shownNode(parent)
+			if parentNode is not None and parentNode.fetched:
+				self.beginRemoveRows(self.indexOf(parentNode), row, row)
+				del names[row]
+				del parentNode.children[row]
+				self.endRemoveRows()
+			else:
+				del names[row]
+			path = parent
+
+		node = self.shownNode(groupName)
+		if node is not None:
+			#still a folder, no longer a group
+			index = self.indexOf(node)
+			self.dataChanged.emit(index, index)
@@ -0,0 +1,443 @@
+import os
+import re
+import csv
+import json
+from xml.etree import cElementTree
+
+import export #registers "escaped" CSV dialect
+from password_map import PasswordGroup
+
+BATCH_SIZE = 64 #passwords of one group encrypted together
+
+class ImportCancelled(Exception):
+	"""Import was cancelled, password map was not changed"""
+	pass
+
+class ProgressReader(object):
+	"""
+	File wrapper counting bytes read, so that progress of streaming
+	parsers can be reported.
+	"""
+
+	def __init__(self, f):
+		self.f = f
+		self.bytesRead = 0
+
+	def read(self, size=-1):
+		data = self.f.read(size)
+		self.bytesRead += len(data)
+		return data
+
+	def readline(self, size=-1):
+		line = self.f.readline(size)
+		self.bytesRead += len(line)
+		return line
+
+	def __iter__(self):
+		return self
+
+	def next(self):
+		line = self.readline()
+		if not line:
+			raise StopIteration
+		return line
+
+def readCsv(f):
+	"""
+	Read rows written by CsvRowWriter: group, key, password. Backslashes
+	are doubled there, use readLegacyCsv for older backups.
+
+	@returns generator of (group name, key, password) utf-8 strings
+	@throws IOError: if a row does not have three columns
+	"""
+	for lineNum, row in enumerate(csv.reader(f, dialect="escaped"), 1):
+		if not row:
+			continue
+		if len(row) != 3:
+			raise IOError("CSV row %d does not have group, key and password" % lineNum)
+		yield tuple(row)
+
+class LookaheadReader(object):
+	"""
+	Reads file in lines of at most READ_SIZE bytes, keeping only the
+	unparsed rest, so that parsers can look a few characters ahead
+	across line ends.
+	"""
+
+	READ_SIZE = 64*1024
+	PLAIN_RUN = re.compile(r'[^"\\,\r\n]+') #characters without special meaning
+
+	def __init__(self, f):
+		self.f = f
+		self.data = ""
+		self.pos = 0
+
+	def peek(self, n=1):
+		"""
+		@returns next n characters, fewer at end of file
+		"""
+		while len(self.data) - self.pos < n:
+			line = self.f.readline(self.READ_SIZE)
+			if not line:
+				break
+			self.data = self.data[self.pos:] + line
+			self.pos = 0
+		return self.data[self.pos:self.pos + n]
+
+	def skip(self, n=1):
+		self.pos += n
+
+	def plainRun(self):
+		"""
+		Consume characters up to next quote, backslash, delimiter or
+		line end in data read so far.
+
+		@returns consumed characters, may be empty
+		"""
+		match = self.PLAIN_RUN.match(self.data, self.pos)
+		if match is None:
+			return ""
+		self.pos = match.end()
+		return match.group()
+
+def legacyCsvRows(f):
+	"""
+	Split rows of CSV written with "escaped" dialect without doubled
+	backslashes, like backups of TrezorPass before export existed.
+	Such writer escapes only quotes by backslash, other backslashes are
+	written as they are inside quoted fields. Backslash followed by quote
+	that ends a quoted field is taken as last character of the field,
+	because value ending with backslash cannot be told apart from quote
+	followed by delimiter there. File is read incrementally, quoted
+	fields may span lines.
+
+	@returns generator of rows, lists of strings
+	"""
+	reader = LookaheadReader(f)
+	row = []
+	while reader.peek():
+		field = []
+		if reader.peek() == '"':
+			reader.skip()
+			while reader.peek():
+				field.append(reader.plainRun())
+				c = reader.peek()
+				if c == "\\" and reader.peek(2) == '\\"' and reader.peek(3)[2:] not in ("", ",", "\r", "\n"):
+					field.append('"')
+					reader.skip(2)
+				elif c == '"':
+					reader.skip()
+					break
+				elif c:
+					field.append(c)
+					reader.skip()
+		while reader.peek() and reader.peek() not in ",\r\n":
+			field.append(reader.plainRun())
+			if reader.peek(2) == '\\"':
+				reader.skip()
+			c = reader.peek()
+			if c and c not in ",\r\n":
+				field.append(c)
+				reader.skip()
+		row.append("".join(field))
+		if reader.peek() == ",":
+			reader.skip()
+			if not reader.peek():
+				row.append("")
+			continue
+		if reader.peek(2) == "\r\n":
+			reader.skip()
+		reader.skip()
+		yield row
+		row = []
+	if row:
+		yield row
+
+def readLegacyCsv(f):
+	"""
+	Read CSV backup saved by TrezorPass before export, it has backslashes
+	not doubled, see legacyCsvRows.
+
+	@returns generator of (group name, key, password) utf-8 strings
+	@throws IOError: if a row does not have three columns
+	"""
+	for lineNum, row in enumerate(legacyCsvRows(f), 1):
+		if row == [""]:
+			continue
+		if len(row) != 3:
+			raise IOError("CSV row %d does not have group, key and password" % lineNum)
+		yield tuple(row)
+
+def readJsonLines(f):
+	"""
+	Read rows written by JsonLinesRowWriter.
+
+	@returns generator of (group name, key, password) utf-8 strings
+	@throws IOError: if a line is not object with group, key and password
+	"""
+	for lineNum, line in enumerate(f, 1):
+		if not line.strip():
+			continue
+		try:
+			row = json.loads(line)
+			yield tuple(row[name].encode("utf-8") for name in ("group", "key", "password"))
+		except (ValueError, KeyError, TypeError, AttributeError):
+			raise IOError("JSON Lines row %d does not have group, key and password" % lineNum)
+
+def xmlText(elem):
+	"""
+	@returns text of XML element as utf-8 string
+	"""
+	text = elem.text or ""
+	if isinstance(text, unicode):
+		text = text.encode("utf-8")
+	return text
+
+def forgetElement(parents, elem):
+	"""
+	Drop finished element parsed by iterparse. Clearing it is not enough,
+	empty elements would still pile up in their parents and the root.
+
+	@param parents: list of open elements, first one is root
+	"""
+	elem.clear()
+	if len(parents) > 1:
+		parents[-1].remove(elem)
+	if parents:
+		parents[0].clear()
+
+def readKeepassXml(f):
+	"""
+	Read entries of KeePass 2.x XML export. Finished elements are dropped
+	from the tree, so large files are parsed in bounded memory.
+
+	Group name is path of KeePass groups below the root group joined
+	by "/", entries of root group go to group named like root group.
+	Key is entry title followed by user name in parentheses. Entries
+	in recycle bin and history of entries are skipped.
+
+	@returns generator of (group name, key, password) utf-8 strings
+	@throws IOError: if file has values protected by KeePass
+		database encryption
+	"""
+	groupPath = [] #names of open groups
+	groupUuids = []
+	recycleBin = None
+	historyDepth = 0 #entries in history are old versions
+	parents = [] #open elements, first one is root
+
+	for event, elem in cElementTree.iterparse(f, events=("start", "end")):
+		if event == "start":
+			if elem.tag == "Group":
+				groupPath.append(None)
+				groupUuids.append(None)
+			elif elem.tag == "History":
+				historyDepth += 1
+			parents.append(elem)
+			continue
+
+		parents.pop()
+		parentElem = parents[-1] if parents else None
+		parent = parentElem.tag if parentElem is not None else None
+		if elem.tag == "RecycleBinUUID" and parent == "Meta":
+			recycleBin = xmlText(elem)
+		elif elem.tag == "Name" and parent == "Group":
+			groupPath[-1] = xmlText(elem)
+		elif elem.tag == "UUID" and parent == "Group":
+			groupUuids[-1] = xmlText(elem)
+		elif elem.tag == "History":
+			historyDepth -= 1
+			forgetElement(parents, elem)
+		elif elem.tag == "Group":
+			groupPath.pop()
+			groupUuids.pop()
+			forgetElement(parents, elem)
+		elif elem.tag == "Entry" and historyDepth == 0:
+			if recycleBin is None or recycleBin not in groupUuids:
+				strings = {}
+				for string in elem.findall("String"):
+					value = string.find("Value")
+					if value is not None and value.get("Protected") == "True":
+						raise IOError("KeePass XML has protected values, export it unencrypted")
+					strings[xmlText(string.find("Key"))] = "" if value is None else xmlText(value)
+
+				title = strings.get("Title", "")
+				userName = strings.get("UserName", "")
+				key = "%s (%s)" % (title, userName) if title and userName else title or userName
+				groupName = "/".join(groupPath[1:]) or groupPath[0]
+				yield groupName, key, strings.get("Password", "")
+			forgetElement(parents, elem)
+
+#row readers by import format name
+IMPORT_FORMATS = {
+	"csv": readCsv,
+	"csv-legacy": readLegacyCsv,
+	"jsonl": readJsonLines,
+	"keepass": readKeepassXml,
+}
+
+class PasswordImport(object):
+	"""
+	Imported entries encrypted with Trezor and backup key, kept aside
+	until commit() adds all of them to password map at once.
+
+	Passwords of a group are encrypted in batches, see
+	PasswordMap.encryptPasswords. New groups get a group key by default,
+	so encrypting all their passwords costs one Trezor call.
+	"""
+
+	def __init__(self, pwMap, groupKeys=True):
+		"""
+		@param pwMap: PasswordMap to import to
+		@param groupKeys: create new groups with group key
+		"""
+		self.pwMap = pwMap
+		self.groupKeys = groupKeys
+		self.groups = {} #PasswordGroup with imported entries by group name
+		self.newGroups = {} #group key or None by name of group created by import
+		self.wrappedKeys = {} #wrapped key of existing groups when encrypted
+		self.pending = {} #(keys, passwords, backups) not encrypted yet by group name
+		self.count = 0 #entries encrypted so far
+
+	def add(self, groupName, key, password, backupPassword=None):
+		"""
+		Add entry, encrypting passwords of its group when BATCH_SIZE of
+		them are pending. Uses Trezor.
+
+		@param backupPassword: password already encrypted by backup key,
+			encrypted here if None
+		"""
+		keys, passwords, backups = self.pending.setdefault(groupName, ([], [], []))
+		keys.append(key)
+		passwords.append(password)
+		backups.append(backupPassword)
+		if len(keys) >= BATCH_SIZE:
+			self.encryptPending(groupName)
+
+	def flush(self):
+		"""
+		Encrypt all pending entries. Uses Trezor.
+		"""
+		for groupName in self.pending.keys():
+			self.encryptPending(groupName)
+
+	def isExisting(self, groupName):
+		"""
+		@returns True if entries of group are added to existing group
+		"""
+		return groupName in self.pwMap.groups
+
+	def importGroup(self, groupName):
+		"""
+		@returns PasswordGroup collecting entries of group, new group
+			gets group key if groupKeys is set
+		"""
+		group = self.groups.get(groupName)
+		if group is None:
+			group = self.groups[groupName] = PasswordGroup()
+			if self.isExisting(groupName):
+				self.wrappedKeys[groupName] = self.pwMap.groups[groupName].wrappedKey
+			else:
+				groupKey = None
+				if self.groupKeys:
+					groupKey = self.pwMap.newGroupKey(groupName)
+				self.newGroups[groupName] = groupKey
+		return group
+
+	def encryptPending(self, groupName):
+		keys, passwords, backups = self.pending.pop(groupName)
+		group = self.importGroup(groupName)
+
+		if groupName not in self.newGroups:
+			encrypted = self.pwMap.encryptPasswords(passwords, groupName)
+		elif self.newGroups[groupName] is None:
+			#a group of that name may still exist, see GroupMove
+			encrypted = self.pwMap.encryptPasswordsByTrezor(passwords, groupName)
+		else:
+			encrypted = self.pwMap.encryptPasswords(passwords, groupName, self.newGroups[groupName][0])
+
+		backupKey = self.pwMap.backupKey
+		for key, password, encPw, bkupPw in zip(keys, passwords, encrypted, backups):
+			group.addEntry(key, encPw, bkupPw or backupKey.encryptPassword(password))
+		self.count += len(keys)
+
+	def commit(self):
+		"""
+		Add all imported groups and entries to password map. Nothing is
+		added if a group was created, removed or switched to group key
+		after its entries were encrypted.
+
+		@returns number of imported entries
+		@throws KeyError: if groups of password map changed
+		"""
+		self.checkGroups()
+		return self.addToMap()
+
+	def checkGroups(self):
+		"""
+		@throws KeyError: if groups of password map changed since
+			entries were encrypted
+		"""
+		if self.pending:
+			raise ValueError("Imported entries were not encrypted, flush() first")
+		groups = self.pwMap.groups
+		for groupName in self.groups:
+			if groupName in self.newGroups:
+				if self.isExisting(groupName):
+					raise KeyError("Password group was created during import: " + groupName)
+			elif groupName not in groups or groups[groupName].wrappedKey != self.wrappedKeys[groupName]:
+				raise KeyError("Password group was changed during import: " + groupName)
+
+	def addToMap(self):
+		"""
+		Add checked groups and entries to password map.
+
+		@returns number of added entries
+		"""
+		for groupName, group in self.groups.iteritems():
+			if groupName in self.newGroups:
+				self.pwMap.addGroup(groupName, self.newGroups[groupName])
+			for key, encPw, bkupPw in group.entries:
+				self.pwMap.addEntry(groupName, key, encPw, bkupPw)
+
+		return self.count
+
+def importFile(pwMap, f, importFormat, groupKeys=True, progress=None, cancelEvent=None):
+	"""
+	Stream-parse file and encrypt its entries for password map. Backup
+	encryption uses hybrid scheme, so it is a cheap symmetric cipher
+	and runs inline. Password map is not changed until commit() of
+	returned import is called.
+
+	@param f: file object opened for reading
+	@param importFormat: key of IMPORT_FORMATS
+	@param groupKeys: create new groups with group key
+	@param progress: function called with (bytes read, file size),
+		file size is 0 if unknown
+	@param cancelEvent: threading.Event, import stops when it is set
+	@returns PasswordImport with all entries encrypted
+	@throws ImportCancelled: if cancelEvent was set
+	@throws IOError: if file is not in given format
+	"""
+	try:
+		total = os.fstat(f.fileno()).st_size
+	except (AttributeError, OSError):
+		total = 0
+
+	reader = ProgressReader(f)
+	passwordImport = PasswordImport(pwMap, groupKeys)
+	try:
+		for rowNum, row in enumerate(IMPORT_FORMATS[importFormat](reader), 1):
+			if cancelEvent is not None and cancelEvent.is_set():
+				raise ImportCancelled()
+			passwordImport.add(*row)
+			if progress is not None and rowNum % BATCH_SIZE == 0:
+				progress(reader.bytesRead, total)
+	except SyntaxError, e:
+		#cElementTree's ParseError
+		raise IOError("Invalid XML: " + str(e))
+
+	passwordImport.flush()
+	if progress is not None:
+		progress(reader.bytesRead, total)
+	return passwordImport
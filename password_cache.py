@@ -0,0 +1,125 @@
+import time
+from collections import OrderedDict
+
+DEFAULT_TTL = 300 #seconds a decrypted password is kept
+DEFAULT_MAX_ENTRIES = 100
+
+class CachedPassword(object):
+	"""
+	Decrypted password in mutable buffer that is overwritten by wipe()
+	"""
+
+	__slots__ = ("buf", "expires")
+
+	def __init__(self, password, expires):
+		self.buf = bytearray(password)
+		self.expires = expires
+
+	def wipe(self):
+		#same-length slice assignment overwrites buffer in place
+		self.buf[:] = bytearray(len(self.buf))
+
+class PasswordCache(object):
+	"""
+	Decrypted passwords of all groups, keyed by group name and encrypted
+	password of the entry. Encrypted password has random IV, so the key
+	stays valid when other entries are added or removed and changes when
+	the entry is updated.
+
+	Entries expire after ttl seconds, least recently used entry is
+	evicted when there are more than maxEntries. Removed passwords are
+	overwritten in memory. Strings returned by get() are copies that
+	Python can not wipe, so they should not be kept longer than needed.
+	"""
+
+	def __init__(self, ttl=DEFAULT_TTL, maxEntries=DEFAULT_MAX_ENTRIES, clock=time.time):
+		"""
+		@param ttl: seconds after which cached password expires
+		@param maxEntries: maximum number of cached passwords
+		@param clock: function returning current time in seconds
+		"""
+		self.ttl = ttl
+		self.maxEntries = maxEntries
+		self.clock = clock
+		self.entries = OrderedDict() #least recently used first
+		self.hits = 0
+		self.misses = 0
+		self.evictions = 0 #passwords removed due to size limit or TTL
+
+	def get(self, groupName, encryptedPassword):
+		"""
+		@returns cached password or None if not cached or expired
+		"""
+		key = (groupName, encryptedPassword)
+		cached = self.entries.pop(key, None)
+		if cached is not None and cached.expires <= self.clock():
+			cached.wipe()
+			self.evictions += 1
+			cached = None
+
+		if cached is None:
+			self.misses += 1
+			return None
+
+		self.entries[key] = cached
+		self.hits += 1
+		return str(cached.buf)
+
+	def put(self, groupName, encryptedPassword, password):
+		"""
+		Cache decrypted password, evicting least recently used
+		passwords over maxEntries.
+		"""
+		self.remove(groupName, encryptedPassword)
+		if self.maxEntries <= 0:
+			return
+
+		self.entries[(groupName, encryptedPassword)] = \
+			CachedPassword(password, self.clock() + self.ttl)
+		while len(self.entries) > self.maxEntries:
+			_, cached = self.entries.popitem(last=False)
+			cached.wipe()
+			self.evictions += 1
+
+	def remove(self, groupName, encryptedPassword):
+		"""
+		Remove password of entry if it is cached
+		"""
+		cached = self.entries.pop((groupName, encryptedPassword), None)
+		if cached is not None:
+			cached.wipe()
+
+	def removeGroup(self, groupName):
+		"""
+		Remove all cached passwords of group
+		"""
+		for key in [key for key in self.entries if key[0] == groupName]:
+			self.entries.pop(key).wipe()
+
+	def expire(self):
+		"""
+		Remove expired passwords. Expired passwords are never returned,
+		this only makes sure they do not stay in memory.
+		"""
+		now = self.clock()
+		for key in [key for key, cached in self.entries.iteritems() if cached.expires <= now]:
+			self.entries.pop(key).wipe()
+			self.evictions += 1
+
+	def clear(self):
+		"""
+		Remove all cached passwords, e.g. when locking.
+		"""
+		for cached in self.entries.itervalues():
+			cached.wipe()
+		self.entries.clear()
+
+	def __len__(self):
+		return len(self.entries)
+
+	def stats(self):
+		"""
+		@returns dict with hit, miss and eviction counters and size
+		"""
+		return {"hits": self.hits, "misses": self.misses,
+			"evictions": self.evictions, "size": len(self.entries)}
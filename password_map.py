@@ -1,16 +1,36 @@
+import os
+import copy
+import stat
+import mmap
 import struct
 import cPickle
+import cStringIO
 import hmac
+import zlib
 import hashlib
+import threading
+import collections
+from itertools import izip
 
 from Crypto.Cipher import AES
+from Crypto.Util import Counter
 from Crypto import Random
 
+try:
+	import lzma
+except ImportError:
+	try:
+		from backports import lzma #backports.lzma package on Python 2
+	except ImportError:
+		lzma = None
+
 from backup import Backup
 
-from encoding import Magic, Padding
+from encoding import Magic, Padding, macEquals
+from serialization import Encoder, Decoder
+from columns import StringColumn
 
-## On-disk format
+## On-disk format, version 1
 #  4 bytes	header "TZPW"
 #  4 bytes	data storage version, network order uint32_t
 # 32 bytes	AES-CBC-encrypted wrappedOuterKey
@@ -20,10 +40,320 @@ from encoding import Magic, Padding
 #  4 bytes	size of data following (N)
 #  N bytes	AES-CBC encrypted blob containing pickled structure for password map
 # 32 bytes	HMAC-SHA256 over data with same key as AES-CBC data struct above
+#
+## On-disk format, version 2 and 3 - groups in independently encrypted segments
+#  4 bytes	header "TZPW"
+#  4 bytes	data storage version, network order uint32_t
+#  4 bytes	flags, network order uint32_t, file is refused if unknown flag is set
+# 32 bytes	AES-CBC-encrypted wrappedOuterKey
+#  2 bytes	backup private key size (B)
+#  B bytes	encrypted backup key
+#  8 bytes	offset of index from start of file, network order uint64_t
+#  ...		group segments, each is 16 bytes IV followed by AES-CBC
+#		encrypted pickled PasswordGroup
+#  4 bytes	size of index following (N)
+#  N bytes	16 bytes IV followed by AES-CBC encrypted pickled index - list
+#		of (group name, segment offset, segment size, segment HMAC)
+# 32 bytes	HMAC-SHA256 over index
+#  ...		journal records if FLAG_JOURNAL is set, each:
+#  4 bytes	size of record data following (N)
+#  N bytes	16 bytes IV followed by AES-CBC encrypted pickled list of
+#		operations done between two saves
+# 32 bytes	HMAC-SHA256 over HMAC of previous record (or of index for
+#		first record) and record data
+#
+# All encryption and HMACs are done with the outer key. HMAC of each
+# segment (including its IV) is stored in the authenticated index, so
+# a group is decrypted and verified only when it is accessed. Journal
+# records are replayed on top of the groups in order. A record that
+# was not completely written is ignored, so a save interrupted by a
+# crash is lost as a whole.
+#
+# Backup key of versions 1 and 2 is pickled tuple (ephemeral IV,
+# encrypted ephemeral key, encrypted private key, public key DER). In
+# version 2 it may be followed by field version 2 and list of RSA
+# wrapped backup data keys of hybrid backup scheme (see backup.py).
+# Version 1 files are never written with data keys, since readers of
+# version 1 know only the 4-tuple.
+#
+# Version 3 has the same layout as version 2, but backup key, groups,
+# index and journal operations are in binary encoding (see
+# serialization.py and serialize methods of PasswordGroup, Backup),
+# each starting with encoding version byte, instead of pickle.
+#
+## Chunked group segments of version 2 and 3, if FLAG_CHUNKED is set
+#  4 bytes	plaintext size of chunks (C), network order uint32_t
+#  ...		chunks, each but the last holds C bytes of serialized group:
+#  4 bytes	chunk index, network order uint32_t
+#  8 bytes	nonce
+#  n bytes	AES-CTR encrypted part of serialized group, no padding
+# 32 bytes	HMAC-SHA256 over chunk index, nonce and encrypted part
+#
+# AES-CTR and HMAC keys of chunks are derived from the outer key. HMAC
+# of chunked segment stored in the index is HMAC over concatenated
+# HMACs of its chunks, so chunks cannot be dropped, reordered or moved
+# between segments, yet each chunk is verified and decrypted on its
+# own, in parallel by a thread pool.
+#
+# If FLAG_ZLIB or FLAG_LZMA is set, serialized groups, index and
+# journal operations are compressed before encryption (and before
+# splitting into chunks).
 
 BLOCKSIZE = 16
 MACSIZE = 32
 KEYSIZE = 32
+MAX_CIPHER_VALUE = 1024 #maximum bytes Trezor encrypts in one CipherKeyValue call
+CHUNK_SIZE = 256*1024 #bytes of mapped file authenticated and decrypted at once
+SEGMENT_CHUNK_SIZE = 1024*1024 #plaintext bytes in one chunk of chunked segment
+CHUNK_NONCE_SIZE = 8
+CHUNK_HEADER_SIZE = 4 + CHUNK_NONCE_SIZE #chunk index and nonce
+
+STORAGE_VERSION = 3 #version written by PasswordMap.save
+FLAG_JOURNAL = 0x1 #journal records follow the index
+FLAG_CHUNKED = 0x2 #group segments are split into chunks
+FLAG_ZLIB = 0x4 #segments, index and journal records are zlib compressed
+FLAG_LZMA = 0x8 #segments, index and journal records are lzma (xz) compressed
+#mask of version 2/3 flags this code understands
+KNOWN_FLAGS = FLAG_JOURNAL | FLAG_CHUNKED | FLAG_ZLIB | FLAG_LZMA
+#flags of storage file that apply to each group segment
+SEGMENT_FLAGS = FLAG_CHUNKED | FLAG_ZLIB | FLAG_LZMA
+COMPRESSION_FLAGS = {"zlib": FLAG_ZLIB, "lzma": FLAG_LZMA} #header flag by compression
+DEFAULT_COMPRESSION_LEVEL = 6 #zlib level or lzma preset, 0-9
+FLAGS_OFFSET = 8 #offset of flags in version 2/3 header
+
+INDEX_ENCODING_VERSION = 1 #first byte of binary encoded index
+OPS_ENCODING_VERSION = 1 #first byte of binary encoded journal operations
+#operation names in journal, binary encoding stores index to this list
+OPERATIONS = ["addGroup", "removeGroup", "addEntry", "updateEntry", "removeEntry",
+	"setGroupKey", "addBackupDataKey"]
+
+#journal is compacted into a new snapshot when it grows over this many
+#bytes and over 1/JOURNAL_COMPACT_RATIO of the snapshot size
+JOURNAL_COMPACT_MIN = 64*1024
+JOURNAL_COMPACT_RATIO = 4
+
+def replaceFile(src, dst):
+	"""
+	Rename src to dst, replacing dst. Atomic on POSIX.
+	"""
+	if os.name == "nt" and os.path.exists(dst):
+		os.remove(dst)
+	os.rename(src, dst)
+
+def openTempFile(fname):
+	"""
+	Create temporary file to be renamed over fname later, with the same
+	permissions as fname, or readable only by owner if fname does not
+	exist yet.
+	
+	@returns tuple (temporary file name, file object opened for writing)
+	@throws IOError: if file cannot be created
+	"""
+	tmpName = fname + ".tmp"
+	try:
+		mode = stat.S_IMODE(os.stat(fname).st_mode)
+	except OSError:
+		mode = 0600
+	try:
+		fd = os.open(tmpName, os.O_WRONLY | os.O_CREAT | os.O_TRUNC | getattr(os, "O_BINARY", 0), mode)
+	except OSError, e:
+		raise IOError(e.errno, e.strerror, tmpName)
+	if hasattr(os, "fchmod"):
+		#mode of existing file or one reduced by umask is not kept
+		os.fchmod(fd, mode)
+	return tmpName, os.fdopen(fd, "wb")
+
+def decryptMapped(mapped, offset, size, key, iv=None):
+	"""
+	Compute HMAC-SHA256 of mapped[offset:offset+size] and decrypt it
+	with AES-CBC in one pass over CHUNK_SIZE chunks, so that the whole
+	ciphertext is never copied out of the mapping. Plaintext is
+	decrypted into one bytearray and padding is cut off by a buffer
+	over it instead of a copy.
+	
+	Padding is not checked here, caller must compare returned HMAC
+	before using plaintext.
+	
+	@param mapped: mmap of storage file
+	@param iv: IV of the data, if None data start with IV
+	@returns tuple (HMAC digest, plaintext as read-only buffer)
+	@throws IOError: if data are truncated or not whole blocks
+	"""
+	if offset + size > len(mapped):
+		raise IOError("Corrupted disk format - encrypted data truncated")
+	mac = hmac.new(key, digestmod=hashlib.sha256)
+	if iv is None:
+		iv = mapped[offset:offset+BLOCKSIZE]
+		mac.update(iv)
+		offset += BLOCKSIZE
+		size -= BLOCKSIZE
+	if size <= 0 or size % BLOCKSIZE:
+		raise IOError("Corrupted disk format - encrypted data are not whole blocks")
+	
+	cipher = AES.new(key, AES.MODE_CBC, iv)
+	plaintext = bytearray(size)
+	for start in xrange(0, size, CHUNK_SIZE):
+		chunk = mapped[offset+start:offset+min(size, start+CHUNK_SIZE)]
+		mac.update(chunk)
+		plaintext[start:start+len(chunk)] = cipher.decrypt(chunk)
+	
+	padLength = plaintext[-1]
+	if padLength > BLOCKSIZE:
+		padLength = 0 #HMAC check fails for such data anyway
+	return mac.digest(), buffer(plaintext, 0, size - padLength)
+
+def compressPayload(data, compression, level=DEFAULT_COMPRESSION_LEVEL):
+	"""
+	@param compression: None, "zlib" or "lzma"
+	@param level: zlib level or lzma preset, 0-9
+	@returns data compressed for storage file
+	@throws IOError: if lzma module is not installed
+	"""
+	if compression is None:
+		return data
+	if compression == "zlib":
+		return zlib.compress(data, level)
+	return lzmaModule().compress(data, preset=level)
+
+def decompressPayload(data, flags):
+	"""
+	Decompress decrypted data of storage file with given header flags.
+	
+	@param data: string or buffer
+	@returns decompressed string, or data if file is not compressed
+	@throws IOError: if data are corrupted or lzma is not installed
+	"""
+	if flags & FLAG_ZLIB:
+		try:
+			return zlib.decompress(data)
+		except zlib.error:
+			raise IOError("Corrupted disk format - bad compressed data")
+	if flags & FLAG_LZMA:
+		module = lzmaModule()
+		try:
+			return module.decompress(str(data))
+		except module.LZMAError:
+			raise IOError("Corrupted disk format - bad compressed data")
+	return data
+
+def lzmaModule():
+	"""
+	@returns lzma module
+	@throws IOError: if it is not installed
+	"""
+	if lzma is None:
+		raise IOError("lzma compression needs lzma module (backports.lzma on Python 2)")
+	return lzma
+
+def compressionAvailable(compression):
+	"""
+	@returns True if compression name is known and its module installed
+	"""
+	return compression in COMPRESSION_FLAGS and (compression != "lzma" or lzma is not None)
+
+def mapFile(f):
+	"""
+	@returns read-only mmap of whole opened file
+	"""
+	return mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+_chunkPool = None #(pid, ThreadPool) of chunk encryption, created on first use
+
+def mapChunks(function, count):
+	"""
+	Call function for chunk indices 0..count-1 in thread pool, AES and
+	HMAC of large strings do not hold the GIL. A single chunk is
+	processed in calling thread.
+	
+	@returns list of results in order of chunks
+	"""
+	global _chunkPool
+	if count == 1:
+		return [function(0)]
+	import multiprocessing
+	from multiprocessing.pool import ThreadPool
+	#threads of pool do not survive fork, child creates its own
+	if _chunkPool is None or _chunkPool[0] != os.getpid():
+		_chunkPool = (os.getpid(), ThreadPool(multiprocessing.cpu_count()))
+	return _chunkPool[1].map(function, xrange(count))
+
+def chunkKeys(key):
+	"""
+	@returns tuple (AES-CTR key, HMAC key) of chunked segments derived
+		from outer key
+	"""
+	return (hmac.new(key, "TrezorPass chunk encryption", hashlib.sha256).digest(),
+		hmac.new(key, "TrezorPass chunk authentication", hashlib.sha256).digest())
+
+def chunkCipher(key, nonce):
+	return AES.new(key, AES.MODE_CTR, counter=Counter.new(64, prefix=nonce, initial_value=0))
+
+def encryptChunked(plaintext, key):
+	"""
+	Encrypt plaintext as chunked segment, chunks are encrypted in
+	parallel.
+	
+	@param key: outer key
+	@returns tuple (segment data, its HMAC digest)
+	"""
+	encKey, macKey = chunkKeys(key)
+	count = max(1, (len(plaintext) + SEGMENT_CHUNK_SIZE - 1) // SEGMENT_CHUNK_SIZE)
+	
+	def encryptChunk(idx):
+		header = struct.pack("!I", idx) + Random.new().read(CHUNK_NONCE_SIZE)
+		start = idx * SEGMENT_CHUNK_SIZE
+		encrypted = chunkCipher(encKey, header[4:]).encrypt(
+			plaintext[start:start+SEGMENT_CHUNK_SIZE])
+		mac = hmac.new(macKey, header, hashlib.sha256)
+		mac.update(encrypted)
+		return header + encrypted + mac.digest()
+	
+	chunks = mapChunks(encryptChunk, count)
+	tags = "".join(chunk[-MACSIZE:] for chunk in chunks)
+	data = struct.pack("!I", SEGMENT_CHUNK_SIZE) + "".join(chunks)
+	return data, hmac.new(macKey, tags, hashlib.sha256).digest()
+
+def decryptChunked(mapped, offset, size, key):
+	"""
+	Verify and decrypt chunked segment mapped[offset:offset+size],
+	chunks are processed in parallel and decrypted into one bytearray.
+	
+	@param key: outer key
+	@returns tuple (HMAC digest of the segment, plaintext as read-only
+		buffer)
+	@throws IOError: if segment is truncated or a chunk is corrupted
+	"""
+	if offset + size > len(mapped) or size < 4:
+		raise IOError("Corrupted disk format - encrypted data truncated")
+	chunkSize = struct.unpack("!I", mapped[offset:offset+4])[0]
+	if chunkSize == 0:
+		raise IOError("Corrupted disk format - bad chunk size")
+	encKey, macKey = chunkKeys(key)
+	storedSize = CHUNK_HEADER_SIZE + chunkSize + MACSIZE
+	dataSize = size - 4
+	count = max(1, (dataSize + storedSize - 1) // storedSize)
+	lastSize = dataSize - (count - 1) * storedSize - CHUNK_HEADER_SIZE - MACSIZE
+	if lastSize < 0:
+		raise IOError("Corrupted disk format - chunk truncated")
+	plaintext = bytearray((count - 1) * chunkSize + lastSize)
+	
+	def decryptChunk(idx):
+		start = offset + 4 + idx * storedSize
+		encSize = chunkSize if idx < count - 1 else lastSize
+		header = mapped[start:start+CHUNK_HEADER_SIZE]
+		start += CHUNK_HEADER_SIZE
+		encrypted = mapped[start:start+encSize]
+		tag = mapped[start+encSize:start+encSize+MACSIZE]
+		mac = hmac.new(macKey, header, hashlib.sha256)
+		mac.update(encrypted)
+		if struct.unpack("!I", header[:4])[0] != idx or not macEquals(tag, mac.digest()):
+			raise IOError("Corrupted disk format - chunk HMAC does not match")
+		plainStart = idx * chunkSize
+		plaintext[plainStart:plainStart+encSize] = chunkCipher(encKey, header[4:]).decrypt(encrypted)
+		return tag
+	
+	tags = mapChunks(decryptChunk, count)
+	return hmac.new(macKey, "".join(tags), hashlib.sha256).digest(), buffer(plaintext)
 
 class PasswordGroup(object):
 	"""
@@ -33,133 +363,943 @@ class PasswordGroup(object):
 	- key
 	- symetrically AES-CBC encrypted password unlockable only by Trezor
 	- RSA-encrypted password for creating backup of all password groups
+	
+	If group has wrappedKey, passwords are instead encrypted locally
+	with group key, which is unlocked by Trezor once for whole group.
+	
+	Each of the values is kept in its own StringColumn instead of
+	a tuple per entry, which saves memory with many entries.
 	"""
 	
+	__slots__ = ("keys", "values", "backups", "wrappedKey")
+	
+	SERIALIZATION_VERSION = 1 #first byte of serialized form
+	SERIALIZATION_VERSION_GROUP_KEY = 2 #same, followed by wrapped group key
+	
 	def __init__(self):
-		self.entries = []
+		self.keys = StringColumn()
+		self.values = StringColumn()
+		self.backups = StringColumn()
+		self.wrappedKey = None #group key encrypted by Trezor, None if not used
+	
+	def __getstate__(self):
+		"""
+		Pickled form, same as of storage versions 1 and 2 groups
+		"""
+		state = {"entries": list(self.entries)}
+		if self.wrappedKey is not None:
+			state["wrappedKey"] = self.wrappedKey
+		return state
+	
+	def __setstate__(self, state):
+		self.__init__()
+		self.wrappedKey = state.get("wrappedKey")
+		entries = state["entries"]
+		if entries:
+			self.keys, self.values, self.backups = \
+				[StringColumn.fromStrings(strings) for strings in izip(*entries)]
+	
+	@property
+	def entries(self):
+		"""
+		Read-only sequence of (key, encrypted value, backup value)
+		"""
+		return EntryList(self)
+	
+	def columns(self):
+		return (self.keys, self.values, self.backups)
+	
+	def serialize(self):
+		"""
+		Return entries as binary encoded string - entry count and
+		string arrays of keys, encrypted values and backup values
+		"""
+		encoder = Encoder()
+		if self.wrappedKey is None:
+			encoder.uint8(self.SERIALIZATION_VERSION)
+		else:
+			encoder.uint8(self.SERIALIZATION_VERSION_GROUP_KEY)
+			encoder.string(self.wrappedKey)
+		encoder.uint32(len(self.keys))
+		for column in self.columns():
+			ends, data = column.ends()
+			encoder.uint32Array(ends)
+			encoder.raw(data)
+		return encoder.getvalue()
+	
+	def deserialize(self, serialized):
+		"""
+		Set entries from binary encoded string
+		
+		@throws IOError: if encoding is corrupted or unknown
+		"""
+		decoder = Decoder(serialized)
+		encodingVersion = decoder.uint8()
+		if encodingVersion == self.SERIALIZATION_VERSION_GROUP_KEY:
+			self.wrappedKey = decoder.string()
+		elif encodingVersion != self.SERIALIZATION_VERSION:
+			raise IOError("Unknown encoding version of password group")
+		count = decoder.uint32()
+		self.keys, self.values, self.backups = \
+			[StringColumn.fromEnds(*decoder.stringArray(count)) for _ in range(3)]
+		decoder.expectEnd()
 	
 	def addEntry(self, key, encryptedValue, backupValue):
 		"""Add key-value-backud entry"""
-		self.entries.append((key, encryptedValue, backupValue))
+		self.keys.append(key)
+		self.values.append(encryptedValue)
+		self.backups.append(backupValue)
 	
 	def removeEntry(self, idx):
 		"""Remove entry at given index"""
-		self.entries.pop(idx)
+		for column in self.columns():
+			del column[idx]
 	
 	def updateEntry(self, idx, key, encryptedValue, backupValue):
 		"""
 		Update pair at index idx with given key, value and
 		backup-encrypted password.
 		"""
-		self.entries[idx] = (key, encryptedValue, backupValue)
+		self.keys[idx] = key
+		self.values[idx] = encryptedValue
+		self.backups[idx] = backupValue
 		
 	def entry(self, idx):
 		"""Return entry with given index"""
-		return self.entries[idx]
+		return (self.keys[idx], self.values[idx], self.backups[idx])
+	
+	def copy(self):
+		"""
+		Return group with the same entries that is not affected by
+		later changes of this one.
+		"""
+		group = PasswordGroup()
+		group.keys, group.values, group.backups = [column.copy() for column in self.columns()]
+		group.wrappedKey = self.wrappedKey
+		return group
+
+class EntryList(collections.Sequence):
+	"""
+	View of PasswordGroup entries as (key, encrypted value, backup
+	value) tuples
+	"""
+	
+	def __init__(self, group):
+		self.group = group
+	
+	def __len__(self):
+		return len(self.group.keys)
+	
+	def __getitem__(self, idx):
+		return self.group.entry(idx)
+	
+	def __iter__(self):
+		return izip(*self.group.columns())
+
+class GroupSegment(object):
+	"""
+	Location of encrypted password group in version 2/3 storage file.
+	"""
+	
+	def __init__(self, fname, offset, size, hmacDigest, key, version, flags=0):
+		"""
+		@param fname: storage file name
+		@param offset: offset of segment from start of file
+		@param size: segment size including IV
+		@param hmacDigest: expected HMAC of the segment
+		@param key: outer key the segment is encrypted with
+		@param version: storage version of the file
+		@param flags: flags of the file that apply to segment, see
+			SEGMENT_FLAGS
+		"""
+		self.fname = fname
+		self.offset = offset
+		self.size = size
+		self.hmacDigest = hmacDigest
+		self.key = key
+		self.version = version
+		self.flags = flags
+	
+	def read(self):
+		"""
+		Return raw segment data - IV and encrypted group, or chunks
+		"""
+		with file(self.fname, "rb") as f:
+			f.seek(self.offset)
+			data = f.read(self.size)
+		
+		if len(data) != self.size:
+			raise IOError("Corrupted disk format - group segment truncated")
+		
+		return data
+
+class LazyGroups(collections.MutableMapping):
+	"""
+	Dict of group name -> PasswordGroup. Groups that are still only
+	in storage file segments are decrypted on first access.
+	
+	Mapping is used from GUI thread and from Trezor worker thread, so
+	its dicts are changed only under lock. Segment is decrypted under
+	the lock too, so that the storage file is not replaced while it is
+	read (see moveSegments).
+	"""
+	
+	def __init__(self, loadSegment, segments=None, loaded=None):
+		"""
+		@param loadSegment: function decrypting GroupSegment into
+			PasswordGroup
+		@param segments: dict group name -> GroupSegment
+		@param loaded: dict group name -> PasswordGroup
+		"""
+		self.loadSegment = loadSegment
+		self.segments = segments or {}
+		self.loaded = loaded or {}
+		self.lock = threading.RLock()
+	
+	def __getitem__(self, groupName):
+		with self.lock:
+			if groupName not in self.loaded:
+				segment = self.segments[groupName]
+				self.loaded[groupName] = self.loadSegment(segment)
+				del self.segments[groupName]
+			
+			return self.loaded[groupName]
+	
+	def __setitem__(self, groupName, group):
+		with self.lock:
+			self.segments.pop(groupName, None)
+			self.loaded[groupName] = group
+	
+	def __delitem__(self, groupName):
+		with self.lock:
+			if groupName in self.loaded:
+				del self.loaded[groupName]
+			else:
+				del self.segments[groupName]
+	
+	def __contains__(self, groupName):
+		with self.lock:
+			return groupName in self.loaded or groupName in self.segments
+	
+	def __iter__(self):
+		with self.lock:
+			groupNames = self.loaded.keys() + self.segments.keys()
+		return iter(groupNames)
+	
+	def __len__(self):
+		with self.lock:
+			return len(self.loaded) + len(self.segments)
+	
+	def isLoaded(self, groupName):
+		"""
+		Return True if group is already decrypted in memory
+		"""
+		with self.lock:
+			return groupName in self.loaded
+	
+	def segment(self, groupName):
+		"""
+		Return GroupSegment of group not loaded yet, None otherwise
+		"""
+		with self.lock:
+			return self.segments.get(groupName)
+	
+	def snapshot(self, loadSegment):
+		"""
+		Return LazyGroups with copies of loaded groups and the same
+		segments, which is not affected by later changes of this one.
+		GroupSegments are never changed, so they are shared.
+		"""
+		with self.lock:
+			return LazyGroups(loadSegment, segments=dict(self.segments),
+				loaded=dict((groupName, group.copy())
+					for groupName, group in self.loaded.iteritems()))
+	
+	def moveSegments(self, movedSegments, replaceFile):
+		"""
+		Call replaceFile, which replaces storage file by a new one, and
+		point segments of groups still not loaded into the new file.
+		Both happen under lock, so no segment is read from a file it
+		does not point into.
+		
+		@param movedSegments: dict group name -> GroupSegment in new file
+		"""
+		with self.lock:
+			replaceFile()
+			for groupName, segment in movedSegments.iteritems():
+				#group may have been loaded or removed meanwhile
+				if groupName in self.segments:
+					self.segments[groupName] = segment
+
+class JournalState(object):
+	"""
+	State of a version 2/3 storage file that journal records are
+	appended to.
+	"""
+	
+	def __init__(self, fname, key, version, flags, snapshotEnd, end, lastDigest):
+		"""
+		@param fname: storage file name
+		@param key: outer key of the file
+		@param version: storage version of the file
+		@param flags: flags in file header
+		@param snapshotEnd: offset where index ends and journal starts
+		@param end: offset where next record will be appended
+		@param lastDigest: HMAC of last record or of index
+		"""
+		self.fname = fname
+		self.key = key
+		self.version = version
+		self.flags = flags
+		self.snapshotEnd = snapshotEnd
+		self.end = end
+		self.lastDigest = lastDigest
+		self.fileStat = self.statFile()
+	
+	def statFile(self):
+		st = os.stat(self.fname)
+		return (st.st_size, st.st_mtime)
+	
+	def journalSize(self):
+		return self.end - self.snapshotEnd
+	
+	def canAppend(self, fname, key, version, flags):
+		"""
+		Return True if records can be appended to fname: it's the same
+		file with the same key, version, chunking and compression and
+		nobody else changed it since.
+		
+		@param flags: header flags the file would be written with
+		"""
+		if os.path.realpath(fname) != os.path.realpath(self.fname) or \
+			key != self.key or version != self.version or \
+			flags != self.flags & ~FLAG_JOURNAL:
+			return False
+		try:
+			return self.statFile() == self.fileStat and self.fileStat[0] == self.end
+		except OSError:
+			return False
 
 class PasswordMap(object):
-	"""Storage of groups of passwords in memory"""
+	"""
+	Storage of groups of passwords in memory.
+	
+	Groups and entries should be changed only through methods of this
+	class, so that changes are recorded for journal.
+	"""
 	
 	def __init__(self, trezor):
 		assert trezor is not None
-		self.groups = {}
+		self.groups = LazyGroups(self.loadSegment)
 		self.trezor = trezor
 		self.outerKey = None # outer AES-CBC key
-		self.outerIv = None  # IV for data blob encrypted with outerKey
+		self.outerIv = None  # IV for version 1 data blob encrypted with outerKey
+		self.wrappedOuterKey = None # (outer key, outer key wrapped by Trezor) reused by saves
 		self.backupKey = None
+		self.journaled = True # append changes to journal on save if possible
+		self.chunked = False  # write version 2/3 group segments in chunks
+		self.compression = None # "zlib" or "lzma" compression of version 2/3 data
+		self.compressionLevel = DEFAULT_COMPRESSION_LEVEL
+		self.journal = None   # JournalState of loaded/saved file
+		self.pendingOps = []  # operations not saved yet
+		self.groupKeys = {}   # unlocked group keys by group name
+		self.savedDataKeys = 0 # count of backup data keys written to file
+		self.searchIndex = None # SearchIndex updated by recorded operations
+		self.deferReplace = False # leave written file for finishSave, see snapshot
+		self.replacement = None # arguments of installFile left by deferred save
+		self.takenOps = []    # operations moved here by snapshot
 	
-	def addGroup(self, groupName):
+	def addGroup(self, groupName, groupKey=None):
 		"""
 		Add group by name as utf-8 encoded string
+		
+		@param groupKey: tuple (key, wrapped key) from newGroupKey to
+			encrypt passwords of group with, so that one Trezor
+			confirmation unlocks whole group
+		"""
+		self.record(("addGroup", groupName))
+		if groupKey is not None:
+			self.useGroupKey(groupName, groupKey)
+	
+	def useGroupKey(self, groupName, groupKey):
+		"""
+		Set group key of group and make it unlocked. Entries already in
+		the group must be re-encrypted, see reencryptGroup.
+		
+		@param groupKey: tuple (key, wrapped key) from newGroupKey
 		"""
-		groupName = groupName
-		if groupName in self.groups:
-			raise KeyError("Password group already exists")
+		key, wrappedKey = groupKey
+		self.record(("setGroupKey", groupName, wrappedKey))
+		self.groupKeys[groupName] = key
+	
+	def newGroupKey(self, groupName):
+		"""
+		Generate new group key and wrap it with Trezor under the group name.
 		
-		self.groups[groupName] = PasswordGroup()
+		@returns tuple (key, wrapped key)
+		"""
+		key = Random.new().read(KEYSIZE)
+		return key, self.wrapGroupKey(key, groupName)
+	
+	def convertToGroupKey(self, groupName):
+		"""
+		Switch group to group key mode, re-encrypting its entries. Each
+		entry is decrypted by Trezor, so this costs one confirmation
+		per entry once.
+		"""
+		if self.hasGroupKey(groupName):
+			return
+		passwords = self.decryptGroup(groupName)
+		self.reencryptGroup(groupName, self.newGroupKey(groupName), passwords)
+	
+	def decryptGroup(self, groupName):
+		"""
+		Return decrypted passwords of all entries of group in order
+		"""
+		return [self.decryptPassword(encPw, groupName)
+			for _, encPw, _ in self.groups[groupName].entries]
+	
+	def reencryptGroup(self, groupName, groupKey, passwords):
+		"""
+		Switch group to group key, encrypting its passwords with it.
+		Does not need Trezor.
+		
+		@param groupKey: tuple (key, wrapped key) from newGroupKey
+		@param passwords: decrypted passwords of all entries in order
+		"""
+		group = self.groups[groupName]
+		self.useGroupKey(groupName, groupKey)
+		for idx, password in enumerate(passwords):
+			key, _, bkupPw = group.entry(idx)
+			self.updateEntry(groupName, idx, key, self.encryptPassword(password, groupName), bkupPw)
+	
+	def hasGroupKey(self, groupName):
+		"""
+		Return True if passwords of group are encrypted with group key
+		"""
+		return self.groups[groupName].wrappedKey is not None
+	
+	def unlockGroup(self, groupName):
+		"""
+		Return group key, unlocking it with Trezor if not done yet.
+		"""
+		key = self.groupKeys.get(groupName)
+		if key is None:
+			key = self.unwrapGroupKey(self.groups[groupName].wrappedKey, groupName)
+			self.groupKeys[groupName] = key
+		return key
+	
+	def lockGroups(self):
+		"""
+		Forget unlocked group keys, next access needs Trezor again.
+		Backup data key of this session is forgotten too.
+		"""
+		self.groupKeys.clear()
+		if self.backupKey is not None:
+			self.backupKey.forgetSessionKey()
+	
+	def removeGroup(self, groupName):
+		"""
+		Remove group with all its entries
+		"""
+		self.record(("removeGroup", groupName))
+	
+	def addEntry(self, groupName, key, encryptedValue, backupValue):
+		"""
+		Add key-value-backup entry to group
+		"""
+		self.record(("addEntry", groupName, key, encryptedValue, backupValue))
+	
+	def updateEntry(self, groupName, idx, key, encryptedValue, backupValue):
+		"""
+		Update entry at index idx of group
+		"""
+		self.record(("updateEntry", groupName, idx, key, encryptedValue, backupValue))
+	
+	def removeEntry(self, groupName, idx):
+		"""
+		Remove entry at index idx of group
+		"""
+		self.record(("removeEntry", groupName, idx))
+	
+	def storageFlags(self):
+		"""
+		@returns header flags of version 2/3 file written by save,
+			without FLAG_JOURNAL
+		"""
+		flags = FLAG_CHUNKED if self.chunked else 0
+		if self.compression is not None:
+			flags |= COMPRESSION_FLAGS[self.compression]
+		return flags
+	
+	def record(self, op):
+		"""
+		Apply operation and remember it for journal. Updates search
+		index if there is one.
+		"""
+		replacedKey = None
+		if self.searchIndex is not None and op[0] in ("updateEntry", "removeEntry"):
+			replacedKey = self.groups[op[1]].keys[op[2]]
+		self.applyOperation(op)
+		self.pendingOps.append(op)
+		if self.searchIndex is not None:
+			self.searchIndex.operationApplied(op, replacedKey)
+	
+	def applyOperation(self, op):
+		"""
+		Apply operation tuple (name, groupName, args...) to groups.
+		
+		@throws KeyError: if adding existing group or group does not exist
+		"""
+		name, groupName, args = op[0], op[1], op[2:]
+		if name == "addGroup":
+			if groupName in self.groups:
+				raise KeyError("Password group already exists")
+			self.groups[groupName] = PasswordGroup()
+		elif name == "removeGroup":
+			del self.groups[groupName]
+			self.groupKeys.pop(groupName, None)
+		elif name == "addEntry":
+			self.groups[groupName].addEntry(*args)
+		elif name == "updateEntry":
+			self.groups[groupName].updateEntry(*args)
+		elif name == "removeEntry":
+			self.groups[groupName].removeEntry(*args)
+		elif name == "setGroupKey":
+			self.groups[groupName].wrappedKey = args[0]
+			self.groupKeys.pop(groupName, None)
+		elif name == "addBackupDataKey":
+			self.backupKey.wrappedDataKeys.append(args[0])
+		else:
+			raise IOError("Corrupted disk format - unknown journal operation")
 
 	def load(self, fname):
 		"""
 		Load encrypted passwords from disk file, decrypt outer
 		layer containing key names. Requires Trezor connected.
 		
+		Groups stored in version 2/3 files are decrypted only on first
+		access, so the file must stay in place until then.
+		
+		Encrypted data are read from memory-mapped file and verified
+		and decrypted in one pass, so only decrypted data take memory.
+		
 		@throws IOError: if reading file failed
 		"""
-		with file(fname) as f:
-			header = f.read(len(Magic.headerStr))
-			if header != Magic.headerStr:
-				raise IOError("Bad header in storage file")
-			version = f.read(4)
-			if len(version) != 4 or struct.unpack("!I", version)[0] != 1:
-				raise IOError("Unknown version of storage file")
-			wrappedKey = f.read(KEYSIZE)
-			if len(wrappedKey) != KEYSIZE:
-				raise IOError("Corrupted disk format - bad wrapped key length")
-			
-			self.outerKey = self.unwrapKey(wrappedKey)
-			
-			self.outerIv = f.read(BLOCKSIZE)
-			if len(self.outerIv) != BLOCKSIZE:
-				raise IOError("Corrupted disk format - bad IV length")
-			
-			lb = f.read(2)
-			if len(lb) != 2:
-				raise IOError("Corrupted disk format - bad backup key length")
-			lb = struct.unpack("!H", lb)[0]
-			
-			self.backupKey = Backup(self.trezor)
-			serializedBackup = f.read(lb)
-			if len(serializedBackup) != lb:
-				raise IOError("Corrupted disk format - not enough encrypted backup key bytes")
-			self.backupKey.deserialize(serializedBackup)
+		self.journal = None
+		self.pendingOps = []
+		
+		with file(fname, "rb") as f:
+			version = self.readHeader(f)
+			if version in (2, 3):
+				self.readStorageV2(f, fname, version)
+				return
 			
+			offset, size, hmacDigest = self.readStorageV1(f)
+			mapped = mapFile(f)
+		
+		try:
+			digest, serialized = decryptMapped(mapped, offset, size,
+				self.outerKey, self.outerIv)
+		finally:
+			mapped.close()
+		if not macEquals(hmacDigest, digest):
+			raise IOError("Corrupted disk format - HMAC does not match or bad passphrase")
+		self.groups = LazyGroups(self.loadSegment, loaded=self.deserialize(serialized))
+	
+	def readHeader(self, f):
+		"""
+		Read magic header and storage version.
+		
+		@returns storage version
+		@throws IOError: if header is bad or version unknown
+		"""
+		header = f.read(len(Magic.headerStr))
+		if header != Magic.headerStr:
+			raise IOError("Bad header in storage file")
+		version = f.read(4)
+		if len(version) != 4 or struct.unpack("!I", version)[0] not in (1, 2, 3):
+			raise IOError("Unknown version of storage file")
+		
+		return struct.unpack("!I", version)[0]
+	
+	def readOuterKey(self, f):
+		"""
+		Read wrapped outer key and unwrap it with Trezor.
+		"""
+		wrappedKey = f.read(KEYSIZE)
+		if len(wrappedKey) != KEYSIZE:
+			raise IOError("Corrupted disk format - bad wrapped key length")
+		
+		self.outerKey = self.unwrapKey(wrappedKey)
+		self.wrappedOuterKey = (self.outerKey, wrappedKey)
+	
+	def readBackupKey(self, f, pickled):
+		"""
+		Read serialized backup key.
+		
+		@param pickled: backup key is pickled (storage version < 3)
+		"""
+		lb = f.read(2)
+		if len(lb) != 2:
+			raise IOError("Corrupted disk format - bad backup key length")
+		lb = struct.unpack("!H", lb)[0]
+		
+		self.backupKey = Backup(self.trezor)
+		serializedBackup = f.read(lb)
+		if len(serializedBackup) != lb:
+			raise IOError("Corrupted disk format - not enough encrypted backup key bytes")
+		self.backupKey.deserialize(serializedBackup, pickled)
+		self.savedDataKeys = len(self.backupKey.wrappedDataKeys)
+	
+	def readStorageV1(self, f):
+		"""
+		Read rest of version 1 storage file, unwrap outer key and
+		backup key. Encrypted data blob is skipped, not read.
+		
+		@returns tuple (offset of encrypted data blob, its size, its
+			HMAC digest)
+		@throws IOError: if reading file failed
+		"""
+		self.readOuterKey(f)
+		
+		self.outerIv = f.read(BLOCKSIZE)
+		if len(self.outerIv) != BLOCKSIZE:
+			raise IOError("Corrupted disk format - bad IV length")
+		
+		self.readBackupKey(f, True)
+		
+		ls = f.read(4)
+		if len(ls) != 4:
+			raise IOError("Corrupted disk format - bad data length")
+		l = struct.unpack("!I", ls)[0]
+		
+		offset = f.tell()
+		if os.fstat(f.fileno()).st_size < offset + l + MACSIZE:
+			raise IOError("Corrupted disk format - not enough data bytes")
+		f.seek(offset + l)
+		
+		hmacDigest = f.read(MACSIZE)
+		if len(hmacDigest) != MACSIZE:
+			raise IOError("Corrupted disk format - HMAC not complete")
+		
+		return offset, l, hmacDigest
+	
+	def readStorageV2(self, f, fname, version):
+		"""
+		Read rest of version 2/3 storage file, unwrap outer key and
+		backup key, decrypt index of group segments and replay journal.
+		
+		@throws IOError: if reading file failed
+		"""
+		flags = f.read(4)
+		if len(flags) != 4:
+			raise IOError("Corrupted disk format - bad flags length")
+		flags = struct.unpack("!I", flags)[0]
+		if flags & ~KNOWN_FLAGS:
+			raise IOError("Storage file uses features unknown to this version")
+		
+		self.readOuterKey(f)
+		self.readBackupKey(f, version < 3)
+		self.chunked = bool(flags & FLAG_CHUNKED)
+		self.compression = None
+		for compression, flag in COMPRESSION_FLAGS.iteritems():
+			if flags & flag:
+				self.compression = compression
+		
+		lo = f.read(8)
+		if len(lo) != 8:
+			raise IOError("Corrupted disk format - bad index offset")
+		f.seek(struct.unpack("!Q", lo)[0])
+		
+		ls = f.read(4)
+		if len(ls) != 4:
+			raise IOError("Corrupted disk format - bad index length")
+		l = struct.unpack("!I", ls)[0]
+		
+		indexData = f.read(l)
+		if len(indexData) != l or l < BLOCKSIZE:
+			raise IOError("Corrupted disk format - not enough index bytes")
+		
+		hmacDigest = f.read(MACSIZE)
+		if len(hmacDigest) != MACSIZE:
+			raise IOError("Corrupted disk format - HMAC not complete")
+		
+		self.verifyOuterMac(indexData, hmacDigest)
+		iv, encrypted = indexData[:BLOCKSIZE], indexData[BLOCKSIZE:]
+		serializedIndex = decompressPayload(self.decryptOuter(encrypted, iv), flags)
+		index = self.decodeIndex(serializedIndex, version)
+		
+		segments = {}
+		for groupName, offset, size, segmentDigest in index:
+			segments[groupName] = GroupSegment(fname, offset, size,
+				segmentDigest, self.outerKey, version, flags & SEGMENT_FLAGS)
+		
+		self.groups = LazyGroups(self.loadSegment, segments=segments)
+		
+		snapshotEnd = f.tell()
+		lastDigest = hmacDigest
+		if flags & FLAG_JOURNAL:
+			lastDigest = self.replayJournal(f, hmacDigest, version, flags)
+			self.savedDataKeys = len(self.backupKey.wrappedDataKeys)
+		self.journal = JournalState(fname, self.outerKey, version, flags,
+			snapshotEnd, f.tell(), lastDigest)
+	
+	def replayJournal(self, f, lastDigest, version, flags=0):
+		"""
+		Read journal records and apply their operations. Stops before
+		incompletely written record, leaving f positioned there.
+		
+		@param lastDigest: HMAC of the index
+		@param version: storage version
+		@param flags: header flags of the file
+		@returns HMAC of last applied record
+		@throws IOError: if record is corrupted
+		"""
+		while True:
+			recordStart = f.tell()
 			ls = f.read(4)
-			if len(ls) != 4:
-				raise IOError("Corrupted disk format - bad data length")
-			l = struct.unpack("!I", ls)[0]
-			
-			encrypted = f.read(l)
-			if len(encrypted) != l:
-				raise IOError("Corrupted disk format - not enough data bytes")
-			
+			l = len(ls) == 4 and struct.unpack("!I", ls)[0] or 0
+			data = f.read(l)
 			hmacDigest = f.read(MACSIZE)
-			if len(hmacDigest) != MACSIZE:
-				raise IOError("Corrupted disk format - HMAC not complete")
+			if l < BLOCKSIZE or len(data) != l or len(hmacDigest) != MACSIZE:
+				f.seek(recordStart)
+				return lastDigest
 			
-			#time-invariant HMAC comparison that also works with python 2.6
-			newHmacDigest = hmac.new(self.outerKey, encrypted, hashlib.sha256).digest()
-			hmacCompare = 0
-			for (ch1, ch2) in zip(hmacDigest, newHmacDigest):
-				hmacCompare |= int(ch1 != ch2)
-			if hmacCompare != 0:
-				raise IOError("Corrupted disk format - HMAC does not match or bad passphrase")
-				
-			serialized = self.decryptOuter(encrypted, self.outerIv)
-			self.groups = cPickle.loads(serialized)
+			if not macEquals(hmacDigest, self.outerMac(lastDigest + data)):
+				raise IOError("Corrupted disk format - journal HMAC does not match")
+			
+			iv, encrypted = data[:BLOCKSIZE], data[BLOCKSIZE:]
+			serializedOps = decompressPayload(self.decryptOuter(encrypted, iv), flags)
+			for op in self.decodeOperations(serializedOps, version):
+				self.applyOperation(op)
+			lastDigest = hmacDigest
 	
-	def save(self, fname):
+	def loadSegment(self, segment):
 		"""
-		Write password database to disk, encrypt it. Requires Trezor
-		connected.
+		Read, verify and decrypt group segment from memory-mapped
+		storage file. Columns of decoded group are buffers over the
+		decrypted segment, not copies. Chunks of chunked segment are
+		decrypted in parallel.
 		
-		@throws IOError: if writing file failed
+		@returns PasswordGroup
+		@throws IOError: if segment is corrupted
+		"""
+		with file(segment.fname, "rb") as f:
+			mapped = mapFile(f)
+		try:
+			if segment.flags & FLAG_CHUNKED:
+				digest, serialized = decryptChunked(mapped, segment.offset,
+					segment.size, segment.key)
+			else:
+				digest, serialized = decryptMapped(mapped, segment.offset,
+					segment.size, segment.key)
+		finally:
+			mapped.close()
+		if not macEquals(segment.hmacDigest, digest):
+			raise IOError("Corrupted disk format - group HMAC does not match")
+		serialized = decompressPayload(serialized, segment.flags)
+		
+		if segment.version < 3:
+			return cPickle.load(cStringIO.StringIO(serialized))
+		
+		group = PasswordGroup()
+		group.deserialize(serialized)
+		return group
+	
+	def encryptSegment(self, group, version):
+		"""
+		Compress group if self.compression is set and encrypt it with
+		self.outerKey, in chunks if self.chunked.
+		
+		@param version: storage version determining encoding
+		@returns tuple (segment data, its HMAC digest)
+		"""
+		if version < 3:
+			serialized = cPickle.dumps(group, cPickle.HIGHEST_PROTOCOL)
+		else:
+			serialized = group.serialize()
+		serialized = compressPayload(serialized, self.compression, self.compressionLevel)
+		if self.chunked:
+			return encryptChunked(serialized, self.outerKey)
+		iv = Random.new().read(BLOCKSIZE)
+		data = iv + self.encryptOuter(serialized, iv)
+		return data, self.outerMac(data)
+	
+	def encodeIndex(self, index, version):
+		"""
+		Encode list of (group name, offset, size, HMAC) of segments
+		"""
+		if version < 3:
+			return cPickle.dumps(index, cPickle.HIGHEST_PROTOCOL)
+		
+		encoder = Encoder()
+		encoder.uint8(INDEX_ENCODING_VERSION)
+		encoder.uint32(len(index))
+		for groupName, offset, size, segmentDigest in index:
+			encoder.string(groupName)
+			encoder.uint64(offset)
+			encoder.uint32(size)
+			encoder.raw(segmentDigest)
+		return encoder.getvalue()
+	
+	def decodeIndex(self, serialized, version):
+		"""
+		Decode index encoded by encodeIndex
+		
+		@throws IOError: if encoding is corrupted or unknown
+		"""
+		if version < 3:
+			return cPickle.loads(serialized)
+		
+		decoder = Decoder(serialized)
+		if decoder.uint8() != INDEX_ENCODING_VERSION:
+			raise IOError("Unknown encoding version of index")
+		index = []
+		for _ in xrange(decoder.uint32()):
+			index.append((decoder.string(), decoder.uint64(),
+				decoder.uint32(), decoder.raw(MACSIZE)))
+		decoder.expectEnd()
+		return index
+	
+	def encodeOperations(self, ops, version):
+		"""
+		Encode list of journal operations
+		"""
+		if version < 3:
+			return cPickle.dumps(ops, cPickle.HIGHEST_PROTOCOL)
+		
+		encoder = Encoder()
+		encoder.uint8(OPS_ENCODING_VERSION)
+		encoder.uint32(len(ops))
+		for op in ops:
+			encoder.uint8(OPERATIONS.index(op[0]))
+			encoder.string(op[1])
+			args = op[2:]
+			if op[0] in ("updateEntry", "removeEntry"):
+				encoder.uint32(args[0])
+				args = args[1:]
+			for arg in args:
+				encoder.string(arg)
+		return encoder.getvalue()
+	
+	def decodeOperations(self, serialized, version):
+		"""
+		Decode journal operations encoded by encodeOperations
+		
+		@throws IOError: if encoding is corrupted or unknown
+		"""
+		if version < 3:
+			return cPickle.loads(serialized)
+		
+		decoder = Decoder(serialized)
+		if decoder.uint8() != OPS_ENCODING_VERSION:
+			raise IOError("Unknown encoding version of journal")
+		ops = []
+		for _ in xrange(decoder.uint32()):
+			code = decoder.uint8()
+			if code >= len(OPERATIONS):
+				raise IOError("Corrupted disk format - unknown journal operation")
+			name = OPERATIONS[code]
+			op = [name, decoder.string()]
+			if name in ("updateEntry", "removeEntry"):
+				op.append(decoder.uint32())
+			if name in ("addEntry", "updateEntry"):
+				op.extend(decoder.string() for _ in range(3))
+			if name in ("setGroupKey", "addBackupDataKey"):
+				op.append(decoder.string())
+			ops.append(tuple(op))
+		decoder.expectEnd()
+		return ops
+	
+	def verifyOuterMac(self, encrypted, hmacDigest):
+		"""
+		Check HMAC of encrypted data blob.
+		
+		@throws IOError: if HMAC does not match
+		"""
+		if not macEquals(hmacDigest, self.outerMac(encrypted)):
+			raise IOError("Corrupted disk format - HMAC does not match or bad passphrase")
+	
+	def outerMac(self, encrypted):
+		"""
+		Compute HMAC-SHA256 of data blob with self.outerKey
+		"""
+		return hmac.new(self.outerKey, encrypted, hashlib.sha256).digest()
+	
+	def serialize(self):
+		"""
+		Return password groups as serialized string, decrypts all
+		segments.
+		"""
+		return cPickle.dumps(dict(self.groups.items()), cPickle.HIGHEST_PROTOCOL)
+	
+	def deserialize(self, serialized):
+		"""
+		Return password groups from serialized string or buffer
+		"""
+		return cPickle.load(cStringIO.StringIO(serialized))
+	
+	def save(self, fname, version=STORAGE_VERSION, wrappedKey=None):
+		"""
+		Write password database to disk, encrypt it. Outer key is
+		wrapped by Trezor only if it was not wrapped yet in this session
+		(see wrapOuterKey) and wrappedKey is not given.
+		
+		Changes are appended to journal of version 2/3 file if it was
+		loaded from or saved to fname, unless journal grows too large.
+		
+		@param version: storage version to write
+		@param wrappedKey: outer key wrapped by wrapKey, so that saving
+			does not talk to Trezor
+		@throws IOError: if writing file failed, or version 1 is asked
+			for with backup data keys
 		"""
 		assert len(self.outerKey) == KEYSIZE
+		#symlinked database stays a symlink, its target is replaced
+		fname = os.path.realpath(fname)
+		if version == 1 and self.backupKey.wrappedDataKeys:
+			raise IOError("Storage version 1 cannot hold backup data keys, use version 2 or 3")
+		
+		if version in (2, 3) and self.journaled and self.journal is not None and \
+			self.journal.canAppend(fname, self.outerKey, version, self.storageFlags()):
+			self.journalDataKeys()
+			if not self.pendingOps:
+				return
+			if self.appendJournal():
+				return
+		
+		if wrappedKey is None:
+			wrappedKey = self.wrapOuterKey()
+		self.pendingOps = []
+		self.journal = None
+		self.savedDataKeys = len(self.backupKey.wrappedDataKeys)
+		
+		if version in (2, 3):
+			self.writeStorageV2(fname, wrappedKey, version)
+			return
+		
 		rnd = Random.new()
 		self.outerIv = rnd.read(BLOCKSIZE)
-		wrappedKey = self.wrapKey(self.outerKey)
+		serialized = self.serialize()
+		encrypted = self.encryptOuter(serialized, self.outerIv)
+		hmacDigest = self.outerMac(encrypted)
+		
+		self.writeStorageV1(fname, wrappedKey, encrypted, hmacDigest)
+	
+	def writeStorageV1(self, fname, wrappedKey, encrypted, hmacDigest):
+		"""
+		Write version 1 storage file with already encrypted data blob.
 		
+		@throws IOError: if writing file failed
+		"""
 		with file(fname, "wb") as f:
 			version = 1
 			f.write(Magic.headerStr)
 			f.write(struct.pack("!I", version))
 			f.write(wrappedKey)
 			f.write(self.outerIv)
-			serialized = cPickle.dumps(self.groups, cPickle.HIGHEST_PROTOCOL)
-			encrypted = self.encryptOuter(serialized, self.outerIv)
-			
-			hmacDigest = hmac.new(self.outerKey, encrypted, hashlib.sha256).digest()
-			serializedBackup = self.backupKey.serialize()
+			serializedBackup = self.backupKey.serialize(pickled=True)
 			lb = struct.pack("!H", len(serializedBackup))
 			f.write(lb)
 			f.write(serializedBackup)
@@ -170,7 +1310,190 @@ class PasswordMap(object):
 			
 			f.flush()
 			f.close()
+	
+	def writeStorageV2(self, fname, wrappedKey, version):
+		"""
+		Write version 2/3 storage file. Groups that were not accessed
+		since load are copied without decryption if outer key, version,
+		chunking and compression did not change. File is written under temporary name
+		and renamed over fname, since segments may be still read from
+		fname. Renaming is left to finishSave if deferReplace is set.
+		
+		@throws IOError: if writing file failed
+		"""
+		movedSegments = {} #segments of all groups in the new file
+		flags = self.storageFlags()
+		
+		tmpName, f = openTempFile(fname)
+		with f:
+			f.write(Magic.headerStr)
+			f.write(struct.pack("!I", version))
+			f.write(struct.pack("!I", flags))
+			f.write(wrappedKey)
+			serializedBackup = self.backupKey.serialize(pickled=version < 3)
+			f.write(struct.pack("!H", len(serializedBackup)))
+			f.write(serializedBackup)
+			indexOffsetPos = f.tell()
+			f.write(struct.pack("!Q", 0))
+			
+			index = []
+			for groupName in sorted(self.groups.keys()):
+				segment = self.groups.segment(groupName)
+				if segment is not None and segment.key == self.outerKey and \
+					segment.version == version and segment.flags == flags:
+					data, segmentDigest = segment.read(), segment.hmacDigest
+				elif segment is not None:
+					data, segmentDigest = self.encryptSegment(self.loadSegment(segment), version)
+				else:
+					data, segmentDigest = self.encryptSegment(self.groups[groupName], version)
+				
+				offset = f.tell()
+				f.write(data)
+				index.append((groupName, offset, len(data), segmentDigest))
+				#group loaded in snapshot may be still a segment in the
+				#map the snapshot was taken from
+				movedSegments[groupName] = GroupSegment(fname, offset,
+					len(data), segmentDigest, self.outerKey, version, flags)
+			
+			indexOffset = f.tell()
+			iv = Random.new().read(BLOCKSIZE)
+			serializedIndex = compressPayload(self.encodeIndex(index, version),
+				self.compression, self.compressionLevel)
+			indexData = iv + self.encryptOuter(serializedIndex, iv)
+			f.write(struct.pack("!I", len(indexData)))
+			f.write(indexData)
+			indexDigest = self.outerMac(indexData)
+			f.write(indexDigest)
+			snapshotEnd = f.tell()
 			
+			f.seek(indexOffsetPos)
+			f.write(struct.pack("!Q", indexOffset))
+			f.flush()
+			os.fsync(f.fileno())
+		
+		replacement = (tmpName, fname, movedSegments, version, flags, snapshotEnd, indexDigest)
+		if self.deferReplace:
+			self.replacement = replacement
+		else:
+			self.installFile(*replacement)
+	
+	def installFile(self, tmpName, fname, movedSegments, version, flags, snapshotEnd, indexDigest):
+		"""
+		Rename file written by writeStorageV2 over fname and point
+		segments of groups not loaded yet into it.
+		
+		@param movedSegments: dict group name -> GroupSegment in new file
+		"""
+		self.groups.moveSegments(movedSegments, lambda: replaceFile(tmpName, fname))
+		self.journal = JournalState(fname, self.outerKey, version, flags,
+			snapshotEnd, snapshotEnd, indexDigest)
+	
+	def snapshot(self):
+		"""
+		Copy of password map to be saved in another thread while this
+		one is used and changed. Loaded groups are copied, groups still
+		in file segments are not read. Pending operations are moved to
+		the copy.
+		
+		After save of the copy, finishSave (or abortSave if it failed)
+		must be called with it in the thread that changes this map. That
+		also renames the written file, so that segments of this map are
+		never read from a file they do not point into.
+		
+		@returns PasswordMap that saves without Trezor if outer key was
+			already wrapped
+		"""
+		snapshot = PasswordMap(self.trezor)
+		snapshot.outerKey = self.outerKey
+		snapshot.outerIv = self.outerIv
+		snapshot.wrappedOuterKey = self.wrappedOuterKey
+		snapshot.backupKey = copy.copy(self.backupKey)
+		snapshot.backupKey.wrappedDataKeys = list(self.backupKey.wrappedDataKeys)
+		snapshot.journaled = self.journaled
+		snapshot.chunked = self.chunked
+		snapshot.compression = self.compression
+		snapshot.compressionLevel = self.compressionLevel
+		snapshot.journal = copy.copy(self.journal)
+		snapshot.savedDataKeys = self.savedDataKeys
+		snapshot.groups = self.groups.snapshot(snapshot.loadSegment)
+		snapshot.pendingOps = self.pendingOps
+		snapshot.takenOps = list(self.pendingOps)
+		snapshot.deferReplace = True
+		self.pendingOps = []
+		return snapshot
+	
+	def finishSave(self, snapshot):
+		"""
+		Take over file written by save of snapshot.
+		
+		@throws IOError: if written file could not be renamed
+		"""
+		if snapshot.replacement is not None:
+			try:
+				self.installFile(*snapshot.replacement)
+			except OSError, e:
+				self.abortSave(snapshot)
+				raise IOError("Could not replace database file: " + str(e))
+		else:
+			self.journal = snapshot.journal
+		self.outerIv = snapshot.outerIv
+		self.wrappedOuterKey = snapshot.wrappedOuterKey
+		self.savedDataKeys = snapshot.savedDataKeys
+	
+	def abortSave(self, snapshot):
+		"""
+		Return operations taken by failed save of snapshot to pending
+		operations, so that next save writes them.
+		"""
+		self.pendingOps[:0] = snapshot.takenOps
+	
+	def journalDataKeys(self):
+		"""
+		Add backup data keys created since the file was written to
+		pending operations, so they are journaled with entries using them.
+		"""
+		wrappedDataKeys = self.backupKey.wrappedDataKeys
+		for wrappedDataKey in wrappedDataKeys[self.savedDataKeys:]:
+			self.pendingOps.append(("addBackupDataKey", "", wrappedDataKey))
+		self.savedDataKeys = len(wrappedDataKeys)
+	
+	def appendJournal(self):
+		"""
+		Append pending operations as one record to journal of
+		self.journal file.
+		
+		@returns False if journal is too large and should be compacted
+		@throws IOError: if writing file failed
+		"""
+		journal = self.journal
+		iv = Random.new().read(BLOCKSIZE)
+		serializedOps = compressPayload(self.encodeOperations(self.pendingOps, journal.version),
+			self.compression, self.compressionLevel)
+		data = iv + self.encryptOuter(serializedOps, iv)
+		hmacDigest = self.outerMac(journal.lastDigest + data)
+		record = struct.pack("!I", len(data)) + data + hmacDigest
+		
+		journalSize = journal.journalSize() + len(record)
+		if journalSize > max(JOURNAL_COMPACT_MIN, journal.snapshotEnd / JOURNAL_COMPACT_RATIO):
+			return False
+		
+		with file(journal.fname, "r+b") as f:
+			if not journal.flags & FLAG_JOURNAL:
+				journal.flags |= FLAG_JOURNAL
+				f.seek(FLAGS_OFFSET)
+				f.write(struct.pack("!I", journal.flags))
+			f.seek(journal.end)
+			f.write(record)
+			f.flush()
+			os.fsync(f.fileno())
+		
+		journal.end += len(record)
+		journal.lastDigest = hmacDigest
+		journal.fileStat = journal.statFile()
+		self.pendingOps = []
+		
+		return True
+	
 	def encryptOuter(self, plaintext, iv):
 		"""
 		Pad and encrypt with self.outerKey
@@ -213,31 +1536,129 @@ class PasswordMap(object):
 		"""
 		ret = self.trezor.encrypt_keyvalue(Magic.unlockNode, Magic.unlockKey, keyToWrap, ask_on_encrypt=False, ask_on_decrypt=True)
 		return ret
+	
+	def wrapOuterKey(self):
+		"""
+		Wrap outer key by Trezor once, later calls return the same
+		wrapped key until outer key changes.
+		"""
+		if self.wrappedOuterKey is None or self.wrappedOuterKey[0] != self.outerKey:
+			self.wrappedOuterKey = (self.outerKey, self.wrapKey(self.outerKey))
+		return self.wrappedOuterKey[1]
 		
+	def wrapGroupKey(self, groupKey, groupName):
+		"""
+		Encrypt group key with Trezor under group name, so that
+		unlocking it shows the group name like decrypting a password.
+		"""
+		ugroup = groupName.decode("utf-8")
+		return self.trezor.encrypt_keyvalue(Magic.groupNode, ugroup, groupKey, ask_on_encrypt=False, ask_on_decrypt=True)
+	
+	def unwrapGroupKey(self, wrappedKey, groupName):
+		"""
+		Decrypt group key wrapped by wrapGroupKey using Trezor.
+		"""
+		ugroup = groupName.decode("utf-8")
+		return self.trezor.decrypt_keyvalue(Magic.groupNode, ugroup, wrappedKey, ask_on_encrypt=False, ask_on_decrypt=True)
+	
 	def encryptPassword(self, password, groupName):
 		"""
 		Encrypt a password. Does PKCS#5 padding before encryption.
-		Store IV as first block.
+		Store IV as first block. Uses group key instead of Trezor if
+		group has one.
 		
 		@param groupName key that will be shown to user on Trezor and
 			used to encrypt the password. A string in utf-8
 		"""
 		rnd = Random.new()
 		rndBlock = rnd.read(BLOCKSIZE)
+		if self.hasGroupKey(groupName):
+			return rndBlock + self.encrypt(password, rndBlock, self.unlockGroup(groupName))
+		
 		padded = Padding(BLOCKSIZE).pad(password)
 		ugroup = groupName.decode("utf-8")
 		ret = rndBlock + self.trezor.encrypt_keyvalue(Magic.groupNode, ugroup, padded, ask_on_encrypt=False, ask_on_decrypt=True, iv=rndBlock)
 		return ret
 		
+	def encryptPasswords(self, passwords, groupName, groupKey=None):
+		"""
+		Encrypt passwords of one group, result is the same as calling
+		encryptPassword for each of them. Without group key, padded
+		passwords are concatenated and encrypted by Trezor in one call
+		per MAX_CIPHER_VALUE bytes. Thanks to CBC chaining, IV of each
+		password is the last ciphertext block before it, so every
+		password decrypts on its own with decryptPassword.
+		
+		@param passwords: list of passwords as strings
+		@param groupName: group name as utf-8 string
+		@param groupKey: key to encrypt with instead of key of the
+			group, for group that is not added yet
+		@returns list of encrypted passwords
+		"""
+		if groupKey is None and groupName in self.groups and self.hasGroupKey(groupName):
+			groupKey = self.unlockGroup(groupName)
+		if groupKey is not None:
+			rnd = Random.new()
+			encrypted = []
+			for password in passwords:
+				iv = rnd.read(BLOCKSIZE)
+				encrypted.append(iv + self.encrypt(password, iv, groupKey))
+			return encrypted
+		
+		return self.encryptPasswordsByTrezor(passwords, groupName)
+	
+	def encryptPasswordsByTrezor(self, passwords, groupName):
+		"""
+		Encrypt passwords by Trezor under group name in batches, see
+		encryptPasswords. Group key of the group is not used, so this
+		works for group that is replaced by a new one without group
+		key.
+		
+		@returns list of encrypted passwords
+		"""
+		padding = Padding(BLOCKSIZE)
+		ugroup = groupName.decode("utf-8")
+		encrypted = []
+		batch = []
+		
+		def flush():
+			iv = Random.new().read(BLOCKSIZE)
+			ciphertext = self.trezor.encrypt_keyvalue(Magic.groupNode, ugroup, "".join(batch), ask_on_encrypt=False, ask_on_decrypt=True, iv=iv)
+			offset = 0
+			for padded in batch:
+				end = offset + len(padded)
+				encrypted.append(iv + ciphertext[offset:end])
+				iv = ciphertext[end-BLOCKSIZE:end]
+				offset = end
+			del batch[:]
+		
+		batchSize = 0
+		for password in passwords:
+			padded = padding.pad(password)
+			if batch and batchSize + len(padded) > MAX_CIPHER_VALUE:
+				flush()
+				batchSize = 0
+			batch.append(padded)
+			batchSize += len(padded)
+		
+		if batch:
+			flush()
+		
+		return encrypted
+		
 	def decryptPassword(self, encryptedPassword, groupName):
 		"""
 		Decrypt a password. First block is IV. After decryption strips PKCS#5 padding.
+		Uses group key instead of Trezor if group has one.
 		
 		@param groupName key that will be shown to user on Trezor and
 			was used to encrypt the password. A string in utf-8.
 		"""
-		ugroup = groupName.decode("utf-8")
 		iv, encryptedPassword = encryptedPassword[:BLOCKSIZE], encryptedPassword[BLOCKSIZE:]
+		if self.hasGroupKey(groupName):
+			return self.decrypt(encryptedPassword, iv, self.unlockGroup(groupName))
+		
+		ugroup = groupName.decode("utf-8")
 		plain = self.trezor.decrypt_keyvalue(Magic.groupNode, ugroup, encryptedPassword, ask_on_encrypt=False, ask_on_decrypt=True, iv=iv)
 		password = Padding(BLOCKSIZE).unpad(plain)
 		return password
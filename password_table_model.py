@@ -0,0 +1,187 @@
+from PyQt4 import QtCore
+
+from qt_encoding import s2q
+
+class PasswordTableModel(QtCore.QAbstractTableModel):
+	"""
+	Table of keys and passwords of one group, read directly from its
+	PasswordGroup. Rows are produced only when the view asks for them.
+	Sorting by key keeps a permutation of entry indexes, entries in
+	the group stay in their order.
+
+	Passwords are shown for revealed entries only and are read from
+	password cache, an expired password is hidden again. If cache is
+	disabled, revealed passwords are kept until group is changed or
+	passwords are hidden.
+	"""
+
+	KEY_IDX = 0 #column where key is shown
+	PASSWORD_IDX = 1 #column where password is shown
+	HIDDEN = "*****"
+
+	def __init__(self, passwordCache, parent=None):
+		"""
+		@param passwordCache: PasswordCache with decrypted passwords
+		"""
+		QtCore.QAbstractTableModel.__init__(self, parent)
+		self.passwordCache = passwordCache
+		self.groupName = None
+		self.group = None #PasswordGroup shown
+		self.order = None #entry index by row when sorted by key
+		self.descending = False
+		self.revealed = {} #password to show by encrypted password, None if cached
+
+	def setGroup(self, groupName, group):
+		"""
+		Show entries of group, None shows empty table.
+
+		@param group: PasswordGroup
+		"""
+		self.beginResetModel()
+		self.groupName = groupName
+		self.group = group
+		self.revealed.clear()
+		if self.order is not None:
+			self.order = self.sortedOrder()
+		self.endResetModel()
+
+	def rowCount(self, parent=QtCore.QModelIndex()):
+		if parent.isValid() or self.group is None:
+			return 0
+		return len(self.group.keys)
+
+	def columnCount(self, parent=QtCore.QModelIndex()):
+		if parent.isValid():
+			return 0
+		return 2
+
+	def data(self, index, role=QtCore.Qt.DisplayRole):
+		if role != QtCore.Qt.DisplayRole or not index.isValid():
+			return QtCore.QVariant()
+
+		idx = self.entryIndex(index.row())
+		if index.column() == self.KEY_IDX:
+			return QtCore.QVariant(s2q(self.group.keys[idx]))
+
+		encPw = self.group.values[idx]
+		if encPw in self.revealed:
+			password = self.revealed[encPw] or self.passwordCache.get(self.groupName, encPw)
+			if password is not None:
+				return QtCore.QVariant(s2q(password))
+		return QtCore.QVariant(self.HIDDEN)
+
+	def headerData(self, section, orientation, role=QtCore.Qt.DisplayRole):
+		if role != QtCore.Qt.DisplayRole or orientation != QtCore.Qt.Horizontal:
+			return QtCore.QVariant()
+		return QtCore.QVariant("Key" if section == self.KEY_IDX else "Value")
+
+	def sort(self, column, order=QtCore.Qt.AscendingOrder):
+		"""
+		Sort rows by key, sorting by password column restores order
+		of entries in group.
+		"""
+		self.layoutAboutToBeChanged.emit()
+		if column == self.KEY_IDX:
+			self.descending = order == QtCore.Qt.DescendingOrder
+			self.order = self.sortedOrder()
+		else:
+			self.order = None
+		self.layoutChanged.emit()
+
+	def sortedOrder(self):
+		"""
+		@returns entry indexes ordered by key
+		"""
+		if self.group is None:
+			return []
+		keys = self.group.keys
+		return sorted(xrange(len(keys)), key=keys.__getitem__, reverse=self.descending)
+
+	def entryIndex(self, row):
+		"""
+		@returns index of entry in group shown in row
+		"""
+		if self.order is None:
+			return row
+		return self.order[row]
+
+	def rowOfEntry(self, idx):
+		"""
+		@returns row where entry with given index in group is shown
+		"""
+		if self.order is None:
+			return idx
+		return self.order.index(idx)
+
+	def sortedRow(self, key):
+		"""
+		@returns row where entry with key belongs when sorted
+		"""
+		keys = self.group.keys
+		low, high = 0, len(self.order)
+		while low < high:
+			mid = (low + high) // 2
+			before = keys[self.order[mid]] > key if self.descending else keys[self.order[mid]] < key
+			if before:
+				low = mid + 1
+			else:
+				high = mid
+		return low
+
+	def entryAdded(self):
+		"""
+		Show entry appended to group.
+		"""
+		idx = len(self.group.keys) - 1
+		row = idx if self.order is None else self.sortedRow(self.group.keys[idx])
+		self.beginInsertRows(QtCore.QModelIndex(), row, row)
+		if self.order is not None:
+			self.order.insert(row, idx)
+		self.endInsertRows()
+
+	def removeEntry(self, idx, removeFromGroup):
+		"""
+		Remove row of entry. Entry is removed from group by calling
+		removeFromGroup() between beginRemoveRows and endRemoveRows,
+		so views never see row count that does not match the group.
+		"""
+		row = self.rowOfEntry(idx)
+		self.revealed.pop(self.group.values[idx], None)
+		self.beginRemoveRows(QtCore.QModelIndex(), row, row)
+		removeFromGroup()
+		if self.order is not None:
+			del self.order[row]
+			self.order = [i - 1 if i > idx else i for i in self.order]
+		self.endRemoveRows()
+
+	def entryChanged(self, idx):
+		"""
+		Show updated entry, moving it if its key changed order.
+		"""
+		if self.order is not None:
+			self.sort(self.KEY_IDX, QtCore.Qt.DescendingOrder if self.descending
+				else QtCore.Qt.AscendingOrder)
+		row = self.rowOfEntry(idx)
+		self.dataChanged.emit(self.index(row, self.KEY_IDX), self.index(row, self.PASSWORD_IDX))
+
+	def revealPassword(self, encPw, password):
+		"""
+		Show password of entry with given encrypted password.
+		"""
+		cached = self.passwordCache.maxEntries > 0
+		self.revealed[encPw] = None if cached else password
+		for idx, value in enumerate(self.group.values):
+			if value == encPw:
+				row = self.rowOfEntry(idx)
+				self.dataChanged.emit(self.index(row, self.PASSWORD_IDX),
+					self.index(row, self.PASSWORD_IDX))
+				break
+
+	def hidePasswords(self):
+		"""
+		Hide all shown passwords.
+		"""
+		self.revealed.clear()
+		if self.rowCount() > 0:
+			self.dataChanged.emit(self.index(0, self.PASSWORD_IDX),
+				self.index(self.rowCount() - 1, self.PASSWORD_IDX))
@@ -0,0 +1,254 @@
+"""
+Timing of hot paths - Trezor calls, loading and saving phases, backup
+RSA operations and filling of Qt models - enabled by --profile.
+
+Methods are timed by wrappers installed into their classes only when
+profiling is enabled, so nothing is added to calls when it is off.
+Report has count, total, mean and maximum time and latency histogram
+of every timed method, it is written on exit and on SIGUSR1.
+"""
+import sys
+import time
+import atexit
+import signal
+import threading
+import functools
+
+#upper bounds of histogram buckets in seconds, last bucket is unbounded
+HISTOGRAM_BOUNDS = (0.001, 0.003, 0.01, 0.03, 0.1, 0.3, 1.0, 3.0, 10.0)
+HISTOGRAM_LABELS = ("1ms", "3ms", "10ms", "30ms", "100ms", "300ms", "1s", "3s", "10s", ">10s")
+TRACEMALLOC_FRAMES = 10 #traceback depth of allocation snapshots
+TRACEMALLOC_TOP = 15 #allocation sites in report
+
+#methods timed by enableCore, by module name
+CORE_METHODS = {
+	"password_map": {
+		"PasswordMap": ["load", "readStorageV1", "readStorageV2", "replayJournal",
+			"loadSegment", "deserialize", "save", "serialize", "writeStorageV1",
+			"writeStorageV2", "appendJournal", "encryptSegment", "encryptPasswords",
+			"decryptPassword", "unlockGroup", "newGroupKey"],
+	},
+	"backup": {
+		"Backup": ["generate", "unwrapPrivateKey", "addDataKey", "encryptPassword"],
+		"BackupDecryptor": ["dataKey", "decrypt"],
+	},
+	"search_index": {
+		"SearchIndex": ["build", "search"],
+	},
+}
+
+#Trezor client methods timed per key string, which is group name for
+#passwords and group keys
+TREZOR_METHODS = ["encrypt_keyvalue", "decrypt_keyvalue"]
+TREZOR_SESSION_METHODS = ["clear_session"]
+
+class Stat(object):
+	"""
+	Count, total and maximum time and latency histogram of one timed
+	operation.
+	"""
+
+	__slots__ = ("count", "total", "maximum", "buckets")
+
+	def __init__(self):
+		self.count = 0
+		self.total = 0.0
+		self.maximum = 0.0
+		self.buckets = [0] * (len(HISTOGRAM_BOUNDS) + 1)
+
+	def add(self, seconds):
+		self.count += 1
+		self.total += seconds
+		self.maximum = max(self.maximum, seconds)
+		bucket = 0
+		while bucket < len(HISTOGRAM_BOUNDS) and seconds > HISTOGRAM_BOUNDS[bucket]:
+			bucket += 1
+		self.buckets[bucket] += 1
+
+class Profiler(object):
+	"""
+	Collects times of wrapped methods from all threads.
+	"""
+
+	def __init__(self):
+		self.stats = {} #Stat by operation name
+		self.lock = threading.Lock()
+		self.wrapped = [] #(class, method name, original attribute or None)
+		self.started = time.time()
+		self.tracemalloc = None #module if allocations are traced
+
+	def record(self, name, seconds):
+		with self.lock:
+			stat = self.stats.get(name)
+			if stat is None:
+				stat = self.stats[name] = Stat()
+			stat.add(seconds)
+
+	def wrap(self, cls, methodName, detail=None):
+		"""
+		Time calls of method of class under name "Class.method".
+
+		@param detail: function returning text appended to the name
+			from call arguments (including self), e.g. group name
+		"""
+		original = getattr(cls, methodName)
+		name = "%s.%s" % (cls.__name__, methodName)
+		record = self.record
+
+		@functools.wraps(original)
+		def timed(*args, **kwargs):
+			start = time.time()
+			try:
+				return original(*args, **kwargs)
+			finally:
+				seconds = time.time() - start
+				record(name if detail is None else "%s %s" % (name, detail(args)), seconds)
+
+		self.wrapped.append((cls, methodName, cls.__dict__.get(methodName)))
+		setattr(cls, methodName, timed)
+
+	def unwrap(self):
+		"""
+		Restore wrapped methods in reverse order.
+		"""
+		for cls, methodName, original in reversed(self.wrapped):
+			if original is None:
+				delattr(cls, methodName)
+			else:
+				setattr(cls, methodName, original)
+		self.wrapped = []
+
+	def startTracemalloc(self):
+		"""
+		Trace memory allocations if tracemalloc module is available
+		(pytracemalloc on Python 2).
+
+		@returns False if tracemalloc is not available
+		"""
+		try:
+			import tracemalloc
+		except ImportError:
+			return False
+		tracemalloc.start(TRACEMALLOC_FRAMES)
+		self.tracemalloc = tracemalloc
+		return True
+
+	def report(self, f):
+		"""
+		Write table of timed operations sorted by total time, and top
+		allocation sites if memory is traced.
+		"""
+		with self.lock:
+			stats = sorted(self.stats.iteritems(), key=lambda item: -item[1].total)
+
+		f.write("Profile after %.1f s\n" % (time.time() - self.started))
+		f.write("%-64s %8s %10s %10s %10s  %s\n" % ("operation", "count", "total s",
+			"mean ms", "max ms", " ".join("%5s" % label for label in HISTOGRAM_LABELS)))
+		for name, stat in stats:
+			f.write("%-64s %8d %10.3f %10.2f %10.2f  %s\n" % (name[:64], stat.count, stat.total,
+				1000 * stat.total / stat.count, 1000 * stat.maximum,
+				" ".join("%5d" % n for n in stat.buckets)))
+
+		if self.tracemalloc is not None:
+			snapshot = self.tracemalloc.take_snapshot()
+			current, peak = self.tracemalloc.get_traced_memory()
+			f.write("Traced memory %.1f MiB, peak %.1f MiB, top allocation sites:\n" %
+				(current / 1048576.0, peak / 1048576.0))
+			for stat in snapshot.statistics("lineno")[:TRACEMALLOC_TOP]:
+				f.write("  %s\n" % stat)
+		f.flush()
+
+#Profiler when profiling is enabled, None otherwise
+profiler = None
+
+def enable(output=None, traceMemory=False):
+	"""
+	Start profiling. Report is written to output file (appended) or
+	stderr on exit and on SIGUSR1.
+
+	@param output: file name of report, None for stderr
+	@param traceMemory: include tracemalloc snapshot in report
+	@returns Profiler
+	"""
+	global profiler
+	if profiler is not None:
+		return profiler
+	profiler = Profiler()
+	if traceMemory and not profiler.startTracemalloc():
+		print >> sys.stderr, "tracemalloc is not available, memory is not traced"
+
+	atexit.register(writeReport, output)
+	if hasattr(signal, "SIGUSR1"):
+		signal.signal(signal.SIGUSR1, lambda signum, frame: writeReport(output))
+	return profiler
+
+def writeReport(output=None):
+	"""
+	Write report of enabled profiler to file name or stderr.
+	"""
+	if profiler is None:
+		return
+	if output is None:
+		profiler.report(sys.stderr)
+		return
+	with file(output, "a") as f:
+		profiler.report(f)
+
+def trezorKey(args):
+	"""
+	@returns key string of CipherKeyValue call - group name or name of
+		outer/backup key
+	"""
+	key = args[2] if len(args) > 2 else "?"
+	if isinstance(key, unicode):
+		key = key.encode("utf-8")
+	return key
+
+def enableCore(trezorClass):
+	"""
+	Time Trezor calls by operation and key, phases of PasswordMap load
+	and save, backup RSA operations and search index. Profiling must be
+	enabled.
+
+	@param trezorClass: class of Trezor client in use
+	"""
+	for moduleName, classes in CORE_METHODS.iteritems():
+		module = __import__(moduleName)
+		for className, methodNames in classes.iteritems():
+			for methodName in methodNames:
+				profiler.wrap(getattr(module, className), methodName)
+
+	for methodName in TREZOR_METHODS:
+		profiler.wrap(trezorClass, methodName, trezorKey)
+	for methodName in TREZOR_SESSION_METHODS:
+		if hasattr(trezorClass, methodName):
+			profiler.wrap(trezorClass, methodName)
+
+class StartupTimer(object):
+	"""
+	Times stages of startup, each from end of the previous one.
+	"""
+
+	def __init__(self, started=None):
+		"""
+		@param started: time.time() when startup began, now if None
+		"""
+		self.started = time.time() if started is None else started
+		self.last = self.started
+		self.stages = [] #(name, seconds of stage, seconds since start)
+		self.lock = threading.Lock()
+
+	def stage(self, name):
+		"""
+		Record end of stage named name, may be called from any thread.
+		"""
+		with self.lock:
+			now = time.time()
+			self.stages.append((name, now - self.last, now - self.started))
+			self.last = now
+
+	def report(self, f):
+		f.write("%-40s %10s %10s\n" % ("startup stage", "stage ms", "total ms"))
+		for name, seconds, total in self.stages:
+			f.write("%-40s %10.1f %10.1f\n" % (name, 1000 * seconds, 1000 * total))
+		f.flush()
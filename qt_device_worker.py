@@ -0,0 +1,130 @@
+from PyQt4 import QtCore
+
+from device_worker import DeviceWorker, DeviceRequest
+
+class GuiCaller(QtCore.QObject):
+	"""
+	Runs functions in GUI thread, blocking calling thread until they
+	return. Lets Trezor callbacks show PIN and passphrase dialogs while
+	worker thread talks to Trezor. May be created in any thread.
+	"""
+
+	requested = QtCore.pyqtSignal(object)
+
+	def __init__(self):
+		QtCore.QObject.__init__(self)
+		app = QtCore.QCoreApplication.instance()
+		if app is not None and self.thread() != app.thread():
+			self.moveToThread(app.thread())
+		self.requested.connect(self.runCall, QtCore.Qt.BlockingQueuedConnection)
+
+	def runCall(self, call):
+		try:
+			call["value"] = call["fn"](*call["args"])
+		except BaseException, e:
+			call["error"] = e
+
+	def __call__(self, fn, *args):
+		"""
+		Call fn(*args) in GUI thread and return its value.
+
+		@throws exception raised by fn
+		"""
+		if QtCore.QThread.currentThread() == self.thread():
+			return fn(*args)
+
+		call = {"fn": fn, "args": args}
+		self.requested.emit(call)
+		if "error" in call:
+			raise call["error"]
+		return call.get("value")
+
+class QtDeviceWorker(QtCore.QObject):
+	"""
+	DeviceWorker that delivers results of requests to callbacks in
+	GUI thread.
+	"""
+
+	requestDone = QtCore.pyqtSignal(object)
+	queueChanged = QtCore.pyqtSignal() #request was queued or finished
+
+	def __init__(self, parent=None):
+		QtCore.QObject.__init__(self, parent)
+		self.worker = DeviceWorker()
+		self.handlers = {} #callbacks of requests by request
+		self.errorHandler = None #called for errors of requests without onError
+		self.requestDone.connect(self.deliver, QtCore.Qt.QueuedConnection)
+		self.worker.start()
+
+	def submit(self, description, fn, args=(), onSuccess=None, onError=None):
+		"""
+		Queue call fn(*args) in worker thread.
+
+		@param description: text describing request for user
+		@param onSuccess: called with value returned by fn in GUI thread
+		@param onError: called with exception raised by fn in GUI thread,
+			self.errorHandler is used if not given
+		@returns DeviceRequest
+		"""
+		request = DeviceRequest(fn, args, description)
+		#handlers are known before the request can finish
+		self.handlers[request] = (onSuccess, onError)
+		self.worker.submitRequest(request, self.requestDone.emit)
+		self.queueChanged.emit()
+		return request
+
+	def deliver(self, request):
+		onSuccess, onError = self.handlers.pop(request, (None, None))
+		self.queueChanged.emit()
+		if request.cancelled():
+			return
+
+		if request.error is not None:
+			handler = onError or self.errorHandler
+			if handler is not None:
+				handler(request.error)
+		elif onSuccess is not None:
+			onSuccess(request.value)
+
+	def pending(self):
+		"""
+		@returns list of requests that are queued or running
+		"""
+		return self.worker.pending()
+
+	def cancelPending(self):
+		"""
+		Cancel requests not sent to Trezor yet
+		"""
+		self.worker.cancelPending()
+
+class ProgressRelay(QtCore.QObject):
+	"""
+	Delivers progress reported by a request running in worker thread
+	to GUI thread: pass progressed.emit as progress callback.
+	"""
+
+	progressed = QtCore.pyqtSignal(int, int) #done, total
+
+class QtBackgroundTask(QtCore.QThread):
+	"""
+	Runs fn(*args, progress=...) in its own thread. Progress callback
+	and result are delivered as signals to GUI thread. SystemExit of
+	cancelled dialogs is delivered as error too.
+	"""
+
+	progressed = QtCore.pyqtSignal(int, int) #done, total
+	taskDone = QtCore.pyqtSignal(object, object) #value, exception or None
+
+	def __init__(self, fn, args=(), parent=None):
+		QtCore.QThread.__init__(self, parent)
+		self.fn = fn
+		self.args = args
+
+	def run(self):
+		try:
+			value = self.fn(*self.args, progress=self.progressed.emit)
+		except BaseException, e:
+			self.taskDone.emit(None, e)
+		else:
+			self.taskDone.emit(value, None)
@@ -0,0 +1,90 @@
+"""
+Trezor client and chooser asking for PIN, passphrase and device with
+Qt dialogs. Imports trezorlib and its protobuf messages, so the GUI
+imports this module only when connecting to Trezor.
+"""
+import sys
+
+from trezorlib.client import BaseClient, ProtocolMixin
+from trezorlib import messages_pb2 as proto
+
+from qt_encoding import q2s
+from qt_device_worker import GuiCaller
+from trezor_client import TrezorChooser
+from dialogs import TrezorPassphraseDialog, EnterPinDialog, TrezorChooserDialog
+
+class QtTrezorMixin(object):
+	"""
+	Mixin for input of passhprases. Client is used from worker thread,
+	so dialogs are shown through GuiCaller in GUI thread.
+	"""
+	
+	def __init__(self, *args, **kwargs):
+		super(QtTrezorMixin, self).__init__(*args, **kwargs)
+		self.passphrase = None
+		self.guiCaller = GuiCaller()
+	
+	def callback_ButtonRequest(self, msg):
+		return proto.ButtonAck()
+
+	def callback_PassphraseRequest(self, msg):
+		if self.passphrase is not None:
+			return proto.PassphraseAck(passphrase=self.passphrase)
+		
+		passphrase = self.guiCaller(self.askPassphrase)
+		return proto.PassphraseAck(passphrase=passphrase)
+	
+	def callback_PinMatrixRequest(self, msg):
+		pin = self.guiCaller(self.askPin)
+		return proto.PinMatrixAck(pin=pin)
+	
+	def askPassphrase(self):
+		dialog = TrezorPassphraseDialog()
+		if not dialog.exec_():
+			sys.exit(3)
+		
+		return unicode(dialog.passphraseEdit.text())
+	
+	def askPin(self):
+		dialog = EnterPinDialog()
+		if not dialog.exec_():
+			sys.exit(7)
+		
+		return q2s(dialog.pin())
+
+	def prefillPassphrase(self, passphrase):
+		"""
+		Instead of asking for passphrase, use this one
+		"""
+		self.passphrase = passphrase.decode("utf-8")
+
+class QtTrezorClient(ProtocolMixin, QtTrezorMixin, BaseClient):
+	"""
+	Trezor client with Qt input methods
+	"""
+	pass
+
+class QtTrezorChooser(TrezorChooser):
+	"""Chooses Trezor via HID, asks user with a dialog if more are connected"""
+	
+	clientClass = QtTrezorClient
+	
+	def chooseFromMap(self, deviceMap):
+		"""
+		Displays a widget with list of Trezor devices to choose from.
+		Chooser may run in background thread, dialog is shown in GUI
+		thread.
+		
+		@returns deviceId string of chosen Trezor
+		"""
+		return GuiCaller()(self.askDevice, deviceMap)
+	
+	def askDevice(self, deviceMap):
+		lastPath = None
+		if self.cache is not None:
+			lastPath = self.cache.pathOfLast(deviceMap.keys())
+		dialog = TrezorChooserDialog(deviceMap, lastPath)
+		if not dialog.exec_():
+			sys.exit(9)
+		
+		return dialog.chosenDeviceStr()
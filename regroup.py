@@ -0,0 +1,89 @@
+from export import exportGroups
+from importer import PasswordImport
+
+class GroupMove(PasswordImport):
+	"""
+	Entries of source groups encrypted under name of target group,
+	kept aside until commit() replaces source groups by target group
+	at once. Renaming is a move of one group, merging a move into
+	existing group and re-keying a move of group to its own name.
+
+	Works as row writer of exportGroups, which decrypts the entries
+	with backup key. Backup encrypted passwords do not depend on group
+	name, so they are kept as they are.
+	"""
+
+	def __init__(self, pwMap, sourceNames, targetName, groupKeys=True):
+		"""
+		@param sourceNames: names of groups to move, may include target
+		@param targetName: name of group entries are moved to, it is
+			created if it does not exist or is one of sources
+		@param groupKeys: create target group with group key
+		"""
+		PasswordImport.__init__(self, pwMap, groupKeys)
+		self.sourceNames = list(sourceNames)
+		self.targetName = targetName
+		#(group name, keys, backups) of sources, see export.snapshotGroups
+		self.snapshot = []
+		for groupName in self.sourceNames:
+			group = pwMap.groups[groupName]
+			self.snapshot.append((groupName, group.keys.copy(), group.backups.copy()))
+		self.backups = (backups[idx] for _, _, backups in self.snapshot
+			for idx in xrange(len(backups)))
+		#target exists even if sources have no entries
+		self.importGroup(targetName)
+
+	def isExisting(self, groupName):
+		return PasswordImport.isExisting(self, groupName) and groupName not in self.sourceNames
+
+	def writeRow(self, groupName, key, password):
+		"""
+		Add decrypted entry of source group to target, rows come in
+		order of snapshot.
+		"""
+		self.add(self.targetName, key, password, next(self.backups))
+
+	def commit(self):
+		"""
+		Remove source groups and add target group with moved entries.
+		Nothing is changed if a source group was changed or target
+		group was created or changed after entries were encrypted.
+
+		@returns number of moved entries
+		@throws KeyError: if groups of password map changed
+		"""
+		groups = self.pwMap.groups
+		for groupName, keys, backups in self.snapshot:
+			if groupName not in groups or list(groups[groupName].keys) != list(keys) or \
+				list(groups[groupName].backups) != list(backups):
+				raise KeyError("Password group was changed during move: " + groupName)
+		self.checkGroups()
+
+		for groupName in self.sourceNames:
+			self.pwMap.removeGroup(groupName)
+		return self.addToMap()
+
+def moveGroups(pwMap, sourceNames, targetName, privateKey, groupKeys=True, processes=None,
+	progress=None, cancelEvent=None):
+	"""
+	Decrypt entries of source groups with backup private key, so that
+	Trezor does not ask to confirm each of them, and encrypt them under
+	target group name. Decryption runs ahead in process pool if there
+	are many RSA encrypted passwords (see exportGroups), while batches
+	of decrypted passwords are encrypted by Trezor or with group key.
+	Password map is not changed until commit() of returned move is
+	called. Uses Trezor.
+
+	@param privateKey: unwrapped private RSA key of pwMap.backupKey
+	@param groupKeys: create target group with group key, encrypting
+		all passwords costs one Trezor call then
+	@param progress: function called with (entries moved, total entries)
+	@param cancelEvent: threading.Event, move stops when it is set
+	@returns GroupMove with all entries encrypted
+	@throws ExportCancelled: if cancelEvent was set
+	"""
+	move = GroupMove(pwMap, sourceNames, targetName, groupKeys)
+	exportGroups(move.snapshot, pwMap.backupKey, privateKey, move, processes=processes,
+		progress=progress, cancelEvent=cancelEvent)
+	move.flush()
+	return move
@@ -0,0 +1,282 @@
+from bisect import bisect_left, insort
+from collections import defaultdict
+
+DEFAULT_LIMIT = 50 #results returned by search
+FUZZY_MIN_SHARED = 0.2 #fraction of query trigrams a fuzzy candidate must contain
+FUZZY_MAX_POSTINGS = 5000 #more common trigrams do not tell similar texts apart
+FUZZY_MAX_CANDIDATES = 1000 #candidates sharing most trigrams checked by edit distance
+FUZZY_MAX_ERRORS = 0.25 #edits per query character allowed in similar text
+
+PREFIX, SUBSTRING, SIMILAR = range(3) #match classes, best first
+
+def normalize(s):
+	"""
+	@returns lowercase unicode of utf-8 string for case insensitive search
+	"""
+	return s.decode("utf-8", "replace").lower()
+
+def trigrams(text):
+	"""
+	@returns set of trigrams of normalized text
+	"""
+	return set(text[i:i+3] for i in xrange(len(text) - 2))
+
+def substringDistance(query, text):
+	"""
+	Edit distance of query to the most similar substring of text,
+	transposition of adjacent characters counts as one edit.
+	"""
+	m = len(query)
+	before = None #row for query[:i-2]
+	previous = range(m + 1) #row for query[:i-1] at text position j-1, here j=0
+	best = previous[m]
+	prevChar = None
+	for c in text:
+		#row of distances of query prefixes ending at this character,
+		#substring may start anywhere so empty prefix costs nothing
+		current = [0]
+		for i in xrange(1, m + 1):
+			cost = previous[i-1] + (query[i-1] != c)
+			cost = min(cost, previous[i] + 1, current[i-1] + 1)
+			if before is not None and i > 1 and query[i-1] == prevChar and query[i-2] == c:
+				cost = min(cost, before[i-2] + 1)
+			current.append(cost)
+		before, previous, prevChar = previous, current, c
+		best = min(best, current[m])
+	return best
+
+class SearchIndex(object):
+	"""
+	Index of group names and entry keys of all groups. Substrings of
+	three and more characters are looked up by trigrams, shorter
+	queries match prefixes from sorted list of texts. When there are
+	not enough substring matches, texts sharing most trigrams with the
+	query and differing from it in a few edits are added, so that typos
+	still find the entry.
+
+	Documents are (group name, key) pairs, key None stands for group
+	itself. Same key may be in group more times, document is removed
+	when its last entry is.
+	"""
+
+	def __init__(self):
+		self.docs = [] #(group name, key) by document id, None for removed
+		self.texts = [] #normalized text by document id
+		self.ids = {} #document id by (group name, key)
+		self.refs = [] #entries with the key by document id
+		self.grams = defaultdict(set) #document ids by trigram
+		self.sorted = [] #(text, document id) for prefix search
+		self.groupDocs = defaultdict(set) #document ids by group name
+		self.free = [] #ids of removed documents for reuse
+
+	def build(self, groups):
+		"""
+		Index all groups of password map.
+
+		@param groups: dict-like of PasswordGroup by group name
+		"""
+		for groupName in groups.keys():
+			self.addDoc(groupName, None, groupName, False)
+			for key in groups[groupName].keys:
+				self.addDoc(groupName, key, key, False)
+		self.sorted.sort()
+
+	def addDoc(self, groupName, key, text, keepSorted=True):
+		doc = (groupName, key)
+		docId = self.ids.get(doc)
+		if docId is not None:
+			self.refs[docId] += 1
+			return
+
+		text = normalize(text)
+		if self.free:
+			docId = self.free.pop()
+			self.docs[docId] = doc
+			self.texts[docId] = text
+			self.refs[docId] = 1
+		else:
+			docId = len(self.docs)
+			self.docs.append(doc)
+			self.texts.append(text)
+			self.refs.append(1)
+		self.ids[doc] = docId
+		self.groupDocs[groupName].add(docId)
+		grams = self.grams
+		for gram in trigrams(text):
+			grams[gram].add(docId)
+		if keepSorted:
+			insort(self.sorted, (text, docId))
+		else:
+			self.sorted.append((text, docId))
+
+	def removeDoc(self, groupName, key):
+		docId = self.ids.get((groupName, key))
+		if docId is None:
+			return
+		self.refs[docId] -= 1
+		if self.refs[docId] > 0:
+			return
+
+		text = self.texts[docId]
+		for gram in trigrams(text):
+			postings = self.grams[gram]
+			postings.discard(docId)
+			if not postings:
+				del self.grams[gram]
+		del self.sorted[bisect_left(self.sorted, (text, docId))]
+		groupDocs = self.groupDocs.get(groupName)
+		if groupDocs is not None:
+			groupDocs.discard(docId)
+			if not groupDocs:
+				del self.groupDocs[groupName]
+		del self.ids[(groupName, key)]
+		self.docs[docId] = None
+		self.texts[docId] = None
+		self.free.append(docId)
+
+	def addGroup(self, groupName):
+		self.addDoc(groupName, None, groupName)
+
+	def removeGroup(self, groupName):
+		"""
+		Remove group and all its keys from index
+		"""
+		for docId in list(self.groupDocs.pop(groupName, ())):
+			self.refs[docId] = 1
+			self.removeDoc(*self.docs[docId])
+
+	def addKey(self, groupName, key):
+		self.addDoc(groupName, key, key)
+
+	def removeKey(self, groupName, key):
+		self.removeDoc(groupName, key)
+
+	def operationApplied(self, op, replacedKey=None):
+		"""
+		Update index after password map operation.
+
+		@param op: operation tuple as in PasswordMap.applyOperation
+		@param replacedKey: key of entry updated or removed by op
+		"""
+		name, groupName = op[0], op[1]
+		if name == "addGroup":
+			self.addGroup(groupName)
+		elif name == "removeGroup":
+			self.removeGroup(groupName)
+		elif name == "addEntry":
+			self.addKey(groupName, op[2])
+		elif name == "updateEntry":
+			self.removeKey(groupName, replacedKey)
+			self.addKey(groupName, op[3])
+		elif name == "removeEntry":
+			self.removeKey(groupName, replacedKey)
+
+	def rank(self, query, text):
+		"""
+		@returns sort key of match not at the start of text, lower is better
+		"""
+		pos = text.find(query)
+		wordStart = not text[pos-1].isalnum()
+		return (not wordStart, len(text), text)
+
+	def search(self, query, limit=DEFAULT_LIMIT, similar=True):
+		"""
+		Find group names and keys containing query, case insensitive.
+
+		@param query: utf-8 string
+		@param similar: add texts similar to query if there are not
+			enough texts containing it
+		@returns list of (group name, key) best matches first, key is
+			None if group name matched
+		"""
+		return [doc for doc, matchClass in self.classifiedSearch(query, limit)
+			if similar or matchClass != SIMILAR]
+
+	def classifiedSearch(self, query, limit=DEFAULT_LIMIT):
+		"""
+		Find group names and keys containing query, case insensitive.
+		Texts starting with query come first, then other texts
+		containing it, then texts similar to it. Only first limit
+		matches found in each class are ranked, so that common queries
+		do not have to look at every match.
+
+		@param query: utf-8 string
+		@returns list of ((group name, key), match class) best matches
+			first, key is None if group name matched, match class is
+			PREFIX, SUBSTRING or SIMILAR
+		"""
+		query = normalize(query).strip()
+		if not query:
+			return []
+
+		result = [(docId, PREFIX) for docId in self.prefixMatches(query, limit)]
+		if len(query) < 3 or len(result) >= limit:
+			return [(self.docs[docId], matchClass) for docId, matchClass in result]
+
+		postings = sorted((self.grams.get(gram, ()) for gram in trigrams(query)), key=len)
+		found = set(docId for docId, _ in result)
+		if postings[0]:
+			matches = []
+			for docId in postings[0].intersection(*postings[1:]):
+				text = self.texts[docId]
+				if docId not in found and query in text:
+					matches.append((self.rank(query, text), docId))
+					if len(matches) >= limit - len(result):
+						break
+			matches.sort()
+			result.extend((docId, SUBSTRING) for _, docId in matches)
+			found.update(docId for _, docId in matches)
+
+		if len(result) < limit:
+			result.extend((docId, SIMILAR) for docId in
+				self.fuzzy(query, postings, found, limit - len(result)))
+
+		return [(self.docs[docId], matchClass) for docId, matchClass in result]
+
+	def prefixMatches(self, query, limit):
+		"""
+		@returns ids of at most limit documents starting with query,
+			exact match first
+		"""
+		start = bisect_left(self.sorted, (query,))
+		found = []
+		for text, docId in self.sorted[start:start+limit]:
+			if not text.startswith(query):
+				break
+			found.append((len(text), text, docId))
+		found.sort()
+		return [docId for _, _, docId in found]
+
+	def fuzzy(self, query, postings, exclude, limit):
+		"""
+		Candidates sharing most trigrams with query are checked by edit
+		distance, so that typos and swapped letters are found while
+		texts sharing only a few trigrams are not.
+
+		@param postings: document ids of each trigram of query
+		@returns ids of documents similar to query, closest first,
+			trigrams in more than FUZZY_MAX_POSTINGS documents are not
+			counted
+		"""
+		shared = defaultdict(int)
+		counted = 0
+		for docIds in postings:
+			if len(docIds) > FUZZY_MAX_POSTINGS:
+				continue
+			counted += 1
+			for docId in docIds:
+				shared[docId] += 1
+
+		minShared = max(1, int(counted * FUZZY_MIN_SHARED))
+		candidates = [(-count, len(self.texts[docId]), docId) for docId, count in shared.iteritems()
+			if count >= minShared and docId not in exclude]
+		candidates.sort()
+
+		maxErrors = max(1, int(len(query) * FUZZY_MAX_ERRORS))
+		found = []
+		for negCount, length, docId in candidates[:FUZZY_MAX_CANDIDATES]:
+			distance = substringDistance(query, self.texts[docId])
+			if distance <= maxErrors:
+				found.append((distance, negCount, length, docId))
+		found.sort()
+		return [docId for _, _, _, docId in found[:limit]]
@@ -0,0 +1,123 @@
+import sys
+import struct
+from array import array
+
+## Binary encoding primitives
+# Integers are in network order. Strings are prefixed by uint32 length.
+# Arrays of N strings are stored as N uint32 end offsets followed by
+# concatenated strings, so they can be split without per-item parsing.
+
+#array typecode of 4-byte unsigned int
+UINT32 = array("I").itemsize == 4 and "I" or "L"
+SWAP = sys.byteorder == "little"
+
+class Encoder(object):
+	"""
+	Builds binary encoded string from integers and strings.
+	"""
+
+	def __init__(self):
+		self.parts = []
+
+	def uint8(self, n):
+		self.parts.append(chr(n))
+
+	def uint32(self, n):
+		self.parts.append(struct.pack("!I", n))
+
+	def uint64(self, n):
+		self.parts.append(struct.pack("!Q", n))
+
+	def raw(self, s):
+		"""Append fixed-size string, decoder must know its length"""
+		self.parts.append(s)
+
+	def string(self, s):
+		self.parts.append(struct.pack("!I", len(s)))
+		self.parts.append(s)
+
+	def uint32Array(self, values):
+		a = array(UINT32, values)
+		if SWAP:
+			a.byteswap()
+		self.parts.append(a.tostring())
+
+	def stringArray(self, strings):
+		"""
+		Append strings as end offsets and concatenated data. Count
+		of strings is not stored.
+		"""
+		ends = []
+		appendEnd = ends.append
+		end = 0
+		for length in map(len, strings):
+			end += length
+			appendEnd(end)
+		self.uint32Array(ends)
+		self.parts.extend(strings)
+
+	def getvalue(self):
+		return "".join(self.parts)
+
+class Decoder(object):
+	"""
+	Reads integers and strings from binary encoded string or buffer.
+
+	Methods throw IOError if data is truncated.
+	"""
+
+	def __init__(self, data):
+		self.data = data
+		self.pos = 0
+
+	def raw(self, size):
+		"""Read fixed-size string"""
+		end = self.pos + size
+		if end > len(self.data):
+			raise IOError("Corrupted disk format - encoded data truncated")
+		s = self.data[self.pos:end]
+		self.pos = end
+		return s
+
+	def uint8(self):
+		return ord(self.raw(1))
+
+	def uint32(self):
+		return struct.unpack("!I", self.raw(4))[0]
+
+	def uint64(self):
+		return struct.unpack("!Q", self.raw(8))[0]
+
+	def string(self):
+		return self.raw(self.uint32())
+
+	def uint32Array(self, count):
+		a = array(UINT32)
+		a.fromstring(self.raw(4 * count))
+		if SWAP:
+			a.byteswap()
+		return a
+
+	def rawBuffer(self, size):
+		"""Read fixed-size data as buffer over decoded data, not a copy"""
+		end = self.pos + size
+		if end > len(self.data):
+			raise IOError("Corrupted disk format - encoded data truncated")
+		b = buffer(self.data, self.pos, size)
+		self.pos = end
+		return b
+
+	def stringArray(self, count):
+		"""
+		Read array of count strings.
+
+		@returns tuple (array of end offsets, concatenated data as
+			buffer over decoded data)
+		"""
+		ends = self.uint32Array(count)
+		size = count and ends[-1] or 0
+		return ends, self.rawBuffer(size)
+
+	def expectEnd(self):
+		if self.pos != len(self.data):
+			raise IOError("Corrupted disk format - trailing encoded data")
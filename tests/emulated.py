@@ -0,0 +1,65 @@
+"""
+Password maps backed by EmulatedTrezorClient for tests.
+"""
+from Crypto import Random
+
+import password_map
+from backup import Backup
+from trezor_emulator import EmulatedTrezorClient
+
+SEED = "test seed"
+
+_serializedBackup = [] #backup key generated once, RSA key generation is slow
+
+def emulatedTrezor():
+	return EmulatedTrezorClient(SEED)
+
+def newBackup(trezor):
+	"""
+	@returns Backup with the same RSA key pair each call, without data keys
+	"""
+	if not _serializedBackup:
+		backup = Backup(trezor)
+		backup.generate()
+		_serializedBackup.append(backup.serialize())
+	backup = Backup(trezor)
+	backup.deserialize(_serializedBackup[0])
+	return backup
+
+def newPasswordMap():
+	"""
+	@returns empty PasswordMap with backup key and outer key
+	"""
+	trezor = emulatedTrezor()
+	pwMap = password_map.PasswordMap(trezor)
+	pwMap.backupKey = newBackup(trezor)
+	pwMap.outerKey = Random.new().read(password_map.KEYSIZE)
+	return pwMap
+
+def loadPasswordMap(fname):
+	"""
+	@returns PasswordMap loaded from fname by new emulated Trezor
+	"""
+	pwMap = password_map.PasswordMap(emulatedTrezor())
+	pwMap.load(fname)
+	return pwMap
+
+def addPasswords(pwMap, groupName, count, prefix="pw"):
+	"""
+	Add group if missing and count entries to it, password of key
+	"keyN" is prefix followed by N.
+	"""
+	if groupName not in pwMap.groups:
+		pwMap.addGroup(groupName)
+	for i in range(count):
+		password = "%s%d" % (prefix, i)
+		pwMap.addEntry(groupName, "key%d" % i, pwMap.encryptPassword(password, groupName),
+			pwMap.backupKey.encryptPassword(password))
+
+def decryptedContents(pwMap):
+	"""
+	@returns dict group name -> list of (key, decrypted password)
+	"""
+	return dict((groupName, [(str(key), pwMap.decryptPassword(str(encPw), groupName))
+		for key, encPw, _ in pwMap.groups[groupName].entries])
+		for groupName in pwMap.groups)
@@ -0,0 +1,117 @@
+import cPickle
+import unittest
+
+from Crypto.Cipher import PKCS1_OAEP
+
+import export
+from backup import Backup
+from tests.emulated import emulatedTrezor, newBackup, newPasswordMap
+
+class ListRowWriter(object):
+	def __init__(self):
+		self.rows = []
+
+	def writeRow(self, groupName, key, password):
+		self.rows.append((groupName, str(key), password))
+
+def legacyEncrypt(backup, password):
+	"""
+	Encrypt password directly with RSA like versions before hybrid scheme
+	"""
+	return PKCS1_OAEP.new(backup.publicKey).encrypt(password)
+
+class BackupTest(unittest.TestCase):
+
+	def setUp(self):
+		self.backup = newBackup(emulatedTrezor())
+		self.privateKey = self.backup.unwrapPrivateKey()
+
+	def testHybridRoundTrip(self):
+		encrypted = self.backup.encryptPassword("secret")
+		self.assertEqual(len(self.backup.wrappedDataKeys), 1)
+		self.assertNotEqual(len(encrypted), Backup.RSA_KEYSIZE / 8)
+		self.assertEqual(self.backup.decryptPassword(encrypted, self.privateKey), "secret")
+
+	def testNewDataKeyAfterForget(self):
+		first = self.backup.encryptPassword("first")
+		self.backup.forgetSessionKey()
+		second = self.backup.encryptPassword("second")
+		self.assertEqual(len(self.backup.wrappedDataKeys), 2)
+		decryptor = self.backup.decryptor(self.privateKey)
+		self.assertEqual([decryptor.decrypt(first), decryptor.decrypt(second)], ["first", "second"])
+
+	def testLegacyAndHybridMixed(self):
+		encrypted = [legacyEncrypt(self.backup, "old"), self.backup.encryptPassword("new"),
+			legacyEncrypt(self.backup, "")]
+		decryptor = self.backup.decryptor(self.privateKey)
+		self.assertEqual(map(decryptor.decrypt, encrypted), ["old", "new", ""])
+
+	def testTamperedHybridRejected(self):
+		encrypted = self.backup.encryptPassword("secret")
+		tampered = encrypted[:-1] + chr(ord(encrypted[-1]) ^ 1)
+		self.assertRaises(ValueError, self.backup.decryptPassword, tampered, self.privateKey)
+		self.assertRaises(ValueError, self.backup.decryptPassword, "\x02" + encrypted[1:],
+			self.privateKey)
+
+	def testSerializationKeepsDataKeys(self):
+		encrypted = self.backup.encryptPassword("secret")
+		for pickled in (False, True):
+			restored = Backup(emulatedTrezor())
+			restored.deserialize(self.backup.serialize(pickled), pickled)
+			self.assertEqual(restored.wrappedDataKeys, self.backup.wrappedDataKeys)
+			self.assertEqual(restored.decryptPassword(encrypted, restored.unwrapPrivateKey()), "secret")
+
+	def testPickledWithoutDataKeys(self):
+		#form written by versions without hybrid scheme
+		legacy = cPickle.dumps((self.backup.ephemeralIv, self.backup.encryptedEphemeral,
+			self.backup.encryptedPrivate, self.backup.publicDer))
+		restored = Backup(emulatedTrezor())
+		restored.deserialize(legacy, True)
+		self.assertEqual(restored.wrappedDataKeys, [])
+		#written without data keys in the same form
+		self.assertEqual(cPickle.loads(self.backup.serialize(True)), cPickle.loads(legacy))
+
+	def testUnknownPickledFieldVersion(self):
+		fields = (self.backup.ephemeralIv, self.backup.encryptedEphemeral,
+			self.backup.encryptedPrivate, self.backup.publicDer, 99, [])
+		self.assertRaises(IOError, Backup(emulatedTrezor()).deserialize,
+			cPickle.dumps(fields), True)
+
+class ExportTest(unittest.TestCase):
+
+	def setUp(self):
+		self.pwMap = newPasswordMap()
+		self.expected = []
+		backup = self.pwMap.backupKey
+		for groupName in ("a", "b"):
+			self.pwMap.addGroup(groupName)
+			for i in range(6):
+				password = "%s%d" % (groupName, i)
+				if i % 2:
+					bkupPw = backup.encryptPassword(password)
+				else:
+					bkupPw = legacyEncrypt(backup, password)
+				self.pwMap.addEntry(groupName, "key%d" % i, "", bkupPw)
+				self.expected.append((groupName, "key%d" % i, password))
+			backup.forgetSessionKey()
+		self.privateKey = backup.unwrapPrivateKey()
+
+	def export(self, processes):
+		writer = ListRowWriter()
+		export.exportGroups(export.snapshotGroups(self.pwMap), self.pwMap.backupKey,
+			self.privateKey, writer, processes=processes)
+		return writer.rows
+
+	def testExportInProcess(self):
+		self.assertEqual(self.export(1), self.expected)
+
+	def testExportInPool(self):
+		parallelMin, batchSize = export.PARALLEL_MIN_ENTRIES, export.BATCH_SIZE
+		export.PARALLEL_MIN_ENTRIES, export.BATCH_SIZE = 1, 4
+		try:
+			self.assertEqual(self.export(2), self.expected)
+		finally:
+			export.PARALLEL_MIN_ENTRIES, export.BATCH_SIZE = parallelMin, batchSize
+
+if __name__ == "__main__":
+	unittest.main()
@@ -0,0 +1,92 @@
+import unittest
+
+from columns import StringColumn
+
+#operation sequences applied both to StringColumn and to a plain list
+OPERATIONS = [
+	[("append", "a"), ("append", ""), ("append", "ccc")],
+	[("append", "short"), ("set", 0, "much longer string"), ("set", 0, "")],
+	[("append", "x" * 10), ("append", "y"), ("del", 0), ("append", "z"), ("del", 1)],
+	#garbage outgrows half of buffer, compaction
+	[("append", "a" * 100), ("append", "b"), ("set", 0, "c"), ("set", 1, "d" * 50),
+		("del", 0), ("append", "e")],
+	[("append", "\x00\xff"), ("append", "p"), ("del", 1), ("del", 0), ("append", "q")],
+	[("append", str(i)) for i in range(50)] + [("del", 25), ("set", 10, "ten"), ("del", 0)],
+]
+
+def apply(target, op):
+	if op[0] == "append":
+		target.append(op[1])
+	elif op[0] == "set":
+		target[op[1]] = op[2]
+	else:
+		del target[op[1]]
+
+class StringColumnTest(unittest.TestCase):
+
+	def assertSame(self, column, expected, msg=None):
+		self.assertEqual(len(column), len(expected), msg)
+		self.assertEqual(list(column), expected, msg)
+		self.assertEqual([column[i] for i in range(len(column))], expected, msg)
+
+	def testOperations(self):
+		for operations in OPERATIONS:
+			column = StringColumn()
+			expected = []
+			for step, op in enumerate(operations):
+				apply(column, op)
+				apply(expected, op)
+				self.assertSame(column, expected, (operations, step))
+			self.assertTrue(column.garbage <= len(column.data) / 2 or column.garbage == 0)
+
+	def testOperationsOnSerializedColumn(self):
+		#buffer from serialized data is not a bytearray until changed
+		for operations in OPERATIONS:
+			initial = ["first", "", "third"]
+			ends, data = StringColumn.fromStrings(initial).ends()
+			column = StringColumn.fromEnds(ends, buffer(data))
+			self.assertSame(column, initial)
+			expected = list(initial)
+			for op in operations:
+				apply(column, op)
+				apply(expected, op)
+			self.assertSame(column, expected, operations)
+
+	def testEndsRoundTrip(self):
+		for operations in OPERATIONS:
+			column = StringColumn()
+			for op in operations:
+				apply(column, op)
+			ends, data = column.ends()
+			self.assertTrue(column.ordered)
+			self.assertEqual(column.garbage, 0)
+			self.assertSame(StringColumn.fromEnds(ends, data), list(column), operations)
+
+	def testEmpty(self):
+		self.assertSame(StringColumn.fromStrings([]), [])
+		ends, data = StringColumn().ends()
+		self.assertEqual((len(ends), data), (0, ""))
+
+	def testCopyIndependent(self):
+		for serialized in (False, True):
+			column = StringColumn.fromStrings(["a", "b", "c"])
+			if not serialized:
+				column.append("d")
+			copy = column.copy()
+			expected = list(column)
+			column[0] = "changed"
+			del column[1]
+			column.append("new")
+			self.assertSame(copy, expected)
+			copy.append("own")
+			self.assertEqual(list(column), ["changed", "c"] + expected[3:] + ["new"])
+
+	def testCompaction(self):
+		column = StringColumn.fromStrings(["a" * 100, "b"])
+		column[0] = "c"
+		self.assertEqual(column.garbage, 0) #garbage 100 of 102 bytes compacted
+		self.assertEqual(str(column.data), "cb") #strings in order
+		self.assertSame(column, ["c", "b"])
+
+if __name__ == "__main__":
+	unittest.main()
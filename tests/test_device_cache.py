@@ -0,0 +1,109 @@
+import unittest
+
+from device_cache import DeviceCache, NO_LABEL
+
+try:
+	from trezor_client import TrezorChooser
+except ImportError:
+	TrezorChooser = None
+
+class DeviceCacheTest(unittest.TestCase):
+
+	def setUp(self):
+		self.cache = DeviceCache({"p1": ("one", "id1"), "p2": ("two", "id2")}, "id2")
+
+	def testForget(self):
+		self.cache.forget(["p1", "p3"])
+		self.assertEqual(self.cache.devices, {"p2": ("two", "id2")})
+
+	def testKeepOnly(self):
+		self.cache.keepOnly(iter(["p2", "p3"]))
+		self.assertEqual(self.cache.devices, {"p2": ("two", "id2")})
+		self.cache.keepOnly([])
+		self.assertEqual(self.cache.devices, {})
+		self.assertEqual(self.cache.lastDeviceId, "id2")
+
+	def testPathOfLast(self):
+		self.assertEqual(self.cache.pathOfLast(["p1", "p2"]), "p2")
+		self.assertIsNone(self.cache.pathOfLast(["p1", "p3"]))
+		self.cache.lastDeviceId = None
+		self.assertIsNone(self.cache.pathOfLast(["p1", "p2"]))
+
+	def testJson(self):
+		restored = DeviceCache.fromJson(self.cache.toJson())
+		self.assertEqual(restored.devices, {"p1": (u"one", u"id1"), "p2": (u"two", u"id2")})
+		self.assertEqual(restored.lastDeviceId, "id2")
+		for invalid in ["", "[]", '{"devices": 1}', '{"devices": {"p1": "x"}}']:
+			restored = DeviceCache.fromJson(invalid)
+			self.assertEqual((restored.devices, restored.lastDeviceId), ({}, None))
+
+class Features(object):
+	def __init__(self, label, deviceId):
+		self.label = label
+		self.device_id = deviceId
+
+class FakeClient(object):
+	def __init__(self, transport):
+		self.features = Features(*transport)
+		self.closed = False
+
+	def close(self):
+		self.closed = True
+
+class FakeChooser(TrezorChooser or object):
+	"""
+	Chooser of devices given as dict path -> (label, device id),
+	chooses last chosen device or the first one.
+	"""
+	clientClass = FakeClient
+
+	def __init__(self, connected, cache):
+		TrezorChooser.__init__(self, cache=cache)
+		self.connected = connected
+
+	def enumerateHIDDevices(self):
+		return [[path, None] for path in sorted(self.connected)]
+
+	def chooseDevice(self, devices):
+		paths = [device[0] for device in devices]
+		self.chosenPath = self.cache.pathOfLast(paths) or paths[0]
+		return self.connected[self.chosenPath]
+
+@unittest.skipIf(TrezorChooser is None, "trezorlib not installed")
+class TrezorChooserTest(unittest.TestCase):
+
+	def testRevalidate(self):
+		cache = DeviceCache({"p1": ("one", "id1")})
+		chooser = FakeChooser({}, cache)
+		chooser.chosenPath = "p1"
+		self.assertTrue(chooser.revalidate(FakeClient(("renamed", "id1"))))
+		self.assertEqual(cache.devices["p1"], ("renamed", "id1"))
+		self.assertFalse(chooser.revalidate(FakeClient((None, "id3"))))
+		self.assertEqual(cache.devices["p1"], (NO_LABEL, "id3"))
+		chooser.chosenPath = "p2"
+		self.assertTrue(chooser.revalidate(FakeClient(("two", "id2"))))
+		self.assertEqual(cache.devices["p2"], ("two", "id2"))
+
+	def testSingleDevicePrunesCache(self):
+		cache = DeviceCache({"p1": ("one", "id1"), "p2": ("two", "id2")}, "id1")
+		client = FakeChooser({"p2": ("two", "id2")}, cache).getDevice()
+		self.assertEqual(client.features.device_id, "id2")
+		self.assertEqual(cache.devices, {"p2": ("two", "id2")})
+		self.assertEqual(cache.lastDeviceId, "id2")
+
+	def testStaleCacheChoosesAgain(self):
+		#another Trezor was plugged in at path of last chosen one
+		cache = DeviceCache({"p1": ("one", "id1"), "p2": ("two", "id2")}, "id2")
+		chooser = FakeChooser({"p1": ("one", "id1"), "p2": ("three", "id3")}, cache)
+		client = chooser.getDevice()
+		self.assertEqual(client.features.device_id, "id1")
+		self.assertEqual(cache.devices, {"p1": ("one", "id1")})
+		self.assertEqual(cache.lastDeviceId, "id1")
+
+	def testNoDevice(self):
+		cache = DeviceCache({"p1": ("one", "id1")}, "id1")
+		self.assertIsNone(FakeChooser({}, cache).getDevice())
+		self.assertEqual(cache.devices, {"p1": ("one", "id1")})
+
+if __name__ == "__main__":
+	unittest.main()
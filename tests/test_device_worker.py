@@ -0,0 +1,84 @@
+import threading
+import unittest
+
+from device_worker import DeviceWorker, DeviceRequest, RequestCancelled
+from trezor_emulator import EmulatedTrezorClient
+
+class DeviceWorkerTest(unittest.TestCase):
+
+	def setUp(self):
+		self.trezor = EmulatedTrezorClient("seed", latency=0.02)
+		self.worker = DeviceWorker()
+		self.worker.start()
+
+	def tearDown(self):
+		self.worker.stop(5)
+
+	def testRequestsRunInOrder(self):
+		order = []
+		requests = [self.worker.submit("call %d" % i, order.append, i) for i in range(20)]
+		for request in requests:
+			request.result(5)
+		self.assertEqual(order, range(20))
+		self.assertEqual(self.worker.pending(), [])
+
+	def testCallbackOfFastRequest(self):
+		#request may finish before submitRequest returns, callbacks
+		#must still run exactly once each
+		calls = []
+		lock = threading.Lock()
+
+		def onDone(request):
+			with lock:
+				calls.append((request.args[0], request in self.worker.pending()))
+
+		requests = [self.worker.submitRequest(DeviceRequest(lambda i: i, (i,), "fast"), onDone)
+			for i in range(200)]
+		for request in requests:
+			self.assertEqual(request.result(5), request.args[0])
+		self.assertEqual(sorted(calls), [(i, False) for i in range(200)])
+
+	def testCallbackAfterDoneRunsImmediately(self):
+		request = self.worker.submit("noop", lambda: None)
+		request.result(5)
+		called = []
+		request.addDoneCallback(called.append)
+		self.assertEqual(called, [request])
+
+	def testCallbacksSeeResult(self):
+		results = []
+		request = DeviceRequest(self.trezor.encrypt_keyvalue, ([], "key", "a" * 16), "encrypt")
+		request.addDoneCallback(lambda request: results.append(request.result(0)))
+		self.worker.submitRequest(request, lambda request: results.append(request.value))
+		encrypted = request.result(5)
+		self.assertEqual(results, [encrypted, encrypted])
+
+	def testErrorRaisedByResult(self):
+		def fail():
+			raise ValueError("broken")
+		request = self.worker.submit("fail", fail)
+		self.assertRaises(ValueError, request.result, 5)
+
+	def testCancelPending(self):
+		started, blocker = threading.Event(), threading.Event()
+
+		def block():
+			started.set()
+			return blocker.wait(5)
+
+		running = self.worker.submit("block", block)
+		started.wait(5)
+		cancelled = []
+		queued = self.worker.submitRequest(DeviceRequest(lambda: None, (), "queued"),
+			lambda request: cancelled.append(request.cancelled()))
+
+		self.worker.cancelPending()
+		self.assertEqual(cancelled, [True])
+		self.assertRaises(RequestCancelled, queued.result, 0)
+		self.assertFalse(running.cancelled())
+		blocker.set()
+		self.assertTrue(running.result(5))
+		self.assertFalse(queued.cancel())
+
+if __name__ == "__main__":
+	unittest.main()
@@ -0,0 +1,180 @@
+import csv
+import threading
+import unittest
+from cStringIO import StringIO
+
+import export
+import importer
+from tests.emulated import newPasswordMap, addPasswords, decryptedContents
+
+#values the csv module has trouble escaping
+TRICKY_VALUES = ["plain", "a\\b", "ends\\", 'q"x', 'x\\"y', "c,d\\e", "line\nbreak",
+	'he said "a,b"', "", "\xc4\x8dau"]
+
+KEEPASS_XML = """<?xml version="1.0" encoding="utf-8"?>
+<KeePassFile>
+	<Meta><RecycleBinUUID>bin</RecycleBinUUID></Meta>
+	<Root>
+		<Group>
+			<UUID>root</UUID><Name>Database</Name>
+			<Entry>
+				<String><Key>Title</Key><Value>mail</Value></String>
+				<String><Key>UserName</Key><Value>me</Value></String>
+				<String><Key>Password</Key><Value>p1</Value></String>
+				<History>
+					<Entry>
+						<String><Key>Title</Key><Value>mail</Value></String>
+						<String><Key>Password</Key><Value>old</Value></String>
+					</Entry>
+				</History>
+			</Entry>
+			<Group>
+				<UUID>work</UUID><Name>work</Name>
+				<Group>
+					<UUID>aws</UUID><Name>aws</Name>
+					<Entry>
+						<String><Key>Title</Key><Value>prod</Value></String>
+						<String><Key>Password</Key><Value>p2</Value></String>
+					</Entry>
+				</Group>
+				<Entry>
+					<String><Key>UserName</Key><Value>\xc4\x8dau</Value></String>
+					<String><Key>Password</Key><Value>p3</Value></String>
+				</Entry>
+			</Group>
+			<Group>
+				<UUID>bin</UUID><Name>Recycle Bin</Name>
+				<Entry>
+					<String><Key>Title</Key><Value>deleted</Value></String>
+					<String><Key>Password</Key><Value>p4</Value></String>
+				</Entry>
+			</Group>
+		</Group>
+	</Root>
+</KeePassFile>
+"""
+
+class PieceReader(object):
+	"""
+	File returning at most few bytes on each read, like a slow stream
+	"""
+
+	def __init__(self, data, pieceSize=3):
+		self.f = StringIO(data)
+		self.pieceSize = pieceSize
+		self.calls = 0
+
+	def readline(self, size=-1):
+		self.calls += 1
+		return self.f.readline(self.pieceSize)
+
+class ReaderTest(unittest.TestCase):
+
+	def rows(self, importFormat, data):
+		return list(importer.IMPORT_FORMATS[importFormat](StringIO(data)))
+
+	def testCsvOfExport(self):
+		f = StringIO()
+		writer = export.CsvRowWriter(f)
+		expected = [("g", value, value) for value in TRICKY_VALUES]
+		for row in expected:
+			writer.writeRow(*row)
+		self.assertEqual(self.rows("csv", f.getvalue()), expected)
+
+	def testLegacyCsv(self):
+		#written like saveBackup of versions before export
+		f = StringIO()
+		writer = csv.writer(f, dialect="escaped")
+		expected = [("g", "k" + value, value) for value in TRICKY_VALUES]
+		for row in expected:
+			writer.writerow(row)
+		self.assertEqual(self.rows("csv-legacy", f.getvalue()), expected)
+
+	def testLegacyCsvReadInPieces(self):
+		f = StringIO()
+		writer = csv.writer(f, dialect="escaped")
+		#quote before line end would be ambiguous, see legacyCsvRows
+		expected = [("g", "multi\nline\r\nkey\\", 'a,"b" \n\\' + value) for value in TRICKY_VALUES]
+		expected.append(("g\\", "k", ""))
+		for row in expected:
+			writer.writerow(row)
+		for pieceSize in (1, 2, 3, 7):
+			reader = PieceReader(f.getvalue(), pieceSize)
+			self.assertEqual(list(importer.readLegacyCsv(reader)), expected)
+			self.assertTrue(reader.calls > len(f.getvalue()) / pieceSize)
+
+	def testCsvBadRow(self):
+		self.assertRaises(IOError, self.rows, "csv", "g,k,p\r\ng,k\r\n")
+
+	def testJsonLines(self):
+		f = StringIO()
+		writer = export.JsonLinesRowWriter(f)
+		expected = [("g", value, value) for value in TRICKY_VALUES]
+		for row in expected:
+			writer.writeRow(*row)
+		self.assertEqual(self.rows("jsonl", f.getvalue() + "\n"), expected)
+		self.assertRaises(IOError, self.rows, "jsonl", '{"group": "g", "key": "k"}\n')
+
+	def testKeepass(self):
+		self.assertEqual(self.rows("keepass", KEEPASS_XML), [
+			("Database", "mail (me)", "p1"),
+			("work/aws", "prod", "p2"),
+			("work", "\xc4\x8dau", "p3"),
+		])
+
+	def testKeepassProtected(self):
+		protectedXml = KEEPASS_XML.replace("<Value>p2</Value>",
+			'<Value Protected="True">cDI=</Value>')
+		self.assertRaises(IOError, self.rows, "keepass", protectedXml)
+
+class ImportFileTest(unittest.TestCase):
+
+	def setUp(self):
+		self.pwMap = newPasswordMap()
+		addPasswords(self.pwMap, "work", 2)
+
+	def importData(self, importFormat, data, **kwargs):
+		passwordImport = importer.importFile(self.pwMap, StringIO(data), importFormat, **kwargs)
+		return passwordImport.commit()
+
+	def testImportCsv(self):
+		f = StringIO()
+		writer = export.CsvRowWriter(f)
+		for i in range(importer.BATCH_SIZE + 3):
+			writer.writeRow("new", "k%d" % i, "new\\%d" % i)
+		writer.writeRow("work", "added", "a\\b")
+		before = decryptedContents(self.pwMap)
+
+		self.assertEqual(self.importData("csv", f.getvalue()), importer.BATCH_SIZE + 4)
+		contents = decryptedContents(self.pwMap)
+		self.assertTrue(self.pwMap.hasGroupKey("new"))
+		self.assertFalse(self.pwMap.hasGroupKey("work"))
+		self.assertEqual(contents["new"], [("k%d" % i, "new\\%d" % i)
+			for i in range(importer.BATCH_SIZE + 3)])
+		self.assertEqual(contents["work"], before["work"] + [("added", "a\\b")])
+
+		privateKey = self.pwMap.backupKey.unwrapPrivateKey()
+		decryptor = self.pwMap.backupKey.decryptor(privateKey)
+		self.assertEqual(decryptor.decrypt(str(self.pwMap.groups["work"].backups[2])), "a\\b")
+
+	def testImportKeepassWithoutGroupKeys(self):
+		self.assertEqual(self.importData("keepass", KEEPASS_XML, groupKeys=False), 3)
+		self.assertFalse(self.pwMap.hasGroupKey("work/aws"))
+		self.assertEqual(decryptedContents(self.pwMap)["work/aws"], [("prod", "p2")])
+
+	def testCancelledImportChangesNothing(self):
+		cancelEvent = threading.Event()
+		cancelEvent.set()
+		before = decryptedContents(self.pwMap)
+		self.assertRaises(importer.ImportCancelled, self.importData, "keepass", KEEPASS_XML,
+			cancelEvent=cancelEvent)
+		self.assertEqual(decryptedContents(self.pwMap), before)
+
+	def testChangedGroupsRejected(self):
+		passwordImport = importer.importFile(self.pwMap, StringIO(KEEPASS_XML), "keepass")
+		self.pwMap.addGroup("work/aws")
+		self.assertRaises(KeyError, passwordImport.commit)
+		self.assertNotIn("Database", self.pwMap.groups)
+
+if __name__ == "__main__":
+	unittest.main()
@@ -0,0 +1,107 @@
+import os
+import shutil
+import struct
+import tempfile
+import unittest
+
+import password_map
+from tests.emulated import newPasswordMap, loadPasswordMap, addPasswords, decryptedContents
+
+def fileFlags(fname):
+	with file(fname, "rb") as f:
+		f.seek(password_map.FLAGS_OFFSET)
+		return struct.unpack("!I", f.read(4))[0]
+
+class JournalTest(unittest.TestCase):
+
+	def setUp(self):
+		self.dir = tempfile.mkdtemp()
+		self.fname = os.path.join(self.dir, "test.pwdb")
+		self.pwMap = newPasswordMap()
+		addPasswords(self.pwMap, "work", 5)
+		self.pwMap.save(self.fname)
+
+	def tearDown(self):
+		shutil.rmtree(self.dir)
+
+	def saveChange(self, change):
+		"""
+		Apply change to the map, save it and return size of the file
+		before the save
+		"""
+		size = os.path.getsize(self.fname)
+		change(self.pwMap)
+		self.pwMap.save(self.fname)
+		return size
+
+	def testChangesAppended(self):
+		self.assertFalse(fileFlags(self.fname) & password_map.FLAG_JOURNAL)
+		snapshotSize = self.saveChange(lambda pwMap: addPasswords(pwMap, "home", 2))
+		self.saveChange(lambda pwMap: pwMap.removeEntry("work", 1))
+		self.saveChange(lambda pwMap: pwMap.updateEntry("work", 0, "renamed",
+			*pwMap.groups["work"].entry(0)[1:]))
+		self.saveChange(lambda pwMap: pwMap.removeGroup("home"))
+
+		self.assertTrue(fileFlags(self.fname) & password_map.FLAG_JOURNAL)
+		self.assertEqual(self.pwMap.journal.snapshotEnd, snapshotSize)
+		loaded = loadPasswordMap(self.fname)
+		self.assertEqual(decryptedContents(loaded), decryptedContents(self.pwMap))
+		self.assertEqual(sorted(loaded.groups), ["work"])
+		self.assertEqual(loaded.groups["work"].keys[0], "renamed")
+
+	def testTruncatedRecordIgnored(self):
+		self.saveChange(lambda pwMap: addPasswords(pwMap, "home", 2))
+		beforeLast = decryptedContents(self.pwMap)
+		lastStart = self.saveChange(lambda pwMap: addPasswords(pwMap, "later", 2))
+
+		for size in (lastStart + 3, os.path.getsize(self.fname) - 1):
+			with file(self.fname, "r+b") as f:
+				f.truncate(size)
+			loaded = loadPasswordMap(self.fname)
+			self.assertEqual(decryptedContents(loaded), beforeLast)
+			self.assertEqual(loaded.journal.end, lastStart)
+
+	def testAppendAfterTruncatedRecord(self):
+		lastStart = self.saveChange(lambda pwMap: addPasswords(pwMap, "home", 2))
+		with file(self.fname, "r+b") as f:
+			f.truncate(os.path.getsize(self.fname) - 1)
+
+		loaded = loadPasswordMap(self.fname)
+		self.assertEqual(loaded.journal.end, lastStart)
+		addPasswords(loaded, "again", 1)
+		loaded.save(self.fname)
+		#partial record is not overwritten, whole file is rewritten
+		self.assertEqual(loaded.journal.journalSize(), 0)
+		self.assertEqual(os.path.getsize(self.fname), loaded.journal.end)
+		self.assertEqual(sorted(loadPasswordMap(self.fname).groups), ["again", "work"])
+
+	def testCorruptedRecordRejected(self):
+		self.saveChange(lambda pwMap: addPasswords(pwMap, "home", 2))
+		with file(self.fname, "r+b") as f:
+			f.seek(-password_map.MACSIZE - 1, os.SEEK_END)
+			byte = f.read(1)
+			f.seek(-1, os.SEEK_CUR)
+			f.write(chr(ord(byte) ^ 1))
+		self.assertRaises(IOError, loadPasswordMap, self.fname)
+
+	def testLargeJournalCompacted(self):
+		compactMin = password_map.JOURNAL_COMPACT_MIN
+		password_map.JOURNAL_COMPACT_MIN = 0
+		try:
+			self.saveChange(lambda pwMap: addPasswords(pwMap, "home", 200))
+		finally:
+			password_map.JOURNAL_COMPACT_MIN = compactMin
+		self.assertFalse(fileFlags(self.fname) & password_map.FLAG_JOURNAL)
+		self.assertEqual(decryptedContents(loadPasswordMap(self.fname)),
+			decryptedContents(self.pwMap))
+
+	def testJournalOfVersion2(self):
+		self.pwMap.save(self.fname, 2)
+		addPasswords(self.pwMap, "home", 2)
+		self.pwMap.save(self.fname, 2)
+		self.assertTrue(fileFlags(self.fname) & password_map.FLAG_JOURNAL)
+		self.assertEqual(decryptedContents(loadPasswordMap(self.fname)),
+			decryptedContents(self.pwMap))
+
+if __name__ == "__main__":
+	unittest.main()
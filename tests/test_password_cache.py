@@ -0,0 +1,99 @@
+import unittest
+
+from password_cache import PasswordCache
+
+class FakeClock(object):
+	def __init__(self):
+		self.now = 1000.0
+
+	def __call__(self):
+		return self.now
+
+class PasswordCacheTest(unittest.TestCase):
+
+	def setUp(self):
+		self.clock = FakeClock()
+		self.cache = PasswordCache(ttl=10, maxEntries=3, clock=self.clock)
+
+	def buffers(self):
+		return [cached.buf for cached in self.cache.entries.itervalues()]
+
+	def testGetAndMiss(self):
+		self.cache.put("g", "enc1", "secret")
+		self.assertEqual(self.cache.get("g", "enc1"), "secret")
+		self.assertIsNone(self.cache.get("g", "enc2"))
+		self.assertIsNone(self.cache.get("other", "enc1"))
+		self.assertEqual(self.cache.stats(), {"hits": 1, "misses": 2, "evictions": 0, "size": 1})
+
+	def testTtlExpiry(self):
+		self.cache.put("g", "enc1", "secret")
+		buf = self.buffers()[0]
+		self.clock.now += 9.9
+		self.assertEqual(self.cache.get("g", "enc1"), "secret")
+		self.clock.now += 0.1
+		self.assertIsNone(self.cache.get("g", "enc1"))
+		self.assertEqual(buf, bytearray(6))
+		self.assertEqual(len(self.cache), 0)
+
+	def testExpireRemovesOnlyExpired(self):
+		self.cache.put("g", "old", "a")
+		self.clock.now += 5
+		self.cache.put("g", "new", "b")
+		self.clock.now += 5
+		self.cache.expire()
+		self.assertEqual(self.cache.entries.keys(), [("g", "new")])
+		self.assertEqual(self.cache.stats()["evictions"], 1)
+
+	def testLruEviction(self):
+		for i in range(3):
+			self.cache.put("g", "enc%d" % i, "pw%d" % i)
+		self.cache.get("g", "enc0") #enc1 is least recently used now
+		evicted = self.cache.entries[("g", "enc1")].buf
+		self.cache.put("g", "enc3", "pw3")
+		self.assertEqual(sorted(key for _, key in self.cache.entries), ["enc0", "enc2", "enc3"])
+		self.assertEqual(evicted, bytearray(3))
+		self.assertEqual(self.cache.stats()["evictions"], 1)
+
+	def testPutReplaces(self):
+		self.cache.put("g", "enc", "first")
+		old = self.buffers()[0]
+		self.cache.put("g", "enc", "second")
+		self.assertEqual(old, bytearray(5))
+		self.assertEqual(self.cache.get("g", "enc"), "second")
+		self.assertEqual(len(self.cache), 1)
+
+	def testRemove(self):
+		self.cache.put("g", "enc", "secret")
+		self.cache.put("h", "enc", "other")
+		buf = self.cache.entries[("g", "enc")].buf
+		self.cache.remove("g", "enc")
+		self.cache.remove("g", "missing")
+		self.assertEqual(buf, bytearray(6))
+		self.assertIsNone(self.cache.get("g", "enc"))
+		self.assertEqual(self.cache.get("h", "enc"), "other")
+
+	def testRemoveGroup(self):
+		self.cache.put("g", "a", "1")
+		self.cache.put("g", "b", "2")
+		self.cache.put("h", "a", "3")
+		self.cache.removeGroup("g")
+		self.assertEqual(self.cache.entries.keys(), [("h", "a")])
+
+	def testClearWipesBuffers(self):
+		#MainWindow clears the cache when locking
+		for i in range(3):
+			self.cache.put("g", "enc%d" % i, "password%d" % i)
+		buffers = self.buffers()
+		self.cache.clear()
+		self.assertEqual(len(self.cache), 0)
+		for buf in buffers:
+			self.assertEqual(buf, bytearray(len("password0")))
+
+	def testDisabled(self):
+		cache = PasswordCache(maxEntries=0, clock=self.clock)
+		cache.put("g", "enc", "secret")
+		self.assertIsNone(cache.get("g", "enc"))
+		self.assertEqual(len(cache), 0)
+
+if __name__ == "__main__":
+	unittest.main()
@@ -0,0 +1,89 @@
+import unittest
+
+from regroup import moveGroups
+from tests.emulated import newPasswordMap, addPasswords, decryptedContents
+
+class MoveGroupsTest(unittest.TestCase):
+
+	def setUp(self):
+		self.pwMap = newPasswordMap()
+		addPasswords(self.pwMap, "a", 3, prefix="a")
+		addPasswords(self.pwMap, "b", 2, prefix="b")
+		addPasswords(self.pwMap, "c", 2, prefix="c")
+		self.before = decryptedContents(self.pwMap)
+		self.privateKey = self.pwMap.backupKey.unwrapPrivateKey()
+
+	def move(self, sourceNames, targetName, groupKeys=True):
+		return moveGroups(self.pwMap, sourceNames, targetName, self.privateKey,
+			groupKeys=groupKeys, processes=1)
+
+	def backupPasswords(self, groupName):
+		decryptor = self.pwMap.backupKey.decryptor(self.privateKey)
+		return [decryptor.decrypt(str(bkupPw)) for bkupPw in self.pwMap.groups[groupName].backups]
+
+	def testRename(self):
+		backups = list(self.pwMap.groups["a"].backups)
+		self.assertEqual(self.move(["a"], "x").commit(), 3)
+		contents = decryptedContents(self.pwMap)
+		self.assertNotIn("a", contents)
+		self.assertEqual(contents["x"], self.before["a"])
+		self.assertTrue(self.pwMap.hasGroupKey("x"))
+		#backup copies do not depend on group name
+		self.assertEqual(list(self.pwMap.groups["x"].backups), backups)
+
+	def testRenameWithoutGroupKey(self):
+		self.move(["a"], "x", groupKeys=False).commit()
+		self.assertFalse(self.pwMap.hasGroupKey("x"))
+		self.assertEqual(decryptedContents(self.pwMap)["x"], self.before["a"])
+
+	def testMerge(self):
+		self.assertEqual(self.move(["a", "b"], "c").commit(), 5)
+		contents = decryptedContents(self.pwMap)
+		self.assertEqual(sorted(contents), ["c"])
+		self.assertEqual(sorted(contents["c"]),
+			sorted(self.before["a"] + self.before["b"] + self.before["c"]))
+		self.assertEqual(sorted(self.backupPasswords("c")),
+			sorted(password for group in "abc" for _, password in self.before[group]))
+
+	def testMergeIntoGroupKeyTarget(self):
+		self.pwMap.convertToGroupKey("c")
+		wrappedKey = self.pwMap.groups["c"].wrappedKey
+		self.move(["a"], "c").commit()
+		self.assertEqual(self.pwMap.groups["c"].wrappedKey, wrappedKey)
+		self.assertEqual(sorted(decryptedContents(self.pwMap)["c"]),
+			sorted(self.before["a"] + self.before["c"]))
+
+	def testRekey(self):
+		self.pwMap.convertToGroupKey("a")
+		wrappedKey = self.pwMap.groups["a"].wrappedKey
+		self.move(["a"], "a").commit()
+		self.assertNotEqual(self.pwMap.groups["a"].wrappedKey, wrappedKey)
+		self.assertEqual(decryptedContents(self.pwMap), self.before)
+
+	def testRefusedWhenSourceChanged(self):
+		move = self.move(["a", "b"], "x")
+		addPasswords(self.pwMap, "b", 3, prefix="later")
+		changed = decryptedContents(self.pwMap)
+		self.assertRaises(KeyError, move.commit)
+		self.assertEqual(decryptedContents(self.pwMap), changed)
+
+	def testRefusedWhenSourceRemoved(self):
+		move = self.move(["a"], "x")
+		self.pwMap.removeGroup("a")
+		self.assertRaises(KeyError, move.commit)
+		self.assertNotIn("x", self.pwMap.groups)
+
+	def testRefusedWhenTargetCreated(self):
+		move = self.move(["a"], "x")
+		self.pwMap.addGroup("x")
+		self.assertRaises(KeyError, move.commit)
+		self.assertIn("a", self.pwMap.groups)
+
+	def testRefusedWhenTargetSwitchedToGroupKey(self):
+		move = self.move(["a"], "c")
+		self.pwMap.convertToGroupKey("c")
+		self.assertRaises(KeyError, move.commit)
+		self.assertEqual(decryptedContents(self.pwMap), self.before)
+
+if __name__ == "__main__":
+	unittest.main()
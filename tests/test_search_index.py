@@ -0,0 +1,105 @@
+import unittest
+
+from search_index import SearchIndex, substringDistance, PREFIX, SUBSTRING, SIMILAR
+
+class Group(object):
+	def __init__(self, keys):
+		self.keys = keys
+
+class SearchIndexTest(unittest.TestCase):
+
+	def setUp(self):
+		self.index = SearchIndex()
+		self.index.build({
+			"mail": Group(["my example account", "work mail", "key0", "key1", "key2"]),
+			"bank": Group(["examples", "card pin"]),
+		})
+
+	def keys(self, query, **kwargs):
+		return [key for _, key in self.index.search(query, **kwargs)]
+
+	def testAddAndRemove(self):
+		self.index.addKey("bank", "savings")
+		self.assertEqual(self.index.search("saving"), [("bank", "savings")])
+		self.index.removeKey("bank", "savings")
+		self.assertEqual(self.index.search("saving"), [])
+
+	def testRefcountedKeys(self):
+		self.index.addKey("bank", "card pin")
+		self.index.removeKey("bank", "card pin")
+		self.assertEqual(self.index.search("card"), [("bank", "card pin")])
+		self.index.removeKey("bank", "card pin")
+		self.assertEqual(self.index.search("card"), [])
+		#id of removed document is reused
+		self.index.addKey("mail", "card pin")
+		self.assertEqual(self.index.search("card"), [("mail", "card pin")])
+
+	def testRemoveGroup(self):
+		self.index.addKey("bank", "card pin")
+		self.index.removeGroup("bank")
+		self.assertEqual(self.keys("example"), ["my example account"])
+		self.assertEqual(self.index.search("bank"), [])
+		self.assertEqual(self.index.search("card"), [])
+
+	def testOperationApplied(self):
+		self.index.operationApplied(("addGroup", "shop"))
+		self.index.operationApplied(("addEntry", "shop", "groceries", "enc", "sig"))
+		self.index.operationApplied(("updateEntry", "shop", 0, "clothes", "enc", "sig"), "groceries")
+		self.assertEqual(self.index.search("clothes"), [("shop", "clothes")])
+		self.assertEqual(self.index.search("groceries", similar=False), [])
+		self.index.operationApplied(("removeEntry", "shop", 0), "clothes")
+		self.assertEqual(self.index.search("clothes", similar=False), [])
+		self.index.operationApplied(("removeGroup", "shop"))
+		self.assertEqual(self.index.search("shop", similar=False), [])
+
+	def testPrefixOrdering(self):
+		#shorter texts starting with query first, case insensitive
+		self.index.addKey("bank", "Example")
+		self.assertEqual(self.keys("ex")[:2], ["Example", "examples"])
+		self.assertEqual(self.keys("key"), ["key0", "key1", "key2"])
+
+	def testSubstringRank(self):
+		self.assertEqual(self.index.classifiedSearch("example"), [
+			(("bank", "examples"), PREFIX),
+			(("mail", "my example account"), SUBSTRING),
+		])
+		#match at word start is better than inside word
+		self.index.addKey("bank", "counterexample")
+		self.assertEqual(self.keys("example")[1:], ["my example account", "counterexample"])
+
+	def testLimit(self):
+		self.assertEqual(self.keys("key", limit=2), ["key0", "key1"])
+		self.assertEqual(len(self.index.search("exam", limit=1)), 1)
+
+	def testTransposition(self):
+		self.assertEqual(self.index.classifiedSearch("exmaple"), [
+			(("bank", "examples"), SIMILAR),
+			(("mail", "my example account"), SIMILAR),
+		])
+		self.assertEqual(self.keys("wrok mail"), ["work mail"])
+		self.assertEqual(self.keys("exmaple", similar=False), [])
+
+	def testSimilarOnlyAfterMatches(self):
+		self.assertEqual(self.keys("key0", similar=False), ["key0"])
+		matches = self.index.classifiedSearch("key0")
+		self.assertEqual(matches[0], (("mail", "key0"), PREFIX))
+		self.assertEqual(set(matchClass for _, matchClass in matches[1:]), set([SIMILAR]))
+
+	def testUnrelatedNotSimilar(self):
+		self.assertEqual(self.index.search("xyzzy"), [])
+		self.assertEqual(self.index.search("ample pin"), [])
+
+	def testSubstringDistance(self):
+		for query, text, distance in [
+			("abc", "xxabcxx", 0),
+			("exmaple", "my example account", 1),
+			("exampel", "examples", 1),
+			("exmple", "example", 1),
+			("exaample", "example", 1),
+			("abcd", "", 4),
+			("abcd", "dcba", 3),
+		]:
+			self.assertEqual(substringDistance(query, text), distance, (query, text))
+
+if __name__ == "__main__":
+	unittest.main()
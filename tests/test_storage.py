@@ -0,0 +1,243 @@
+import os
+import stat
+import shutil
+import tempfile
+import threading
+import unittest
+
+import password_map
+from tests.emulated import newPasswordMap, loadPasswordMap, addPasswords, decryptedContents
+
+class StorageRoundTripTest(unittest.TestCase):
+
+	def setUp(self):
+		self.dir = tempfile.mkdtemp()
+		self.fname = os.path.join(self.dir, "test.pwdb")
+
+	def tearDown(self):
+		shutil.rmtree(self.dir)
+
+	def roundTrip(self, version, **attrs):
+		"""
+		Save map with two groups in given storage version with given
+		PasswordMap attributes set and check loaded one has the same
+		passwords.
+		"""
+		pwMap = newPasswordMap()
+		for name, value in attrs.items():
+			setattr(pwMap, name, value)
+		addPasswords(pwMap, "work", 5)
+		addPasswords(pwMap, "home/\xc4\x8dau", 3, prefix="home")
+		pwMap.addGroup("empty")
+		pwMap.save(self.fname, version)
+
+		loaded = loadPasswordMap(self.fname)
+		self.assertEqual(decryptedContents(loaded), decryptedContents(pwMap))
+		return loaded
+
+	def testVersion1(self):
+		pwMap = newPasswordMap()
+		addPasswords(pwMap, "work", 3)
+		#version 1 cannot store data keys, backup copies are not checked
+		pwMap.backupKey.wrappedDataKeys = []
+		pwMap.save(self.fname, 1)
+		self.assertEqual(decryptedContents(loadPasswordMap(self.fname)), decryptedContents(pwMap))
+
+	def testVersion1RejectsDataKeys(self):
+		pwMap = newPasswordMap()
+		addPasswords(pwMap, "work", 1)
+		self.assertRaises(IOError, pwMap.save, self.fname, 1)
+
+	def testVersion2(self):
+		self.roundTrip(2)
+
+	def testVersion3(self):
+		self.roundTrip(3)
+
+	def testChunked(self):
+		chunkSize = password_map.SEGMENT_CHUNK_SIZE
+		password_map.SEGMENT_CHUNK_SIZE = 100 #several chunks per segment
+		try:
+			for version in (2, 3):
+				loaded = self.roundTrip(version, chunked=True)
+				self.assertTrue(loaded.chunked)
+		finally:
+			password_map.SEGMENT_CHUNK_SIZE = chunkSize
+
+	def testCorruptedChunkRejected(self):
+		self.roundTrip(3, chunked=True)
+		loaded = loadPasswordMap(self.fname)
+		segment = loaded.groups.segment("work")
+		with file(self.fname, "r+b") as f:
+			f.seek(segment.offset + segment.size / 2)
+			byte = f.read(1)
+			f.seek(-1, os.SEEK_CUR)
+			f.write(chr(ord(byte) ^ 1))
+		self.assertRaises(IOError, lambda: loaded.groups["work"])
+
+	def flagCombinations(self, compressions):
+		"""
+		Round trip of versions 2 and 3 with and without chunks under
+		each of compressions, followed by journaled change.
+		"""
+		for version in (2, 3):
+			for chunked in (False, True):
+				for compression in compressions:
+					combination = "version %d, chunked %s, %s" % (version, chunked, compression)
+					loaded = self.roundTrip(version, chunked=chunked, compression=compression)
+					self.assertEqual((loaded.chunked, loaded.compression),
+						(chunked, compression), combination)
+
+					addPasswords(loaded, "journaled", 2)
+					loaded.save(self.fname, version)
+					self.assertNotEqual(loaded.journal.journalSize(), 0, combination)
+					self.assertEqual(decryptedContents(loadPasswordMap(self.fname)),
+						decryptedContents(loaded), combination)
+
+	def testFlagCombinations(self):
+		self.flagCombinations([None, "zlib"])
+
+	@unittest.skipUnless(password_map.compressionAvailable("lzma"), "lzma module not installed")
+	def testLzmaFlagCombinations(self):
+		self.flagCombinations(["lzma"])
+
+	def testGroupsLoadedLazily(self):
+		self.roundTrip(3)
+		loaded = loadPasswordMap(self.fname)
+		self.assertFalse(loaded.groups.isLoaded("work"))
+		loaded.groups["work"]
+		self.assertTrue(loaded.groups.isLoaded("work"))
+
+	def testPermissionsKept(self):
+		self.roundTrip(3)
+		self.assertEqual(stat.S_IMODE(os.stat(self.fname).st_mode), 0600)
+		os.chmod(self.fname, 0640)
+		self.roundTrip(3)
+		self.assertEqual(stat.S_IMODE(os.stat(self.fname).st_mode), 0640)
+
+	def testSymlinkKept(self):
+		target = os.path.join(self.dir, "target.pwdb")
+		file(target, "wb").close()
+		os.symlink(target, self.fname)
+		loaded = self.roundTrip(3)
+		self.assertTrue(os.path.islink(self.fname))
+		addPasswords(loaded, "journaled", 1)
+		loaded.save(self.fname)
+		self.assertNotEqual(loaded.journal.journalSize(), 0)
+		self.assertTrue(os.path.islink(self.fname))
+		self.assertEqual(decryptedContents(loadPasswordMap(self.fname)), decryptedContents(loaded))
+
+	def testBadPassphrase(self):
+		pwMap = newPasswordMap()
+		addPasswords(pwMap, "work", 1)
+		pwMap.save(self.fname, 3)
+		loaded = newPasswordMap()
+		loaded.trezor.prefillPassphrase("other")
+		self.assertRaises(IOError, loaded.load, self.fname)
+
+class BackgroundSaveTest(unittest.TestCase):
+	"""
+	Saves of snapshot in another thread while the map is changed, like
+	MainWindow.startSave does.
+	"""
+
+	def setUp(self):
+		self.dir = tempfile.mkdtemp()
+		self.fname = os.path.join(self.dir, "test.pwdb")
+		pwMap = newPasswordMap()
+		for groupName in ("a", "b", "c", "d"):
+			addPasswords(pwMap, groupName, 3, prefix=groupName)
+		pwMap.save(self.fname)
+		self.pwMap = loadPasswordMap(self.fname)
+
+	def tearDown(self):
+		shutil.rmtree(self.dir)
+
+	def saveInThread(self, snapshot):
+		"""
+		@returns exception raised by save of snapshot or None
+		"""
+		errors = []
+		def write():
+			try:
+				snapshot.save(self.fname)
+			except Exception, e:
+				errors.append(e)
+		thread = threading.Thread(target=write)
+		thread.start()
+		thread.join()
+		return errors[0] if errors else None
+
+	def testEditsDuringSave(self):
+		addPasswords(self.pwMap, "a", 1, prefix="snap")
+		self.pwMap.journaled = False #whole file is rewritten
+		snapshot = self.pwMap.snapshot()
+		expected = decryptedContents(snapshot)
+
+		#changes after snapshot, including group still in old file
+		addPasswords(self.pwMap, "a", 2, prefix="later")
+		self.pwMap.removeEntry("b", 0)
+		self.pwMap.removeGroup("c")
+		self.assertIsNone(self.saveInThread(snapshot))
+		self.pwMap.finishSave(snapshot)
+		self.assertEqual(decryptedContents(loadPasswordMap(self.fname)), expected)
+
+		self.pwMap.journaled = True
+		self.assertTrue(self.pwMap.pendingOps)
+		self.pwMap.save(self.fname)
+		self.assertNotEqual(self.pwMap.journal.journalSize(), 0)
+		self.assertEqual(decryptedContents(loadPasswordMap(self.fname)),
+			decryptedContents(self.pwMap))
+
+	def testJournaledSnapshot(self):
+		addPasswords(self.pwMap, "new", 2)
+		snapshot = self.pwMap.snapshot()
+		addPasswords(self.pwMap, "a", 1, prefix="later")
+		self.assertIsNone(self.saveInThread(snapshot))
+		self.pwMap.finishSave(snapshot)
+		self.pwMap.save(self.fname)
+		self.assertNotEqual(self.pwMap.journal.journalSize(), 0)
+		self.assertEqual(decryptedContents(loadPasswordMap(self.fname)),
+			decryptedContents(self.pwMap))
+
+	def testFailedSaveAborted(self):
+		with file(self.fname, "rb") as f:
+			original = f.read()
+		addPasswords(self.pwMap, "a", 1, prefix="lost")
+		self.pwMap.journaled = False
+		snapshot = self.pwMap.snapshot()
+		os.mkdir(self.fname + ".tmp") #temporary file cannot be created
+
+		self.assertIsInstance(self.saveInThread(snapshot), IOError)
+		self.pwMap.abortSave(snapshot)
+		with file(self.fname, "rb") as f:
+			self.assertEqual(f.read(), original)
+
+		os.rmdir(self.fname + ".tmp")
+		addPasswords(self.pwMap, "b", 1, prefix="after")
+		self.pwMap.save(self.fname)
+		contents = decryptedContents(loadPasswordMap(self.fname))
+		self.assertEqual(contents, decryptedContents(self.pwMap))
+		self.assertIn(("key0", "lost0"), contents["a"])
+
+	def testUnloadedSegmentsReadAfterRename(self):
+		addPasswords(self.pwMap, "a", 1, prefix="snap")
+		self.pwMap.journaled = False
+		snapshot = self.pwMap.snapshot()
+		self.assertIsNone(self.saveInThread(snapshot))
+		self.assertTrue(os.path.exists(self.fname + ".tmp"))
+
+		#read before rename comes from the old file
+		self.assertEqual(self.pwMap.decryptPassword(str(self.pwMap.groups["b"].values[0]), "b"), "b0")
+		self.assertFalse(self.pwMap.groups.isLoaded("c"))
+		self.pwMap.finishSave(snapshot)
+		self.assertFalse(os.path.exists(self.fname + ".tmp"))
+
+		#old file is gone, segments must point into the new one
+		for groupName in ("c", "d"):
+			self.assertFalse(self.pwMap.groups.isLoaded(groupName))
+			self.assertEqual(self.pwMap.groups.segment(groupName).fname, self.fname)
+		self.assertEqual(decryptedContents(self.pwMap), decryptedContents(loadPasswordMap(self.fname)))
+
+if __name__ == "__main__":
+	unittest.main()
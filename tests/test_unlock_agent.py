@@ -0,0 +1,100 @@
+import os
+import stat
+import shutil
+import tempfile
+import threading
+import unittest
+
+from unlock_agent import UnlockAgent, AgentClient, AgentError
+from tests.emulated import newPasswordMap, addPasswords
+
+class UnlockAgentTest(unittest.TestCase):
+
+	def setUp(self):
+		self.dir = tempfile.mkdtemp()
+		self.fname = os.path.join(self.dir, "test.pwdb")
+		self.socketPath = os.path.join(self.dir, "agent.sock")
+		self.pwMap = newPasswordMap()
+		addPasswords(self.pwMap, "mail", 3)
+		addPasswords(self.pwMap, "bank", 1, prefix="pin")
+		self.pwMap.save(self.fname)
+		self.startAgent(idleTimeout=60)
+
+	def tearDown(self):
+		self.agent.lockAgent()
+		self.serveThread.join(10)
+		shutil.rmtree(self.dir)
+
+	def startAgent(self, idleTimeout):
+		self.agent = UnlockAgent(self.pwMap, self.fname, self.socketPath, idleTimeout)
+		self.agent.listen()
+		self.serveThread = threading.Thread(target=self.agent.serve)
+		self.serveThread.daemon = True
+		self.serveThread.start()
+		self.client = AgentClient(self.socketPath)
+
+	def assertAgentEnded(self):
+		self.serveThread.join(10)
+		self.assertFalse(self.serveThread.is_alive())
+		self.assertFalse(os.path.exists(self.socketPath))
+		self.assertIsNone(self.pwMap.groups)
+		self.assertIsNone(self.pwMap.outerKey)
+		self.assertRaises(IOError, self.client.call, "ping")
+
+	def testRequests(self):
+		self.assertEqual(self.client.call("ping"), "pong")
+		self.assertEqual(self.client.call("list"), ["bank", "mail"])
+		self.assertEqual(self.client.call("list", group="mail"), ["key0", "key1", "key2"])
+		self.assertEqual(self.client.call("get", group="mail", key="key1"), "pw1")
+		self.assertEqual(self.client.call("get", group="bank", key="key0"), "pin0")
+		self.assertEqual(self.client.call("search", query="key1", similar=False), [["mail", "key1"]])
+		self.assertEqual(self.client.call("search", query="ban"), [["bank", None]])
+
+	def testErrors(self):
+		for command, args, error in [
+			("get", {"group": "nope", "key": "key0"}, "No such group: nope"),
+			("list", {"group": "nope"}, "No such group: nope"),
+			("get", {"group": "mail", "key": "nope"}, "No such key in group: nope"),
+			("unlock", {}, "Unknown command: unlock"),
+		]:
+			with self.assertRaises(AgentError) as cm:
+				self.client.call(command, **args)
+			self.assertEqual(str(cm.exception), error)
+		#agent still answers after errors
+		self.assertEqual(self.client.call("ping"), "pong")
+
+	def testSocketPrivate(self):
+		mode = os.stat(self.socketPath).st_mode
+		self.assertTrue(stat.S_ISSOCK(mode))
+		self.assertEqual(stat.S_IMODE(mode), 0600)
+
+	def testSecondAgentRefused(self):
+		agent = UnlockAgent(self.pwMap, self.fname, self.socketPath)
+		self.assertRaises(IOError, agent.listen)
+		self.assertEqual(self.client.call("ping"), "pong")
+
+	def testLockCommand(self):
+		self.assertIsNone(self.client.call("lock"))
+		self.assertAgentEnded()
+
+	def testIdleLock(self):
+		self.agent.lockAgent()
+		self.serveThread.join(10)
+		self.startAgent(idleTimeout=0.2)
+		self.assertAgentEnded()
+
+	def testFileChangedLocks(self):
+		self.assertEqual(self.client.call("ping"), "pong")
+		with file(self.fname, "ab") as f:
+			f.write("x")
+		with self.assertRaises(AgentError) as cm:
+			self.client.call("list")
+		self.assertEqual(str(cm.exception), "Agent is locked")
+		self.assertAgentEnded()
+
+	def testFileRemovedLocks(self):
+		os.remove(self.fname)
+		self.assertAgentEnded()
+
+if __name__ == "__main__":
+	unittest.main()
@@ -0,0 +1,261 @@
+import time
+import getpass
+import threading
+
+from trezorlib.client import BaseClient, ProtocolMixin
+from trezorlib.transport_hid import HidTransport
+from trezorlib import messages_pb2 as proto
+
+from device_cache import NO_LABEL
+
+class HeadlessTrezorMixin(object):
+	"""
+	Mixin for input of passphrase and PIN on terminal, no GUI needed.
+	"""
+
+	def __init__(self, *args, **kwargs):
+		super(HeadlessTrezorMixin, self).__init__(*args, **kwargs)
+		self.passphrase = None
+
+	def callback_ButtonRequest(self, msg):
+		return proto.ButtonAck()
+
+	def callback_PassphraseRequest(self, msg):
+		if self.passphrase is not None:
+			return proto.PassphraseAck(passphrase=self.passphrase)
+
+		passphrase = getpass.getpass("Trezor passphrase: ")
+		return proto.PassphraseAck(passphrase=passphrase.decode("utf-8"))
+
+	def callback_PinMatrixRequest(self, msg):
+		pin = getpass.getpass("PIN (positions as shown on Trezor's matrix): ")
+		return proto.PinMatrixAck(pin=pin)
+
+	def prefillPassphrase(self, passphrase):
+		"""
+		Instead of asking for passphrase, use this one
+		"""
+		self.passphrase = passphrase.decode("utf-8")
+
+class HeadlessTrezorClient(ProtocolMixin, HeadlessTrezorMixin, BaseClient):
+	"""
+	Trezor client with terminal input methods
+	"""
+	pass
+
+PROBE_TIMEOUT = 2.0 #seconds to wait for labels of uncached devices
+
+class TrezorChooser(object):
+	"""
+	Factory for Trezor clients connected via HID.
+
+	Subclasses set clientClass for different input methods and override
+	chooseFromMap to let user pick one of several connected devices.
+
+	With DeviceCache, only devices missing from it are opened to read
+	their labels, concurrently, and last chosen device is selected
+	without asking when it is connected.
+	"""
+
+	clientClass = HeadlessTrezorClient
+
+	def __init__(self, label=None, cache=None, autoSelect=True):
+		"""
+		@param label: if more Trezors are connected, use the one with
+			this label
+		@param cache: DeviceCache updated with labels and chosen device
+		@param autoSelect: choose last chosen device from cache
+			without asking
+		"""
+		self.label = label
+		self.cache = cache
+		self.autoSelect = autoSelect
+		self.chosenPath = None #HID path of device chosen by chooseDevice
+
+	def getDevice(self):
+		"""
+		Get one from available devices.
+
+		@returns client of type self.clientClass or None if no Trezor
+			is connected
+		"""
+		devices = self.enumerateHIDDevices()
+
+		if not devices:
+			return None
+
+		if self.cache is not None:
+			#forget labels of unplugged devices
+			self.cache.keepOnly(device[0] for device in devices)
+
+		transport = self.chooseDevice(devices)
+		client = self.clientClass(transport)
+
+		if self.cache is not None and not self.revalidate(client) and len(devices) > 1:
+			#cached label belonged to another Trezor, choose again
+			#from labels read from devices
+			client.close()
+			self.cache.forget(device[0] for device in devices)
+			transport = self.chooseDevice(devices)
+			client = self.clientClass(transport)
+			self.revalidate(client)
+
+		if self.cache is not None:
+			self.cache.lastDeviceId = self.cache.devices[self.chosenPath][1]
+
+		return client
+
+	def revalidate(self, client):
+		"""
+		Update cache with features of opened chosen device.
+
+		@returns False if cache had another device at its path
+		"""
+		label, deviceId = self.featuresOf(client)
+		cached = self.cache.devices.get(self.chosenPath)
+		self.cache.devices[self.chosenPath] = (label, deviceId)
+		return cached is None or cached[1] == deviceId
+
+	def featuresOf(self, client):
+		"""
+		@returns tuple (label, device id) of opened device
+		"""
+		features = client.features
+		return features.label or NO_LABEL, features.device_id
+
+	def enumerateHIDDevices(self):
+		"""Returns Trezor HID devices"""
+		devices = HidTransport.enumerate()
+
+		return devices
+
+	def chooseDevice(self, devices):
+		"""
+		Choose device from enumerated list. If there's only one Trezor,
+		that will be chosen, otherwise chooseFromMap decides.
+
+		@returns HidTransport object of selected device
+		"""
+		if not len(devices):
+			raise RuntimeError("No Trezor connected!")
+
+		if len(devices) == 1:
+			self.chosenPath = devices[0][0]
+			try:
+				return HidTransport(devices[0])
+			except IOError:
+				raise RuntimeError("Trezor is currently in use")
+
+		autoSelect = self.cache is not None and self.autoSelect and self.label is None
+		deviceStr = None
+		if autoSelect:
+			#labels are not needed, getDevice checks the device is
+			#still the one cached at its path
+			deviceStr = self.cache.pathOfLast(device[0] for device in devices)
+
+		if deviceStr is None:
+			deviceMap = self.deviceLabels(devices)
+			if not deviceMap:
+				raise RuntimeError("All connected Trezors are in use!")
+			if autoSelect:
+				deviceStr = self.cache.pathOfLast(deviceMap.keys())
+			if deviceStr is None:
+				deviceStr = self.chooseFromMap(deviceMap)
+
+		self.chosenPath = deviceStr
+		try:
+			return HidTransport([deviceStr, None])
+		except IOError:
+			raise RuntimeError("Trezor is currently in use")
+
+	def deviceLabels(self, devices):
+		"""
+		Read labels of devices, from cache if possible. Uncached devices
+		are probed concurrently.
+
+		@returns dict deviceId string -> device label
+		"""
+		if self.cache is None:
+			probed = self.probeDevices(devices)
+		else:
+			probed = self.probeDevices([device for device in devices
+				if device[0] not in self.cache.devices])
+			self.cache.devices.update(probed)
+			probed = dict((device[0], self.cache.devices[device[0]]) for device in devices
+				if device[0] in self.cache.devices)
+
+		return dict((path, label) for path, (label, _) in probed.iteritems())
+
+	def probeDevices(self, devices):
+		"""
+		Open devices in parallel threads and read their features.
+		Devices in use or not answering within PROBE_TIMEOUT are left
+		out, so that one busy device does not delay the others.
+		Transports of devices that did not answer are closed before
+		returning, so that the device can be opened again.
+
+		@returns dict deviceId string -> (label, device id)
+		"""
+		results = {}
+		transports = {} #deviceId -> transport of unfinished probe
+		lock = threading.Lock()
+		timedOut = threading.Event()
+
+		def probe(device):
+			try:
+				transport = HidTransport(device)
+			except IOError:
+				#device in use, do not offer as choice
+				return
+			with lock:
+				if timedOut.is_set():
+					transport.close()
+					return
+				transports[device[0]] = transport
+
+			try:
+				features = self.featuresOf(self.clientClass(transport))
+			except Exception:
+				#IOError of device in use, or transport was closed
+				#after timeout
+				features = None
+			with lock:
+				if transports.pop(device[0], None) is None:
+					return #closed after timeout
+				transport.close()
+				if features is not None:
+					results[device[0]] = features
+
+		threads = []
+		for device in devices:
+			thread = threading.Thread(target=probe, args=(device,))
+			thread.daemon = True
+			thread.start()
+			threads.append(thread)
+
+		deadline = time.time() + PROBE_TIMEOUT
+		for thread in threads:
+			thread.join(max(0, deadline - time.time()))
+
+		with lock:
+			timedOut.set()
+			for transport in transports.itervalues():
+				transport.close()
+			transports.clear()
+			return dict(results)
+
+	def chooseFromMap(self, deviceMap):
+		"""
+		Pick device whose label matches self.label.
+
+		@param deviceMap: dict deviceId string -> device label
+		@returns deviceId string of chosen Trezor
+		"""
+		if self.label is None:
+			raise RuntimeError("Multiple Trezors connected, choose one by label")
+
+		for deviceStr, label in deviceMap.items():
+			if label == self.label:
+				return deviceStr
+
+		raise RuntimeError("No available Trezor with label " + self.label)
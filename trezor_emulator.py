@@ -0,0 +1,118 @@
+import time
+import struct
+import hmac
+import hashlib
+import threading
+
+from Crypto.Cipher import AES
+
+class EmulatedFeatures(object):
+	"""Subset of Trezor features message the app looks at"""
+
+	def __init__(self, label):
+		self.label = label
+
+class EmulatedTrezorClient(object):
+	"""
+	Software stand-in for Trezor client, for tests and benchmarks.
+
+	Implements the cipher-key-value calls the same way Trezor does -
+	AES-256-CBC without padding, key and default IV derived from node
+	and key string - with node keys derived deterministically from test
+	seed and passphrase. Same seed and passphrase always decrypt what
+	they encrypted. It is not secure, never use it with real passwords.
+
+	Latency of each call and of button confirmation can be set to
+	emulate real device speed. Calls are serialized like on real device.
+	"""
+
+	BLOCKSIZE = 16
+
+	def __init__(self, seed, passphrase="", label="emulator", latency=0.0, confirmDelay=0.0):
+		"""
+		@param seed: string from which all keys are derived
+		@param passphrase: Trezor passphrase, part of key derivation
+		@param label: label reported in features
+		@param latency: seconds each call to device takes
+		@param confirmDelay: seconds added when button confirmation
+			is requested
+		"""
+		self.seed = seed
+		self.passphrase = passphrase.decode("utf-8")
+		self.features = EmulatedFeatures(label)
+		self.latency = latency
+		self.confirmDelay = confirmDelay
+		self.calls = {} #maps call name -> count of calls
+		self.lock = threading.Lock()
+
+	def prefillPassphrase(self, passphrase):
+		"""
+		Use this passphrase for key derivation
+		"""
+		self.passphrase = passphrase.decode("utf-8")
+
+	def clear_session(self):
+		self.countCall("clear_session")
+
+	def close(self):
+		pass
+
+	def countCall(self, name):
+		self.calls[name] = self.calls.get(name, 0) + 1
+
+	def wait(self, confirm):
+		"""
+		Sleep for duration of a device call, longer if button has to
+		be pressed.
+		"""
+		delay = self.latency + (self.confirmDelay if confirm else 0.0)
+		if delay > 0:
+			time.sleep(delay)
+
+	def nodeKey(self, n):
+		"""
+		Derive private key for node path n from seed and passphrase.
+		"""
+		secret = self.seed + self.passphrase.encode("utf-8")
+		key = hmac.new("TrezorPass emulator seed", secret, hashlib.sha512).digest()[:32]
+		for index in n:
+			key = hmac.new(key, struct.pack("!I", index), hashlib.sha512).digest()[:32]
+
+		return key
+
+	def cipherKey(self, n, key, ask_on_encrypt, ask_on_decrypt):
+		"""
+		Derive AES key and default IV like Trezor's CipherKeyValue.
+
+		@returns tuple (key, iv)
+		"""
+		if isinstance(key, unicode):
+			key = key.encode("utf-8")
+		keyStr = "CipherKeyValue" + key + \
+			(ask_on_encrypt and "E1" or "E0") + (ask_on_decrypt and "D1" or "D0")
+		data = hmac.new(self.nodeKey(n), keyStr, hashlib.sha512).digest()
+
+		return data[:32], data[32:48]
+
+	def cipherKeyValue(self, name, n, key, value, encrypt, ask_on_encrypt, ask_on_decrypt, iv):
+		if len(value) % self.BLOCKSIZE != 0:
+			raise ValueError("Value must be multiple of %d bytes" % self.BLOCKSIZE)
+
+		with self.lock:
+			self.countCall(name)
+			self.wait(ask_on_encrypt if encrypt else ask_on_decrypt)
+
+			aesKey, defaultIv = self.cipherKey(n, key, ask_on_encrypt, ask_on_decrypt)
+			cipher = AES.new(aesKey, AES.MODE_CBC, iv or defaultIv)
+			if encrypt:
+				return cipher.encrypt(value)
+			else:
+				return cipher.decrypt(value)
+
+	def encrypt_keyvalue(self, n, key, value, ask_on_encrypt=True, ask_on_decrypt=True, iv=""):
+		return self.cipherKeyValue("encrypt_keyvalue", n, key, value, True,
+			ask_on_encrypt, ask_on_decrypt, iv)
+
+	def decrypt_keyvalue(self, n, key, value, ask_on_encrypt=True, ask_on_decrypt=True, iv=""):
+		return self.cipherKeyValue("decrypt_keyvalue", n, key, value, False,
+			ask_on_encrypt, ask_on_decrypt, iv)
@@ -0,0 +1,320 @@
+#!/usr/bin/env python
+"""
+Command line access to TrezorPass password database. Does not need Qt,
+so a single lookup costs only crypto and Trezor round-trips.
+
+Examples:
+	trezorpass_cli.py -f passwords.pwdb list
+	trezorpass_cli.py -f passwords.pwdb list mail
+	trezorpass_cli.py -f passwords.pwdb get mail user@example.com
+	trezorpass_cli.py -f passwords.pwdb add mail user@example.com
+	trezorpass_cli.py -f passwords.pwdb export backup.csv
+	trezorpass_cli.py -f passwords.pwdb export --format jsonl backup.jsonl
+	trezorpass_cli.py -f passwords.pwdb import --format keepass keepass.xml
+	trezorpass_cli.py -f passwords.pwdb search mail
+	trezorpass_cli.py -f passwords.pwdb rename mail work/mail
+	trezorpass_cli.py -f passwords.pwdb convert --chunked
+	trezorpass_cli.py -f passwords.pwdb convert --compression zlib
+
+Agent keeps database unlocked, so lookups skip Trezor enumeration,
+passphrase and unlocking:
+	eval `trezorpass_cli.py -f passwords.pwdb agent`
+	trezorpass_cli.py -f passwords.pwdb agent --foreground	(for debugging)
+	trezorpass_cli.py get mail user@example.com
+"""
+import sys
+import os
+import argparse
+import getpass
+
+import password_map
+import profiler
+from trezor_emulator import EmulatedTrezorClient
+from export import EXPORT_FORMATS, snapshotGroups, exportGroups
+from importer import IMPORT_FORMATS, importFile
+from regroup import moveGroups
+from search_index import SearchIndex, DEFAULT_LIMIT
+from unlock_agent import UnlockAgent, AgentClient, AgentError, \
+	defaultSocketPath, detachProcess, DEFAULT_IDLE_TIMEOUT
+
+def findEntry(group, key):
+	"""
+	@returns index of first entry in group with given key
+	@throws KeyError: if group has no such key
+	"""
+	for idx, entry in enumerate(group.entries):
+		if entry[0] == key:
+			return idx
+
+	raise KeyError("No such key in group: " + key)
+
+def cmdList(pwMap, args):
+	if args.group is None:
+		for groupName in sorted(pwMap.groups.keys()):
+			print groupName
+	else:
+		group = pwMap.groups[args.group]
+		for key, _, _ in group.entries:
+			print key
+
+def cmdGet(pwMap, args):
+	group = pwMap.groups[args.group]
+	entry = group.entry(findEntry(group, args.key))
+	print pwMap.decryptPassword(entry[1], args.group)
+
+def cmdRename(pwMap, args):
+	for groupName in args.source:
+		if groupName not in pwMap.groups:
+			raise KeyError("No such group: " + groupName)
+	privateKey = pwMap.backupKey.unwrapPrivateKey()
+	move = moveGroups(pwMap, args.source, args.target, privateKey,
+		groupKeys=not args.no_group_key, processes=args.processes)
+	print >> sys.stderr, "Moved %d entries" % move.commit()
+	pwMap.save(args.file)
+
+def cmdSearch(pwMap, args):
+	index = SearchIndex()
+	index.build(pwMap.groups)
+	printSearchResults(index.search(args.query, args.limit, args.similar))
+
+def printSearchResults(results):
+	for groupName, key in results:
+		if key is None:
+			print groupName
+		else:
+			print "%s\t%s" % (groupName, key)
+
+def cmdAgent(pwMap, args):
+	socketPath = args.socket or defaultSocketPath()
+	agent = UnlockAgent(pwMap, args.file, socketPath, args.idle_timeout)
+	agent.listen()
+	#shell commands for eval, like ssh-agent
+	shellVars = "TREZORPASS_AGENT=%s; export TREZORPASS_AGENT;" % socketPath
+	if args.foreground:
+		print shellVars
+		sys.stdout.flush()
+		agent.serve()
+		return
+	
+	#parent prints variables and exits, so that command substitution
+	#of eval ends while the agent serves in background
+	pid = os.fork()
+	if pid:
+		print shellVars
+		print "TREZORPASS_AGENT_PID=%d; export TREZORPASS_AGENT_PID;" % pid
+		sys.stdout.flush()
+		os._exit(0)
+	detachProcess()
+	agent.serve()
+
+def agentList(client, args):
+	for name in client.call("list", group=args.group):
+		print name
+
+def agentGet(client, args):
+	print client.call("get", group=args.group, key=args.key)
+
+def agentSearch(client, args):
+	printSearchResults(client.call("search", query=args.query, limit=args.limit,
+		similar=args.similar))
+
+def cmdAdd(pwMap, args):
+	if args.password_stdin:
+		plainPw = sys.stdin.readline().rstrip("\n")
+	else:
+		plainPw = getpass.getpass("Password: ")
+		if plainPw != getpass.getpass("Repeat password: "):
+			raise ValueError("Passwords do not match")
+
+	if args.group not in pwMap.groups:
+		pwMap.addGroup(args.group)
+
+	encPw = pwMap.encryptPassword(plainPw, args.group)
+	bkupPw = pwMap.backupKey.encryptPassword(plainPw)
+	pwMap.addEntry(args.group, args.key, encPw, bkupPw)
+	pwMap.save(args.file)
+
+def cmdExport(pwMap, args):
+	privateKey = pwMap.backupKey.unwrapPrivateKey()
+	snapshot = snapshotGroups(pwMap)
+	with file(args.output, "w") as f:
+		exportGroups(snapshot, pwMap.backupKey, privateKey, EXPORT_FORMATS[args.format](f),
+			processes=args.processes)
+
+def cmdConvert(pwMap, args):
+	if args.chunked is not None:
+		pwMap.chunked = args.chunked
+	if args.compression is not None:
+		if args.compression != "none" and not password_map.compressionAvailable(args.compression):
+			raise IOError("Compression is not available: " + args.compression)
+		pwMap.compression = None if args.compression == "none" else args.compression
+	pwMap.compressionLevel = args.compression_level
+	pwMap.journaled = False
+	pwMap.save(args.file, args.version)
+
+def cmdImport(pwMap, args):
+	with file(args.input) as f:
+		passwordImport = importFile(pwMap, f, args.format, groupKeys=not args.no_group_keys)
+	print >> sys.stderr, "Imported %d entries" % passwordImport.commit()
+	pwMap.save(args.file)
+
+def parseArgs(argv):
+	parser = argparse.ArgumentParser(description="TrezorPass command line interface")
+	parser.add_argument("-f", "--file", default=os.environ.get("TREZORPASS_DB"),
+		help="password database file (default: $TREZORPASS_DB)")
+	parser.add_argument("-l", "--label",
+		help="label of Trezor to use if more are connected")
+	parser.add_argument("--agent", metavar="SOCKET", default=os.environ.get("TREZORPASS_AGENT"),
+		help="ask running agent for list, get and search (default: $TREZORPASS_AGENT)")
+	parser.add_argument("--profile", action="store_true",
+		help="time Trezor calls, loading, saving and backup key operations, report on exit")
+	parser.add_argument("--profile-output", metavar="FILE",
+		help="append profile report to FILE instead of stderr")
+	parser.add_argument("--profile-memory", action="store_true",
+		help="add tracemalloc snapshot to profile report")
+	parser.add_argument("--emulator", metavar="SEED",
+		help="use software Trezor emulator with given seed instead of device, for testing only")
+	subparsers = parser.add_subparsers()
+
+	listParser = subparsers.add_parser("list", help="list groups or keys in a group")
+	listParser.add_argument("group", nargs="?")
+	listParser.set_defaults(command=cmdList, agentCommand=agentList)
+
+	getParser = subparsers.add_parser("get", help="decrypt password and print it")
+	getParser.add_argument("group")
+	getParser.add_argument("key")
+	getParser.set_defaults(command=cmdGet, agentCommand=agentGet)
+
+	searchParser = subparsers.add_parser("search", help="find groups and keys containing query")
+	searchParser.add_argument("query")
+	searchParser.add_argument("--limit", type=int, default=DEFAULT_LIMIT)
+	searchParser.add_argument("--similar", action="store_true",
+		help="also print groups and keys similar to query, e.g. with a typo")
+	searchParser.set_defaults(command=cmdSearch, agentCommand=agentSearch)
+
+	addParser = subparsers.add_parser("add", help="add password, creating group if needed")
+	addParser.add_argument("group")
+	addParser.add_argument("key")
+	addParser.add_argument("--password-stdin", action="store_true",
+		help="read password from first line of stdin instead of prompting")
+	addParser.set_defaults(command=cmdAdd)
+
+	exportParser = subparsers.add_parser("export", help="export all passwords as CSV or JSON Lines")
+	exportParser.add_argument("output")
+	exportParser.add_argument("--format", choices=sorted(EXPORT_FORMATS), default="csv")
+	exportParser.add_argument("--processes", type=int,
+		help="processes decrypting passwords (default: CPU count)")
+	exportParser.set_defaults(command=cmdExport)
+
+	importParser = subparsers.add_parser("import",
+		help="import passwords from exported CSV, JSON Lines or KeePass 2.x XML")
+	importParser.add_argument("input")
+	importParser.add_argument("--format", choices=sorted(IMPORT_FORMATS), default="csv")
+	importParser.add_argument("--no-group-keys", action="store_true",
+		help="create new groups without group key, Trezor then confirms each password")
+	importParser.set_defaults(command=cmdImport)
+
+	renameParser = subparsers.add_parser("rename",
+		help="rename group, merge groups into one or re-key group under its own name")
+	renameParser.add_argument("source", nargs="+")
+	renameParser.add_argument("target")
+	renameParser.add_argument("--no-group-key", action="store_true",
+		help="create target without group key, Trezor then confirms each password")
+	renameParser.add_argument("--processes", type=int,
+		help="processes decrypting passwords (default: CPU count)")
+	renameParser.set_defaults(command=cmdRename)
+
+	convertParser = subparsers.add_parser("convert",
+		help="rewrite database in given storage version and chunking")
+	convertParser.add_argument("--storage-version", dest="version", type=int,
+		choices=[1, 2, 3], default=password_map.STORAGE_VERSION,
+		help="storage version to write, 1 only without hybrid backup data keys (default: %(default)s)")
+	chunkedGroup = convertParser.add_mutually_exclusive_group()
+	chunkedGroup.add_argument("--chunked", action="store_const", const=True,
+		help="split groups into chunks verified and decrypted in parallel (version 2/3)")
+	chunkedGroup.add_argument("--no-chunked", dest="chunked", action="store_const", const=False,
+		help="store each group as one encrypted segment")
+	convertParser.add_argument("--compression", choices=["none"] + sorted(password_map.COMPRESSION_FLAGS),
+		help="compress groups, index and journal before encryption (default: keep)")
+	convertParser.add_argument("--compression-level", type=int, choices=range(10),
+		default=password_map.DEFAULT_COMPRESSION_LEVEL,
+		help="zlib level or lzma preset (default: %(default)s)")
+	convertParser.set_defaults(command=cmdConvert)
+
+	agentParser = subparsers.add_parser("agent",
+		help="keep database unlocked and answer lookups over a Unix socket")
+	agentParser.add_argument("--socket",
+		help="socket path (default: in $XDG_RUNTIME_DIR or private directory in /tmp)")
+	agentParser.add_argument("--idle-timeout", type=int, default=DEFAULT_IDLE_TIMEOUT,
+		help="seconds without requests before agent locks and ends (default: %(default)s)")
+	agentParser.add_argument("--foreground", action="store_true",
+		help="serve in foreground instead of forking into background")
+	agentParser.set_defaults(command=cmdAgent)
+
+	args = parser.parse_args(argv)
+	if args.agent and getattr(args, "agentCommand", None) is not None:
+		return args
+	if args.file is None:
+		parser.error("password database file not given")
+
+	return args
+
+def main(argv):
+	args = parseArgs(argv)
+
+	if args.agent and getattr(args, "agentCommand", None) is not None:
+		try:
+			args.agentCommand(AgentClient(args.agent), args)
+		except (IOError, AgentError), e:
+			print >> sys.stderr, e.message
+			return 5
+		return 0
+
+	if not os.path.isfile(args.file):
+		print >> sys.stderr, "Password database not found:", args.file
+		return 1
+
+	pinErrors, callErrors = (), () #trezorlib errors, emulator raises none
+	if args.emulator is not None:
+		trezor = EmulatedTrezorClient(args.emulator)
+	else:
+		#trezorlib is imported only for real device, so that emulator
+		#and agent clients work without it
+		from trezorlib.client import CallException, PinException
+		from trezorlib.transport import ConnectionError
+		from trezor_client import TrezorChooser
+		pinErrors, callErrors = PinException, CallException
+		try:
+			trezor = TrezorChooser(args.label).getDevice()
+		except (ConnectionError, RuntimeError), e:
+			print >> sys.stderr, "Connection to Trezor failed:", e.message
+			return 1
+
+	if trezor is None:
+		print >> sys.stderr, "No available Trezor found"
+		return 1
+
+	if args.profile:
+		profiler.enable(args.profile_output, args.profile_memory)
+		profiler.enableCore(type(trezor))
+
+	trezor.clear_session()
+	pwMap = password_map.PasswordMap(trezor)
+
+	try:
+		pwMap.load(args.file)
+		args.command(pwMap, args)
+	except pinErrors:
+		print >> sys.stderr, "Invalid PIN"
+		return 8
+	except callErrors:
+		#button cancel on Trezor
+		return 6
+	except (IOError, KeyError, ValueError), e:
+		print >> sys.stderr, e.message
+		return 5
+
+	return 0
+
+if __name__ == "__main__":
+	sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,340 @@
+"""
+Agent keeping unlocked password database and Trezor session in memory,
+serving lookups to clients over a Unix socket. Clients then do not pay
+device enumeration, passphrase and outer key unwrapping on every use.
+
+Protocol is JSON Lines: each request is an object with "command" and
+its arguments on one line, each response is {"ok": true, "result": ...}
+or {"ok": false, "error": message}. Commands:
+	ping
+	list		[group]
+	search		query [limit] [similar]	- similar adds texts not containing query
+	get		group key	- decrypts password, Trezor asks for button
+	lock		- locks the agent and ends it
+
+Socket is created in a directory accessible only to the user, and on
+Linux peers of other users are refused. Agent locks itself (forgets
+keys, clears Trezor session and ends) after idleTimeout seconds without
+requests, and when database file is changed by someone else, since it
+would serve stale data.
+"""
+import os
+import sys
+import stat
+import json
+import time
+import errno
+import socket
+import struct
+import threading
+import SocketServer
+
+from device_worker import DeviceWorker
+from search_index import SearchIndex
+
+DEFAULT_IDLE_TIMEOUT = 15*60 #seconds without requests before agent locks
+MAX_REQUEST_SIZE = 64*1024
+SO_PEERCRED = getattr(socket, "SO_PEERCRED", 17) #Linux value, missing in Python 2
+
+class AgentError(Exception):
+	"""Agent refused or failed a request"""
+	pass
+
+def defaultSocketPath():
+	"""
+	@returns socket path in $XDG_RUNTIME_DIR, or in directory private
+		to the user under /tmp
+	@throws IOError: if /tmp directory exists and is not private
+	"""
+	runtimeDir = os.environ.get("XDG_RUNTIME_DIR")
+	if not runtimeDir:
+		runtimeDir = "/tmp/trezorpass-%d" % os.getuid()
+		try:
+			os.mkdir(runtimeDir, 0700)
+		except OSError, e:
+			if e.errno != errno.EEXIST:
+				raise
+		st = os.lstat(runtimeDir)
+		if not stat.S_ISDIR(st.st_mode) or st.st_uid != os.getuid() or st.st_mode & 077:
+			raise IOError("Agent directory is not private: " + runtimeDir)
+	return os.path.join(runtimeDir, "trezorpass-agent.sock")
+
+def detachProcess():
+	"""
+	Detach forked agent from terminal and from stdout read by command
+	substitution: new session, stdio redirected to /dev/null. Working
+	directory is kept, database file name may be relative to it.
+	"""
+	os.setsid()
+	devnull = os.open(os.devnull, os.O_RDWR)
+	for fd in (0, 1, 2):
+		os.dup2(devnull, fd)
+	if devnull > 2:
+		os.close(devnull)
+
+def peerUid(sock):
+	"""
+	@returns uid of process connected to Unix socket, None if the
+		platform does not tell
+	"""
+	if not sys.platform.startswith("linux"):
+		return None
+	creds = sock.getsockopt(socket.SOL_SOCKET, SO_PEERCRED, struct.calcsize("3i"))
+	return struct.unpack("3i", creds)[1]
+
+class AgentRequestHandler(SocketServer.StreamRequestHandler):
+	"""
+	Answers requests of one client connection, one per line.
+	"""
+
+	def handle(self):
+		agent = self.server.agent
+		uid = peerUid(self.request)
+		if uid is not None and uid != os.getuid():
+			return
+
+		while True:
+			line = self.rfile.readline(MAX_REQUEST_SIZE)
+			if not line:
+				break
+			self.wfile.write(agent.answer(line) + "\n")
+			self.wfile.flush()
+
+class AgentServer(SocketServer.ThreadingMixIn, SocketServer.UnixStreamServer):
+	daemon_threads = True
+
+	def __init__(self, socketPath, agent):
+		self.agent = agent
+		SocketServer.UnixStreamServer.__init__(self, socketPath, AgentRequestHandler)
+
+class UnlockAgent(object):
+	"""
+	Serves requests for loaded PasswordMap. Password map is only read,
+	calls to Trezor are run one after another by DeviceWorker.
+	"""
+
+	def __init__(self, pwMap, dbFilename, socketPath, idleTimeout=DEFAULT_IDLE_TIMEOUT):
+		"""
+		@param pwMap: loaded PasswordMap
+		@param dbFilename: file pwMap was loaded from
+		@param idleTimeout: seconds without requests before agent locks
+		"""
+		self.pwMap = pwMap
+		self.dbFilename = dbFilename
+		self.socketPath = socketPath
+		self.idleTimeout = idleTimeout
+		self.dbStat = self.fileStat()
+		self.lock = threading.Lock() #guards pwMap and searchIndex
+		self.searchIndex = None #built on first search
+		self.worker = DeviceWorker()
+		self.server = None
+		self.lastUse = time.time()
+		self.active = 0 #requests being answered
+		self.activeLock = threading.Lock()
+		self.locked = threading.Event()
+
+	def fileStat(self):
+		st = os.stat(self.dbFilename)
+		return st.st_mtime, st.st_size, st.st_ino
+
+	def fileChanged(self):
+		"""
+		@returns True if database file was changed, renamed or removed
+			since it was loaded
+		"""
+		try:
+			return self.fileStat() != self.dbStat
+		except OSError:
+			return True
+
+	def listen(self):
+		"""
+		Create socket accessible only to the user.
+
+		@throws IOError: if another agent listens on the socket
+		"""
+		self.removeStaleSocket()
+		oldUmask = os.umask(077)
+		try:
+			self.server = AgentServer(self.socketPath, self)
+		finally:
+			os.umask(oldUmask)
+		os.chmod(self.socketPath, 0600)
+
+	def serve(self):
+		"""
+		Answer requests on socket created by listen() until agent is
+		locked.
+		"""
+		self.worker.start()
+		idleThread = threading.Thread(target=self.watchIdle, name="AgentIdle")
+		idleThread.daemon = True
+		idleThread.start()
+		try:
+			self.server.serve_forever()
+		finally:
+			self.server.server_close()
+			self.forgetKeys()
+			try:
+				os.remove(self.socketPath)
+			except OSError:
+				pass
+
+	def removeStaleSocket(self):
+		"""
+		Remove socket left by agent that ended without cleanup.
+		"""
+		if not os.path.exists(self.socketPath):
+			return
+		try:
+			AgentClient(self.socketPath).call("ping")
+		except IOError:
+			os.remove(self.socketPath)
+			return
+		raise IOError("Agent is already running on " + self.socketPath)
+
+	def watchIdle(self):
+		while not self.locked.wait(1.0):
+			idle = self.active == 0 and time.time() - self.lastUse > self.idleTimeout
+			if idle or self.fileChanged():
+				self.lockAgent()
+
+	def lockAgent(self):
+		"""
+		Stop serving, forget keys once last request is answered.
+		"""
+		if self.locked.is_set():
+			return
+		self.locked.set()
+		threading.Thread(target=self.server.shutdown).start()
+
+	def forgetKeys(self):
+		with self.lock:
+			self.pwMap.lockGroups()
+			self.pwMap.outerKey = None
+			self.pwMap.wrappedOuterKey = None
+			self.pwMap.groups = None
+			self.searchIndex = None
+		try:
+			self.worker.submit("Clear session", self.pwMap.trezor.clear_session).result(10)
+		except Exception:
+			#Trezor disconnected or busy, session ends with it anyway
+			pass
+		self.worker.stop()
+
+	def answer(self, line):
+		"""
+		@returns response to request line as JSON
+		"""
+		with self.activeLock:
+			self.active += 1
+		try:
+			if self.locked.is_set() or self.fileChanged():
+				self.lockAgent()
+				raise AgentError("Agent is locked")
+			request = json.loads(line)
+			command = request["command"]
+			handler = getattr(self, "cmd" + command.capitalize(), None)
+			if handler is None:
+				raise AgentError("Unknown command: " + command)
+			return json.dumps({"ok": True, "result": handler(request)})
+		except Exception, e:
+			#bad requests as well as Trezor errors, e.g. cancel on device
+			message = e.message or e.__class__.__name__
+			if isinstance(message, str):
+				message = message.decode("utf-8", "replace")
+			return json.dumps({"ok": False, "error": message})
+		finally:
+			with self.activeLock:
+				self.lastUse = time.time()
+				self.active -= 1
+
+	def cmdPing(self, request):
+		return "pong"
+
+	def cmdList(self, request):
+		groupName = request.get("group")
+		with self.lock:
+			if groupName is None:
+				return sorted(self.pwMap.groups.keys())
+			return list(self.group(groupName).keys)
+
+	def cmdSearch(self, request):
+		with self.lock:
+			if self.searchIndex is None:
+				self.searchIndex = SearchIndex()
+				self.searchIndex.build(self.pwMap.groups)
+			return self.searchIndex.search(request["query"].encode("utf-8"),
+				int(request.get("limit", 50)), bool(request.get("similar", True)))
+
+	def cmdGet(self, request):
+		groupName = request["group"].encode("utf-8")
+		key = request["key"].encode("utf-8")
+		with self.lock:
+			group = self.group(groupName)
+			for idx, entryKey in enumerate(group.keys):
+				if entryKey == key:
+					encPw = group.values[idx]
+					break
+			else:
+				raise KeyError("No such key in group: " + key)
+
+		request = self.worker.submit("Decrypt password", self.pwMap.decryptPassword,
+			encPw, groupName)
+		return request.result().decode("utf-8")
+
+	def cmdLock(self, request):
+		self.lockAgent()
+		return None
+
+	def group(self, groupName):
+		if isinstance(groupName, unicode):
+			groupName = groupName.encode("utf-8")
+		if groupName not in self.pwMap.groups:
+			raise KeyError("No such group: " + groupName)
+		return self.pwMap.groups[groupName]
+
+class AgentClient(object):
+	"""
+	Sends requests to UnlockAgent, strings in results are utf-8.
+	"""
+
+	def __init__(self, socketPath):
+		self.socketPath = socketPath
+
+	def call(self, command, **args):
+		"""
+		@returns result of command
+		@throws IOError: if agent is not running
+		@throws AgentError: if agent refused or failed the request
+		"""
+		args["command"] = command
+		sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+		try:
+			try:
+				sock.connect(self.socketPath)
+			except socket.error, e:
+				raise IOError("Agent is not running: " + str(e))
+			f = sock.makefile("r+b")
+			f.write(json.dumps(args) + "\n")
+			f.flush()
+			line = f.readline()
+		finally:
+			sock.close()
+
+		if not line:
+			raise IOError("Agent closed connection")
+		response = json.loads(line)
+		if not response.get("ok"):
+			raise AgentError(response.get("error", "").encode("utf-8"))
+		return utf8(response.get("result"))
+
+def utf8(value):
+	"""
+	@returns value decoded from JSON with strings encoded as utf-8
+	"""
+	if isinstance(value, unicode):
+		return value.encode("utf-8")
+	if isinstance(value, list):
+		return [utf8(v) for v in value]
+	return value